@@ -0,0 +1,458 @@
+process.env.KASPA_WASM_HEAP_SIZE_MB = "256";
+globalThis.WebSocket = require("websocket").w3cwebsocket;
+const readline = require("readline");
+const sleep = ms => new Promise(res => setTimeout(res, ms));
+
+const {
+    Address,
+    PrivateKey,
+    RpcClient,
+    kaspaToSompi,
+    sompiToKaspaString,
+    createTransactions,
+    Resolver
+} = require('../../../../nodejs/kaspa');
+
+// Long-lived version of simple-transaction.js.
+// Reads one JSON payout request per line on stdin: {"id": 1, "address": "kaspa:...", "amount": "12.5"}
+// Writes one JSON log entry per line on stdout, tagged with the request id, and finishes every
+// request with {"type": "result", "id": 1, "result": true|false}.
+// A batch {"id": 1, "outputs": [{"address": ..., "amount": ...}, ...]} is paid with one multi-output
+// transaction. Outputs that fail validation are left out of it and reported with an "error" entry
+// carrying their "output" index, and the result entry adds "outputs": [true|false, ...], one per output.
+// A payout that is submitted but not confirmed in time is reported with a {"type": "pending", "txid": ...}
+// entry; the server's payout tracker follows it from there with
+// {"id": 2, "method": "check", "addresses": [...], "txids": [...]} requests, answered with the confirmed txids.
+// {"id": 3, "method": "status"} answers whether the node is reachable and synced.
+// Errors that mean the node could not be reached (before anything was submitted) carry "offline": true,
+// so the server can keep the payout and send it later. A payout (or batch output) may carry an idempotency
+// "key": a key that was already submitted is rejected with "duplicate": true and the earlier "txid".
+// The RPC connection is kept open between requests.
+// The hot wallet's UTXOs and the node's fee estimate are cached and kept warm between payouts (UTXO change
+// notifications, plus a periodic full refresh), so a payout only picks inputs, signs and submits.
+// {"id": 4, "method": "wallet"} answers the cache's state.
+// --presplit-count=N --presplit-amount=KAS keeps at least N UTXOs of about KAS each, split off the wallet's
+// large UTXOs while no payout is waiting, so most payouts spend a single payout-sized input.
+let { encoding, networkId } = require("../utils").parseArgs({
+    additionalParseArgs: {
+        "presplit-count": { type: "string" },
+        "presplit-amount": { type: "string" },
+    },
+    additionalHelpOutput: `
+        --presplit-count <utxos> --presplit-amount <amount_in_kaspa>`,
+});
+const argValue = name => {
+    const arg = process.argv.find(arg => arg.startsWith(`--${name}=`));
+    return arg ? arg.split("=")[1] : undefined;
+};
+const presplitCount = Number(argValue("presplit-count") ?? 0);
+const presplitAmountSompi = presplitCount > 0 ? kaspaToSompi(argValue("presplit-amount") ?? "0") : 0n;
+
+// `phase` marks the end of a payout step (connect, build, sign, submit, confirm), for the server's metrics
+function log(message, level = "info", id = null, phase = undefined, fields = {}) {
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: level, message, id, phase, ...fields }));
+}
+const privateKeyHex = process.env.KASPA_PRIVATE_KEY;
+if (!privateKeyHex) {
+    log("Missing KASPA_PRIVATE_KEY environment variable", "error");
+    process.exit(1);
+}
+const privateKey = new PrivateKey(privateKeyHex);
+const sourceAddress = privateKey.toKeypair().toAddress(networkId);
+const rpc = new RpcClient({ resolver: new Resolver(), networkId });
+
+async function ensureConnected(id = null) {
+    if (!rpc.isConnected) {
+        await rpc.connect();
+        log(`Connected to ${rpc.url}`, "info", id);
+    }
+}
+
+const UTXO_REFRESH_MS = 30 * 1000;     // Full refresh, in case a change notification was missed
+const FEE_REFRESH_MS = 10 * 1000;      // Fee estimate and sync state
+const WARM_MAX_AGE_MS = 60 * 1000;     // Older than this, a payout refreshes the cache before using it
+const RESERVED_MAX_AGE_MS = 10 * 60 * 1000;
+const MAX_INPUTS = 10;
+
+const wallet = {
+    utxos: new Map(),     // "txid:index" -> UTXO entry of sourceAddress
+    reserved: new Map(),  // "txid:index" -> time it was spent by a submitted transaction, until the node drops it
+    utxosAt: 0,
+    feeRate: null,        // sompi per gram, from the node's normal fee bucket
+    synced: false,
+    statusAt: 0,
+    subscribed: false,
+    splitAt: 0,           // Last pre-split, whose outputs may not be in the cache yet
+};
+const outpointKey = entry => `${entry.outpoint.transactionId}:${entry.outpoint.index}`;
+
+async function refreshUtxos() {
+    const { entries } = await rpc.getUtxosByAddresses([sourceAddress]);
+    wallet.utxos = new Map(entries.map(entry => [outpointKey(entry), entry]));
+    wallet.utxosAt = Date.now();
+    for (const [key, spentAt] of wallet.reserved) {
+        if (!wallet.utxos.has(key) || Date.now() - spentAt > RESERVED_MAX_AGE_MS)
+            wallet.reserved.delete(key);
+    }
+}
+
+async function refreshStatus() {
+    ({ isSynced: wallet.synced } = await rpc.getServerInfo());
+    const { estimate } = await rpc.getFeeEstimate({});
+    wallet.feeRate = (estimate.normalBuckets[0] ?? estimate.priorityBucket).feerate;
+    wallet.statusAt = Date.now();
+}
+
+function onUtxosChanged({ data }) {
+    for (const entry of data.removed ?? []) {
+        wallet.utxos.delete(outpointKey(entry));
+        wallet.reserved.delete(outpointKey(entry));
+    }
+    for (const entry of data.added ?? [])
+        wallet.utxos.set(outpointKey(entry), entry);
+}
+
+async function subscribeUtxos() {
+    if (wallet.subscribed)
+        return;
+    await rpc.subscribeUtxosChanged([sourceAddress]);
+    wallet.subscribed = true;
+}
+
+// Spendable UTXOs, refreshed first if the cache is cold or too old
+async function spendableEntries() {
+    if (Date.now() - wallet.utxosAt > WARM_MAX_AGE_MS)
+        await refreshUtxos();
+    return [...wallet.utxos.values()].filter(entry => !wallet.reserved.has(outpointKey(entry)));
+}
+
+// The smallest single UTXO that covers `needed` (a pre-split one, ideally), else the largest ones until they do
+function selectInputs(entries, needed) {
+    const ascending = [...entries].sort((a, b) => (a.amount < b.amount ? -1 : a.amount > b.amount ? 1 : 0));
+    const single = ascending.find(entry => entry.amount >= needed);
+    if (single)
+        return [single];
+    const inputs = [];
+    let total = 0n;
+    for (const entry of ascending.reverse().slice(0, MAX_INPUTS)) {
+        inputs.push(entry);
+        total += entry.amount;
+        if (total >= needed)
+            break;
+    }
+    return inputs;
+}
+
+function reserveInputs(transaction) {
+    const now = Date.now();
+    for (const input of transaction.transaction.inputs)
+        wallet.reserved.set(`${input.previousOutpoint.transactionId}:${input.previousOutpoint.index}`, now);
+}
+
+// Splits a large UTXO into payout-sized ones while the wallet has too few of them
+async function presplit() {
+    if (Date.now() - wallet.splitAt < UTXO_REFRESH_MS)
+        return;
+    const payoutSized = [...wallet.utxos.values()].filter(entry => !wallet.reserved.has(outpointKey(entry))
+        && entry.amount >= presplitAmountSompi && entry.amount < presplitAmountSompi * 2n);
+    const missing = presplitCount - payoutSized.length;
+    if (missing < presplitCount / 2)
+        return;
+    const needed = presplitAmountSompi * BigInt(missing);
+    const large = (await spendableEntries()).filter(entry => entry.amount >= presplitAmountSompi * 2n);
+    const inputs = selectInputs(large, needed + presplitAmountSompi);
+    if (inputs.reduce((total, entry) => total + entry.amount, 0n) < needed + presplitAmountSompi)
+        return;
+    const { transactions } = await createTransactions({
+        entries: inputs,
+        outputs: Array.from({ length: missing }, () => ({ address: sourceAddress, amount: presplitAmountSompi })),
+        priorityFee: 0n,
+        feeRate: wallet.feeRate ?? undefined,
+        changeAddress: sourceAddress,
+        networkId
+    });
+    for (const pending of transactions) {
+        await pending.sign([privateKey]);
+        const txid = await pending.submit(rpc);
+        reserveInputs(pending);
+        wallet.splitAt = Date.now();
+        log(`Split ${missing} UTXOs of ${sompiToKaspaString(presplitAmountSompi)} KAS off the wallet, TXID: ${txid}`);
+    }
+}
+
+// Keeps the cache warm; a failed refresh is retried on the next round (and by the next payout)
+async function keepWalletWarm() {
+    let lastUtxoRefresh = 0;
+    while (true) {
+        try {
+            await ensureConnected();
+            await subscribeUtxos();
+            await refreshStatus();
+            if (Date.now() - lastUtxoRefresh >= UTXO_REFRESH_MS) {
+                await refreshUtxos();
+                lastUtxoRefresh = Date.now();
+            }
+            if (presplitCount > 0 && wallet.synced && activeRequests.size === 0)
+                queue = queue.then(() => presplit().catch(error =>
+                    log(`Pre-split failed: ${error.message || JSON.stringify(error)}`, "warn")));
+        } catch (error) {
+            wallet.subscribed = false;
+            log(`Wallet cache refresh failed: ${error.message || JSON.stringify(error)}`, "warn");
+        }
+        await sleep(FEE_REFRESH_MS);
+    }
+}
+
+const submittedKeys = new Map();  // idempotency key -> txid, oldest first
+const MAX_SUBMITTED_KEYS = 10000;
+
+function rememberSubmitted(outputs, txid) {
+    for (const { key } of outputs) {
+        if (key)
+            submittedKeys.set(key, txid);
+    }
+    while (submittedKeys.size > MAX_SUBMITTED_KEYS)
+        submittedKeys.delete(submittedKeys.keys().next().value);
+}
+
+// Returns the output with its amount in sompi, or null (after logging why) if it cannot be paid
+function checkOutput(id, { address, amount, key }, index) {
+    const fields = index === undefined ? {} : { output: index };
+    if (key && submittedKeys.has(key)) {
+        const txid = submittedKeys.get(key);
+        log(`Payout ${key} was already submitted, TXID: ${txid}`, "error", id, undefined, { ...fields, duplicate: true, txid });
+        return null;
+    }
+    if (!amount) {
+        log("Missing amount.", "error", id, undefined, fields);
+        return null;
+    }
+    const amountSompi = kaspaToSompi(String(amount));
+    if (!(amountSompi > 0)) {
+        log("Invalid amount. Must be greater than zero.", "error", id, undefined, fields);
+        return null;
+    }
+    if (!Address.validate(address)) {
+        log(`Invalid address: ${address}`, "error", id, undefined, fields);
+        return null;
+    }
+    return { address, amount, amountSompi, key };
+}
+
+async function sendKaspaTransaction(id, outputs) {
+    const info = (message, level = "info", phase = undefined, fields = {}) => log(message, level, id, phase, fields);
+    try {
+        if (!outputs.length) {
+            info("No valid outputs to send.", "error");
+            return false;
+        }
+
+        // The sync state and the UTXOs come from the warm cache when it is fresh enough
+        let entries;
+        try {
+            await ensureConnected(id);
+            if (Date.now() - wallet.statusAt > FEE_REFRESH_MS * 2)
+                await refreshStatus();
+            entries = await spendableEntries();
+        } catch (error) {
+            info(`Node unreachable: ${error.message || JSON.stringify(error)}`, "error", undefined, { offline: true });
+            return false;
+        }
+        if (!wallet.synced) {
+            info("Node is not synced. Aborting.", "error", undefined, { offline: true });
+            return false;
+        }
+        if (!entries.length) {
+            info("No UTXOs found for address", "error");
+            return false;
+        }
+
+        const totalSompi = outputs.reduce((total, output) => total + output.amountSompi, 0n);
+        if (outputs.length === 1) {
+            info(`Attempting to send ${outputs[0].amount} KASPA (${totalSompi.toString()} sompi) to ${outputs[0].address}`, "info", "connect");
+        } else {
+            info(`Attempting to send ${totalSompi.toString()} sompi to ${outputs.length} addresses in one transaction`, "info", "connect");
+        }
+
+        const paymentOutputs = outputs.map(({ address, amountSompi }) => ({ address, amount: amountSompi }));
+        const build = inputs => createTransactions({
+            entries: inputs,
+            outputs: paymentOutputs,
+            priorityFee: 0n,
+            feeRate: wallet.feeRate ?? undefined,
+            changeAddress: sourceAddress,
+            networkId
+        });
+        let transactions;
+        try {
+            // Some room for the fee, so a single pre-split UTXO is only picked if it also covers that
+            ({ transactions } = await build(selectInputs(entries, totalSompi + totalSompi / 100n + 100000n)));
+        } catch (error) {
+            info(`Selected inputs were not enough (${error.message || error}), using the whole wallet`, "warn");
+            ({ transactions } = await build(selectInputs(entries, Infinity)));  // The MAX_INPUTS largest
+        }
+
+        if (!transactions || !transactions.length) {
+            info("Transaction creation failed.", "error");
+            return false;
+        }
+
+        if (cancelledRequests.has(id)) {
+            info("Payout cancelled before submission.", "error");
+            return false;
+        }
+        signingRequests.add(id);  // Too late to cancel from here on
+
+        let pending = transactions[0];
+        info("Signing transaction...", "info", "build");
+        await pending.sign([privateKey]);
+
+        info("Submitting transaction...", "info", "sign");
+        let txid;
+        try {
+            txid = await pending.submit(rpc);
+        } catch (error) {
+            wallet.utxosAt = 0;  // The cache may be out of date (e.g. inputs already spent): refetch next time
+            throw error;
+        }
+        reserveInputs(pending);
+        rememberSubmitted(outputs, txid);
+        info(`Transaction sent. TXID: ${txid}. Waiting for confirmation...`, "info", "submit", { txid });
+
+        const addresses = [...new Set(outputs.map(output => output.address))];
+        let confirmed = false;
+        for (let i = 0; i < 15; i++) {  // Check 15 times, once per second
+            let { entries } = await rpc.getUtxosByAddresses(addresses);
+            if (entries.some(tx => tx.outpoint.transactionId === txid)) {
+                info(`Transaction confirmed! TXID: ${txid}`, "success", "confirm", { txid });
+                confirmed = true;
+                break;
+            }
+            await sleep(1000);
+        }
+
+        if (!confirmed) {
+            info("Transaction unconfirmed! Don't worry - I will keep checking in the background and resend if needed.", "warn");
+            const paid = outputs.map(({ address, amount }) => ({ address, amount }));
+            info(`Pending TXID: ${txid}`, "pending", undefined, { txid, ...paid[0], outputs: paid });
+        }
+
+        return confirmed;
+
+    } catch (error) {
+        info(`Exception: ${error.message || JSON.stringify(error)}`, "error");
+        return false;
+    }
+}
+
+// Looks up all the addresses in one RPC call and returns the txids (of `txids`) that reached them
+async function checkTransactions({ id, addresses, txids }) {
+    let result = false;
+    try {
+        await ensureConnected(id);
+        const { entries } = await rpc.getUtxosByAddresses(addresses);
+        const wanted = new Set(txids);
+        result = [...new Set(entries.map(entry => entry.outpoint.transactionId).filter(txid => wanted.has(txid)))];
+    } catch (error) {
+        log(`Check failed: ${error.message || JSON.stringify(error)}`, "error", id);
+    }
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result }));
+}
+
+// Answers the wallet cache's state: UTXO count and balance, pre-split UTXOs, fee rate and ages in seconds
+function walletStatus({ id }) {
+    const spendable = [...wallet.utxos.values()].filter(entry => !wallet.reserved.has(outpointKey(entry)));
+    const result = {
+        utxos: spendable.length,
+        reserved: wallet.reserved.size,
+        balance: sompiToKaspaString(spendable.reduce((total, entry) => total + entry.amount, 0n)),
+        presplit: presplitCount > 0 ? spendable.filter(entry => entry.amount >= presplitAmountSompi
+            && entry.amount < presplitAmountSompi * 2n).length : null,
+        fee_rate: wallet.feeRate,
+        synced: wallet.synced,
+        subscribed: wallet.subscribed,
+        utxo_age: wallet.utxosAt ? (Date.now() - wallet.utxosAt) / 1000 : null,
+        status_age: wallet.statusAt ? (Date.now() - wallet.statusAt) / 1000 : null,
+    };
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result }));
+}
+
+// Answers whether the node is reachable and synced
+async function checkStatus({ id }) {
+    let result = false;
+    try {
+        await ensureConnected(id);
+        ({ isSynced: result } = await rpc.getServerInfo());
+    } catch (error) {
+        log(`Status check failed: ${error.message || JSON.stringify(error)}`, "warn", id);
+    }
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result: result === true }));
+}
+
+async function handleRequest(request) {
+    const { id } = request;
+    const batch = Array.isArray(request.outputs);
+    const outputs = batch ? request.outputs : [{ address: request.address, amount: request.amount, key: request.key }];
+    const checked = outputs.map((output, index) => checkOutput(id, output, batch ? index : undefined));
+    const result = await sendKaspaTransaction(id, checked.filter(output => output !== null));
+    activeRequests.delete(id);
+    cancelledRequests.delete(id);
+    signingRequests.delete(id);
+    const perOutput = batch ? { outputs: checked.map(output => output !== null && result) } : {};
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result, ...perOutput }));
+}
+
+// Requests are handled one at a time so two payouts never pick the same UTXOs
+let queue = Promise.resolve();
+const activeRequests = new Set();     // queued or running request ids
+const cancelledRequests = new Set();  // {"id": 1, "cancel": true} received before submission
+const signingRequests = new Set();    // past the last cancel check, being signed or submitted
+const input = readline.createInterface({ input: process.stdin });
+input.on("line", (line) => {
+    let request;
+    try {
+        request = JSON.parse(line);
+    } catch (error) {
+        log(`Ignoring malformed request: ${line}`, "warn");
+        return;
+    }
+    if (request.method === "check") {
+        checkTransactions(request);  // Read only, so it does not wait for queued payouts
+        return;
+    }
+    if (request.method === "status") {
+        checkStatus(request);
+        return;
+    }
+    if (request.method === "wallet") {
+        walletStatus(request);
+        return;
+    }
+    if (request.cancel) {
+        // Answered right away: the server needs to know whether the payout may still go out
+        if (signingRequests.has(request.id)) {
+            log("Too late to cancel, the transaction is being signed or was sent.", "warn", request.id, undefined, { cancelled: false });
+            return;
+        }
+        if (activeRequests.has(request.id))
+            cancelledRequests.add(request.id);
+        log("Cancel accepted, the payout will not be submitted.", "info", request.id, undefined, { cancelled: true });
+        return;
+    }
+    activeRequests.add(request.id);
+    queue = queue.then(() => handleRequest(request));
+});
+input.on("close", async () => {
+    await queue;
+    await rpc.disconnect();
+    process.exit(0);
+});
+
+rpc.addEventListener("utxos-changed", onUtxosChanged);
+rpc.addEventListener("disconnect", () => { wallet.subscribed = false; });
+ensureConnected()
+    .catch((error) => log(`Initial connect failed, will retry on the first payout: ${error.message}`, "warn"))
+    .finally(() => {
+        log("Transaction worker ready", "ready");
+        keepWalletWarm();
+    });
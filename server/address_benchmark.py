@@ -0,0 +1,58 @@
+"""
+Checks the Kaspa address decoder against test vectors, then times it.
+
+    python3 address_benchmark.py [--iterations 100000]
+"""
+import argparse
+import timeit
+
+from kaspa_address import decode_address, encode_address, is_valid_kaspa_address
+
+MAINNET_ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+
+# (address, valid on mainnet)
+TEST_VECTORS = [
+    (MAINNET_ADDRESS, True),
+    (MAINNET_ADDRESS.upper(), True),
+    (encode_address("kaspa", 1, bytes(range(33))), True),   # ECDSA public key
+    (encode_address("kaspa", 8, bytes(range(32))), True),   # Script hash
+    (encode_address("kaspatest", 0, bytes(32)), False),     # Valid, but not mainnet
+    (MAINNET_ADDRESS[:-1] + "9", False),                    # Checksum character changed
+    (MAINNET_ADDRESS[:20] + "z" + MAINNET_ADDRESS[21:], False),  # Payload character changed
+    (MAINNET_ADDRESS[:-1], False),                          # Truncated
+    (MAINNET_ADDRESS[:10] + MAINNET_ADDRESS[10:].upper(), False),  # Mixed case
+    ("kaspa:" + MAINNET_ADDRESS[6:].replace("q", "b", 1), False),  # 'b' is not in the charset
+    ("bitcoin:" + MAINNET_ADDRESS[6:], False),
+    (encode_address("kaspa", 2, bytes(32)), False),         # Unknown version
+    (encode_address("kaspa", 0, bytes(31)), False),         # Wrong payload length
+    ("https://kaspa.org", False),
+    ("", False),
+]
+
+
+def check_vectors():
+    for address, expected in TEST_VECTORS:
+        result = is_valid_kaspa_address(address)
+        assert result == expected, f"{address!r}: expected {expected}, got {result}"
+    prefix, version, data = decode_address(MAINNET_ADDRESS)
+    assert encode_address(prefix, version, data) == MAINNET_ADDRESS
+    print(f"{len(TEST_VECTORS)} test vectors passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    check_vectors()
+    for name, statement in [
+        ("full decode", lambda: decode_address(MAINNET_ADDRESS)),
+        ("cached is_valid_kaspa_address", lambda: is_valid_kaspa_address(MAINNET_ADDRESS)),
+        ("reject bad prefix", lambda: is_valid_kaspa_address.__wrapped__("https://kaspa.org")),
+    ]:
+        seconds = timeit.timeit(statement, number=args.iterations)
+        print(f"{name:32} {seconds / args.iterations * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Compares payout submit latency across the payout backends: the Node worker, gRPC and the mock.
+
+    python3 backend_benchmark.py [--payouts 20] [--backends node,grpc,mock] [--delay-factor 0.2]
+                                 [--node-latency 0.005] [--grpc-node HOST:PORT ...] [--address ADDRESS]
+
+Sends payouts one after another through each backend and reports the time from the request to
+the "submit" entry (the transaction is with the node) and to the result, and how long the
+backend took to get ready. "node" runs mock-transaction-worker.js (needs node) and "mock" runs
+in process, both with the mock's step delays times --delay-factor. Without --grpc-node, "grpc"
+talks to a stub node served over real gRPC from this process, which answers every call after
+--node-latency seconds and checks the signatures: that measures the client side (pool,
+transaction building, signing, protobuf). With --grpc-node it pays real money from
+KASPA_PRIVATE_KEY to --address, so point it at a testnet node.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from payout_backend import TERMINAL_TYPE, MockPayoutBackend, open_payout_backend
+
+MOCK_WORKER_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock-transaction-worker.js")
+ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+
+
+async def serve_stub_node(secret, latency):
+    """Starts a stub Kaspa node on a free local port. Returns (server, "host:port")."""
+    import grpc
+    from kaspy.protos import rpc_pb2
+    from kaspy.protos.messages_pb2 import KaspadMessage
+    from kaspy.protos.messages_pb2_grpc import RPCServicer, add_RPCServicer_to_server
+
+    from kaspa_tx import (SOMPI_PER_KASPA, Transaction, TxInput, TxOutput, Utxo, address_of_secret,
+                          pay_to_address_script, schnorr_public_key, schnorr_verify, signature_hash,
+                          transaction_id)
+
+    public_key = schnorr_public_key(secret)
+    wallet_address = address_of_secret(secret)
+    utxos = {}  # outpoint -> Utxo
+    for index in range(20):
+        utxo = Utxo(f"{index:064x}", 0, 100 * SOMPI_PER_KASPA, *pay_to_address_script(wallet_address))
+        utxos[utxo.outpoint] = utxo
+
+    def submit(request):
+        rpc_tx = request.transaction
+        inputs = []
+        for rpc_input in rpc_tx.inputs:
+            outpoint = f"{rpc_input.previousOutpoint.transactionId}:{rpc_input.previousOutpoint.index}"
+            if outpoint not in utxos:
+                return rpc_pb2.SubmitTransactionResponseMessage(error=rpc_pb2.RPCError(message=f"{outpoint} is spent"))
+            inputs.append(TxInput(utxos[outpoint], bytes.fromhex(rpc_input.signatureScript),
+                                  rpc_input.sequence, rpc_input.sigOpCount))
+        outputs = [TxOutput(output.amount, output.scriptPublicKey.version, bytes.fromhex(output.scriptPublicKey.scriptPublicKey))
+                   for output in rpc_tx.outputs]
+        tx = Transaction(inputs, outputs)
+        for index, tx_input in enumerate(inputs):
+            if not schnorr_verify(public_key, signature_hash(tx, index), tx_input.signature_script[1:65]):
+                return rpc_pb2.SubmitTransactionResponseMessage(error=rpc_pb2.RPCError(message=f"bad signature on input {index}"))
+        txid = transaction_id(tx)
+        for tx_input in inputs:
+            del utxos[tx_input.utxo.outpoint]
+        for index, output in enumerate(outputs):
+            utxos[f"{txid}:{index}"] = Utxo(txid, index, output.amount, output.script_version, output.script)
+        return rpc_pb2.SubmitTransactionResponseMessage(transactionId=txid)
+
+    def utxos_by_addresses(request):
+        wanted = {pay_to_address_script(address)[1]: address for address in request.addresses}
+        return rpc_pb2.GetUtxosByAddressesResponseMessage(entries=[rpc_pb2.UtxosByAddressesEntry(
+            address=wanted[utxo.script],
+            outpoint=rpc_pb2.RpcOutpoint(transactionId=utxo.transaction_id, index=utxo.index),
+            utxoEntry=rpc_pb2.RpcUtxoEntry(amount=utxo.amount, scriptPublicKey=rpc_pb2.RpcScriptPublicKey(
+                version=utxo.script_version, scriptPublicKey=utxo.script.hex()))
+        ) for utxo in utxos.values() if utxo.script in wanted])
+
+    handlers = {
+        "getInfoRequest": lambda request: ("getInfoResponse", rpc_pb2.GetInfoResponseMessage(
+            isSynced=True, isUtxoIndexed=True, serverVersion="stub")),
+        "getUtxosByAddressesRequest": lambda request: ("getUtxosByAddressesResponse", utxos_by_addresses(request)),
+        "submitTransactionRequest": lambda request: ("submitTransactionResponse", submit(request)),
+    }
+
+    class StubNode(RPCServicer):
+        async def MessageStream(self, request_iterator, context):
+            async for message in request_iterator:
+                name = message.WhichOneof("payload")
+                await asyncio.sleep(latency)
+                response_name, response = handlers[name](getattr(message, name))
+                yield KaspadMessage(**{response_name: response})
+
+    server = grpc.aio.server()
+    add_RPCServicer_to_server(StubNode(), server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+    return server, f"127.0.0.1:{port}"
+
+
+async def run(label, backend, payout_count, address):
+    start = time.perf_counter()
+    backend.start()
+    while not backend.ready:
+        await asyncio.sleep(0.01)
+    ready_seconds = time.perf_counter() - start
+
+    submits = []
+    totals = []
+    confirmed = 0
+    for index in range(payout_count):
+        start = time.perf_counter()
+        async for entry in backend.payout(address, f"{1 + index % 7}.5", timeout=120, key=f"{label}-{index}"):
+            if entry.get("phase") == "submit":
+                submits.append(time.perf_counter() - start)
+            if entry.get("type") == "error":
+                print(f"{label:>5}: {entry.get('message')}")
+            if entry.get("type") == TERMINAL_TYPE:
+                confirmed += entry.get("result") is True
+        totals.append(time.perf_counter() - start)
+    await backend.stop()
+
+    submits.sort()
+    totals.sort()
+    submit_text = (f"submit p50 {submits[len(submits) // 2] * 1000:7.1f} ms, p95 {submits[int(len(submits) * 0.95)] * 1000:7.1f} ms"
+                   if submits else "never submitted")
+    print(f"{label:>5}: ready in {ready_seconds:5.2f} s | {confirmed}/{payout_count} confirmed | {submit_text} | "
+          f"result p50 {totals[len(totals) // 2]:6.2f} s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payouts", type=int, default=20)
+    parser.add_argument("--backends", default="node,grpc,mock")
+    parser.add_argument("--delay-factor", type=float, default=0.2, help="step delays of the node and mock backends")
+    parser.add_argument("--node-latency", type=float, default=0.005, help="seconds the stub node takes per call")
+    parser.add_argument("--grpc-node", action="append", default=[], help="real node to use instead of the stub")
+    parser.add_argument("--network", default="mainnet")
+    parser.add_argument("--address", default=ADDRESS, help="payout address")
+    args = parser.parse_args()
+
+    for name in args.backends.split(","):
+        if name == "node":
+            backend = open_payout_backend("node", worker_script=MOCK_WORKER_JS,
+                                          worker_args=[f"--delay-factor={args.delay_factor}"])
+            await run(name, backend, args.payouts, args.address)
+        elif name == "mock":
+            await run(name, MockPayoutBackend(delay_factor=args.delay_factor), args.payouts, args.address)
+        elif name == "grpc" and args.grpc_node:
+            backend = open_payout_backend("grpc", grpc_nodes=args.grpc_node, network=args.network)
+            await run(name, backend, args.payouts, args.address)
+        elif name == "grpc":
+            os.environ["KASPA_PRIVATE_KEY"] = os.urandom(32).hex()  # Only this process's stub node knows it
+            server, target = await serve_stub_node(bytes.fromhex(os.environ["KASPA_PRIVATE_KEY"]), args.node_latency)
+            try:
+                await run(name, open_payout_backend("grpc", grpc_nodes=[target]), args.payouts, args.address)
+            finally:
+                await server.stop(None)
+        else:
+            parser.error(f"unknown backend {name!r}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""
+Measures Broadcaster fan-out latency over real localhost WebSocket connections.
+
+    python3 broadcast_benchmark.py [--clients 1 10 100] [--events 200] [--interval 0.005]
+
+For each client count, publishes `--events` submit-log events and reports the time from
+publish() to receipt by each client, plus how long publish() itself holds the event loop.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import websockets
+
+from broadcaster import Broadcaster
+
+
+async def run(client_count, event_count, interval):
+    broadcaster = Broadcaster(max_queue=event_count + 1)
+    connected = asyncio.Event()
+
+    async def handler(websocket):
+        broadcaster.add(websocket)
+        if len(broadcaster) == client_count:
+            connected.set()
+        try:
+            await websocket.wait_closed()
+        finally:
+            broadcaster.remove(websocket)
+
+    server = await websockets.serve(handler, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    latencies = []
+
+    async def client():
+        async with websockets.connect(f"ws://127.0.0.1:{port}") as websocket:
+            for _ in range(event_count):
+                message = json.loads(await websocket.recv())
+                latencies.append(time.perf_counter() - message["data"]["sent"])
+
+    clients = [asyncio.create_task(client()) for _ in range(client_count)]
+    await connected.wait()
+
+    publish_times = []
+    for i in range(event_count):
+        start = time.perf_counter()
+        broadcaster.publish("submit-log", {"type": "INFO", "message": f"line {i}", "sent": start})
+        publish_times.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+
+    await asyncio.gather(*clients)
+    server.close()
+    await server.wait_closed()
+
+    latencies.sort()
+    print(f"{client_count:>4} clients: "
+          f"publish {statistics.mean(publish_times) * 1e6:8.1f} us | "
+          f"delivery p50 {latencies[len(latencies) // 2] * 1e3:7.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:7.2f} ms, "
+          f"max {latencies[-1] * 1e3:7.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between events")
+    args = parser.parse_args()
+    for client_count in args.clients:
+        await run(client_count, args.events, args.interval)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
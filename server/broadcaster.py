@@ -0,0 +1,224 @@
+import asyncio
+import collections
+import json
+import time
+
+import websockets
+
+from log_setup import get_logger
+from wire_protocol import DeltaEncoder, encode_frame, pack_event, snapshot_frame
+
+logger = get_logger("ws")
+
+# High-rate events: when a client's queue is full, the oldest of these is dropped first
+DROPPABLE_EVENTS = {"submit-log"}
+# Events where only the latest value matters: a queued one is replaced instead of queued twice
+# (not coin-update: each one carries the amount of its own coin)
+COALESCED_EVENTS = {"exchange-update", "readiness"}
+
+
+class ClientChannel:
+    """One connected client: a bounded queue of encoded messages and the task that writes them."""
+
+    def __init__(self, websocket, max_queue, send_timeout, delivery_histogram=None, protocol="json", encoding="json"):
+        self.websocket = websocket
+        self.protocol = protocol  # "json" (a message per event) or "compact" (wire_protocol frames)
+        self.encoding = encoding  # Of the compact frames: "json" or "msgpack"
+        self.delivery_histogram = delivery_histogram
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.queue = collections.deque()  # (event, message, time queued) tuples
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._write())
+
+    def enqueue(self, event, message):
+        """Queues an encoded message. Returns False if the client cannot keep up and should be dropped."""
+        if event in COALESCED_EVENTS:
+            for i, (queued_event, _, queued_at) in enumerate(self.queue):
+                if queued_event == event:
+                    self.queue[i] = (event, message, queued_at)
+                    return True
+
+        if len(self.queue) >= self.max_queue and not self._drop_oldest():
+            return False
+
+        self.queue.append((event, message, time.monotonic()))
+        self._wakeup.set()
+        return True
+
+    def _drop_oldest(self):
+        for i, (queued_event, _, _) in enumerate(self.queue):
+            if queued_event in DROPPABLE_EVENTS:
+                del self.queue[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _write(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue:
+                _, message, queued_at = self.queue.popleft()
+                try:
+                    await asyncio.wait_for(self.websocket.send(message), self.send_timeout)
+                    if self.delivery_histogram is not None:
+                        self.delivery_histogram.observe(time.monotonic() - queued_at)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Client did not read a message within {self.send_timeout}s, disconnecting")
+                    await self._close_websocket()
+                    return
+                except websockets.exceptions.ConnectionClosed:
+                    return
+
+    async def close(self):
+        self.task.cancel()
+        await self._close_websocket()
+
+    async def _close_websocket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(), self.send_timeout)
+        except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+            pass
+
+
+class Broadcaster:
+    """
+    Fans events out to all connected WebSocket clients.
+
+    Each event is encoded once and put on every client's own bounded queue; a writer task per
+    client sends it. A slow client only delays itself: high-rate events are dropped from its
+    queue first, and it is disconnected if it cannot take a message within `send_timeout`.
+
+    Published events carry an increasing "seq". The last `history_size` encoded events are
+    kept, so a client that reconnects with the epoch and seq it last saw can be sent only what
+    it missed. The epoch changes on every server start, so sequence numbers never get mixed up.
+
+    Clients on the compact protocol (see wire_protocol.py) get frames of state patches and
+    packed events instead, at most one per `tick` seconds: an event after a quiet tick is sent
+    on the next loop iteration, the events of a burst are collected until the tick is over.
+    Each frame is built once and encoded once per encoding; the last `history_size` are kept.
+    """
+
+    def __init__(self, max_queue=64, send_timeout=5, history_size=256, delivery_histogram=None, tick=0.05):
+        """
+        :param max_queue: Messages queued per client before its high-rate events are dropped.
+        :param send_timeout: Seconds a client may take to accept one message before it is disconnected.
+        :param history_size: Published events kept for clients that reconnect.
+        :param delivery_histogram: Optional metrics.Histogram of seconds from publish to sent, per client.
+        :param tick: Seconds between frames to compact clients, at least.
+        """
+        self.delivery_histogram = delivery_histogram
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.clients = {}  # websocket -> ClientChannel
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        self.history = collections.deque(maxlen=history_size)  # (seq, event, message)
+        self.tick = tick
+        self.delta = DeltaEncoder()
+        self.frames = collections.deque(maxlen=history_size)  # (first seq, last seq, frame or None if empty)
+        self._pending = []  # (seq, event, data) published since the last frame
+        self._flush_handle = None
+        self._flushed_at = None  # Loop time of the last frame
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add(self, websocket, protocol="json", encoding="json"):
+        channel = ClientChannel(websocket, self.max_queue, self.send_timeout, self.delivery_histogram,
+                                protocol, encoding)
+        self.clients[websocket] = channel
+        return channel
+
+    def remove(self, websocket):
+        channel = self.clients.pop(websocket, None)
+        if channel is not None:
+            channel.task.cancel()
+
+    @staticmethod
+    def encode(event, data, seq=None):
+        return json.dumps({"event": event, "data": data, "seq": seq})
+
+    def publish(self, event, data):
+        """Encodes the event once and queues it for every client. Never waits on a client."""
+        self.seq += 1
+        message = self.encode(event, data, self.seq)
+        self.history.append((self.seq, event, message))
+        self._pending.append((self.seq, event, data))
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            wait = 0 if self._flushed_at is None else self._flushed_at + self.tick - loop.time()
+            self._flush_handle = loop.call_later(wait, self._flush) if wait > 0 else loop.call_soon(self._flush)
+        for websocket, channel in list(self.clients.items()):
+            if channel.protocol == "json" and not channel.enqueue(event, message):
+                self._drop(websocket, channel)
+        return message
+
+    def _flush(self):
+        """Sends the events of the last tick to the compact clients as one frame."""
+        self._flush_handle = None
+        self._flushed_at = asyncio.get_running_loop().time()
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        ops = self.delta.ops([(event, data) for _, event, data in pending])
+        frame = {"v": pending[-1][0], "o": ops} if ops else None
+        self.frames.append((pending[0][0], pending[-1][0], frame))
+        if frame is None:
+            return  # Nothing changed, e.g. an exchange-update with the same prices
+        encoded = {}  # encoding -> frame
+        for websocket, channel in list(self.clients.items()):
+            if channel.protocol != "compact":
+                continue
+            if channel.encoding not in encoded:
+                encoded[channel.encoding] = encode_frame(frame, channel.encoding)
+            if not channel.enqueue("frame", encoded[channel.encoding]):
+                self._drop(websocket, channel)
+
+    def _drop(self, websocket, channel):
+        logger.warning("Client send queue is full, disconnecting")
+        self.remove(websocket)
+        asyncio.create_task(channel.close())
+
+    def send_to(self, websocket, event, data):
+        """Queues an event for a single client, tagged with the current seq."""
+        channel = self.clients.get(websocket)
+        if channel is None:
+            return
+        if channel.protocol == "compact":
+            frame = (snapshot_frame(self.seq, data) if event == "state-snapshot"
+                     else {"v": self.seq, "o": [pack_event(event, data)]})
+            channel.enqueue(event, encode_frame(frame, channel.encoding))
+        else:
+            channel.enqueue(event, self.encode(event, data, self.seq))
+
+    def resume(self, websocket, epoch, seq):
+        """
+        Queues the events a reconnecting client missed since (epoch, seq).
+
+        :return: False if they are no longer in the history (or from another server run),
+                 in which case the client needs a full snapshot instead.
+        """
+        channel = self.clients.get(websocket)
+        if channel is None or epoch != self.epoch or seq > self.seq:
+            return False
+        if channel.protocol == "compact":
+            return self._resume_frames(channel, seq)
+        missed = [entry for entry in self.history if entry[0] > seq]
+        if seq < self.seq and (not missed or missed[0][0] != seq + 1):
+            return False
+        for _, event, message in missed:
+            channel.enqueue(event, message)
+        return True
+
+    def _resume_frames(self, channel, seq):
+        missed = [entry for entry in self.frames if entry[1] > seq]
+        first_missed = missed[0][0] if missed else (self._pending[0][0] if self._pending else self.seq + 1)
+        if seq < self.seq and first_missed > seq + 1:
+            return False
+        for _, _, frame in missed:
+            if frame is not None:
+                channel.enqueue("frame", encode_frame(frame, channel.encoding))
+        return True  # Events of the current tick come with the next frame
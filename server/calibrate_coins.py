@@ -0,0 +1,72 @@
+"""
+Calibrates the coin pulse thresholds for this coin acceptor and saves them for the server.
+
+    python3 calibrate_coins.py [--seconds 120] [--output coin_calibration.json]
+    python3 calibrate_coins.py --trace coins.trace [...]
+
+Without --trace, records COIN_PIN while coins are inserted (stop the server first, it holds
+the pin); insert each coin type several times. Traces from pulse_benchmark.py record can be
+used instead. Labelled traces are also replayed with the old and new thresholds.
+"""
+import argparse
+import time
+
+from coin_calibration import PulseCalibration, PulseTimings, calibrate
+from coin_decoder import CoinPulseDecoder
+from gpio_backend import open_gpio_backend
+from pulse_benchmark import COIN_PIN, SIGNAL_MAX_DURATION, SIGNAL_MIN_DURATION, TIME_WINDOW
+from pulse_trace import PulseTrace, PulseTraceRecorder, replay, score
+
+MIN_CONFIDENCE = 0.8  # Same as click-socket.py
+
+
+def record_trace(pin, seconds):
+    gpio = open_gpio_backend()
+    recorder = PulseTraceRecorder()
+    recorder.attach(gpio, pin)
+    print(f"Recording GPIO {pin} for {seconds} seconds: insert each coin type several times (Ctrl-C to stop early)...")
+    try:
+        time.sleep(seconds)
+    except KeyboardInterrupt:
+        pass
+    gpio.close()
+    return recorder.trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", nargs="+", help="pulse trace files to calibrate from instead of recording")
+    parser.add_argument("--pin", type=int, default=COIN_PIN)
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--output", default="coin_calibration.json")
+    args = parser.parse_args()
+
+    traces = [PulseTrace.load(path) for path in args.trace] if args.trace else [record_trace(args.pin, args.seconds)]
+    timings = PulseTimings(size=max(4096, sum(len(trace) for trace in traces)))
+    for trace in traces:
+        timings.add_edges(trace.levels, trace.ticks)
+
+    calibration = calibrate(timings.widths(), timings.gaps())
+    if calibration is None:
+        print("No pulses recorded")
+        return
+    print(f"Pulse width {calibration.width_ms} ms, gap {calibration.gap_ms} ms -> {calibration}")
+
+    default = PulseCalibration(SIGNAL_MIN_DURATION, SIGNAL_MAX_DURATION, TIME_WINDOW)
+    for trace in traces:
+        if len(trace.coin_counts):
+            for name, thresholds in (("default", default), ("calibrated", calibration)):
+                decoder = CoinPulseDecoder()
+                thresholds.apply(decoder)
+                stats = score(trace, replay(trace, decoder))
+                print(f"  {name:10} thresholds: {stats['correct']}/{stats['coins']} labelled coins decoded correctly")
+
+    if calibration.confidence < MIN_CONFIDENCE:
+        print(f"Confidence below {MIN_CONFIDENCE}, not saved: record more coins, or check the wiring")
+        return
+    calibration.save(args.output)
+    print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
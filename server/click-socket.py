@@ -1,97 +1,229 @@
-import lgpio
+import time
+startup_began = time.monotonic()  # Import time and time to the first websocket frame are measured from here
 import asyncio
+import threading
 import websockets
-import time
 import json
-from fetcher import DataFetcher
-from code_reader import scan_qr_code
-import subprocess
+import urllib.parse
+import uuid
+import hmac
+import os
+from fetcher import PriceFeed, PriceOracle, PriceSource
+from code_reader import open_code_reader
+from kaspa_address import address_from_qr, is_valid_kaspa_address
+from gpio_backend import open_gpio_backend
+from coin_decoder import CoinPulseDecoder, CoinEdgeListener
+from payout_backend import open_payout_backend
+from payout_batcher import PayoutBatcher
+from payout_outbox import PayoutOutbox
+from payout_tracker import PayoutTracker
+from readiness import Readiness
+from kiosk import DEFAULT_KIOSK_ID, Kiosk
+from screen_machine import COIN, PAYOUT_OUTCOME, SCAN_RESULT, SCREEN_TIMEOUTS, ScreenMachine
+from session_journal import SessionJournal
+from history_store import HistoryStore
+from history_api import serve_history
+from metrics import MetricsRegistry, measure_loop_lag, serve_metrics
+from loop_watchdog import LoopWatchdog, SamplingProfiler
+from wire_protocol import negotiate
+from log_setup import TraceBuffer, get_logger, setup_logging
 import logging
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
-
-SIMPLE_TRANSACTION_JS = "/home/alauden/projects/rusty-kaspa/wasm/examples/nodejs/javascript/transactions/simple-transaction.js"
-#SIMPLE_TRANSACTION_JS = "/home/alauden/projects/change-o-matic/server/mock-transaction.js"
-MONITOR_JS = "/home/alauden/projects/rusty-kaspa/wasm/examples/nodejs/javascript/transactions/monitor-tx.js"
-
-
-# Fetch Kaspa price every 10 minutes
-kaspa_fetcher = DataFetcher(
-    name="Kaspa",
-    url="https://api.kaspa.org/info/price?stringOnly=false",
-    key="price",
-    interval_minutes=10
-)
-
-# Fetch USD to AUD exchange rate every 15 minutes
-usd_aud_fetcher = DataFetcher(
-    name="USD/AUD",
-    url="https://api.exchangerate-api.com/v4/latest/USD",
-    key="rates",
-    sub_key="AUD",
-    interval_minutes=15
-)
-
-# Start fetching data in background threads
-kaspa_fetcher.start()
-usd_aud_fetcher.start()
-
-BUTTON_PIN = 17     # GPIO pin for button
-COIN_PIN = 22       # GPIO pin for coin signal (digital input)
-chip = lgpio.gpiochip_open(0)
-
-# Claim GPIO pins
-lgpio.gpio_claim_input(chip, BUTTON_PIN)
-lgpio.gpio_claim_input(chip, COIN_PIN)
-
-# Initialize main button state variables
-LAST_PRESS_TIME = 0
-DEBOUNCE_INTERVAL = 0.09
-BUTTON_RELEASED = True
-HOLD_TO_RESET_INTERVAL = 4
-PRESS_THEN_RELEASE_HANDLED = True
 
 #Log file settings
 LOG_FILE = "change-o-matic.log"
 MAX_FILE_SIZE = 1 * 1024 * 1024  # 1MB
 BACKUP_COUNT = 20  # Keep up to 20 log files
-logger = logging.getLogger("MyLogger")
-logger.setLevel(logging.DEBUG)  # Set log level
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=MAX_FILE_SIZE, backupCount=BACKUP_COUNT, encoding="utf-8")
-class CustomFormatter(logging.Formatter):
-    def format(self, record):
-        record.asctime = self.formatTime(record, "%Y-%m-%d %H:%M:%S.%f")[:-3]  # Trim to milliseconds
-        return f"[{record.asctime}] [{record.levelname}] {record.getMessage()}"
-formatter = CustomFormatter("[%(asctime)s] %(message)s")
-file_handler.setFormatter(formatter)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
-
-# Store connected WebSocket clients
-connected_clients = set()
-
-# Store shared data (money, address)
+# JSON lines written by a background thread; per-subsystem levels via CHANGEOMATIC_LOG_LEVELS="gpio=DEBUG,ws=WARNING"
+log_listener = setup_logging(LOG_FILE, MAX_FILE_SIZE, BACKUP_COUNT)
+logger = get_logger()
+gpio_logger = get_logger("gpio")
+ws_logger = get_logger("ws")
+payout_logger = get_logger("payout")
+price_logger = get_logger("price")
+qr_logger = get_logger("qr")
+
+TRANSACTION_WORKER_JS = "/home/alauden/projects/rusty-kaspa/wasm/examples/nodejs/javascript/transactions/transaction-worker.js"
+#TRANSACTION_WORKER_JS = "/home/alauden/projects/change-o-matic/server/mock-transaction-worker.js"
+# What sends the payouts: CHANGEOMATIC_PAYOUT="node" (the Node worker above, the default), "grpc"
+# (from this process, over the gRPC interface of the nodes below, with failover) or "mock"
+KASPA_NETWORK = "mainnet"
+GRPC_NODES = ["127.0.0.1:16110"]  # In order of preference
+GRPC_FEE_RATE = 1.0  # Sompi per gram of mass; the gRPC interface has no fee estimate
+
+
+# Kaspa price (USD) every 10 minutes, from several sources
+kaspa_feed = PriceFeed("Kaspa", [
+    PriceSource("api.kaspa.org", "https://api.kaspa.org/info/price?stringOnly=false", ["price"]),
+    PriceSource("CoinGecko", "https://api.coingecko.com/api/v3/simple/price?ids=kaspa&vs_currencies=usd", ["kaspa", "usd"]),
+    PriceSource("CoinPaprika", "https://api.coinpaprika.com/v1/tickers/kas-kaspa", ["quotes", "USD", "price"]),
+], interval_minutes=10)
+
+# USD to AUD exchange rate every 15 minutes
+usd_aud_feed = PriceFeed("USD/AUD", [
+    PriceSource("exchangerate-api.com", "https://api.exchangerate-api.com/v4/latest/USD", ["rates", "AUD"]),
+    PriceSource("open.er-api.com", "https://open.er-api.com/v6/latest/USD", ["rates", "AUD"]),
+    PriceSource("frankfurter.app", "https://api.frankfurter.app/latest?from=USD&to=AUD", ["rates", "AUD"]),
+], interval_minutes=15, ttl_minutes=24 * 60)
+
+# Fetched on the event loop once main() starts it; last known good values come from the cache file
+price_oracle = PriceOracle([kaspa_feed, usd_aud_feed], cache_file="price_cache.json")
+price_oracle.load_cache()
+
+# Startup state of every subsystem: the websocket is bound first, then the kiosk hardware, the price
+# feeds and the payout worker come up concurrently, and clients are told what is still starting
+def on_readiness_change(readiness):
+    asyncio.create_task(send_message(None, "readiness", readiness.to_dict()))
+
+readiness = Readiness(started=startup_began, on_change=on_readiness_change)
+startup_seconds = {}  # stage ("import", "first-frame") -> seconds from startup_began
+
+def on_worker_state(ready, detail):
+    if ready:
+        readiness.mark_ready("payouts", detail)
+    else:
+        readiness.mark_failed("payouts", detail)
+
+# The worker keeps the hot wallet's UTXOs and the fee estimate cached between payouts. With
+# WALLET_PRESPLIT_COUNT > 0 it also keeps that many UTXOs of WALLET_PRESPLIT_AMOUNT KAS (about one
+# payout each), split off while idle, so a payout spends one input and only has to sign and submit.
+WALLET_PRESPLIT_COUNT = 0
+WALLET_PRESPLIT_AMOUNT = "25"
+WALLET_POLL_INTERVAL = 30  # Seconds between reads of the worker's wallet cache, for the metrics
+wallet_args = ([f"--presplit-count={WALLET_PRESPLIT_COUNT}", f"--presplit-amount={WALLET_PRESPLIT_AMOUNT}"]
+               if WALLET_PRESPLIT_COUNT else [])
+wallet_status = {}  # Last answer of the worker's "wallet" request
+
+# Sends the payouts (by default a long-lived Node process), started in main()
+payout_backend = open_payout_backend(on_state=on_worker_state, worker_script=TRANSACTION_WORKER_JS,
+                                     worker_args=["--encoding", "borsh", "--network", KASPA_NETWORK, *wallet_args],
+                                     grpc_nodes=GRPC_NODES, network=KASPA_NETWORK, fee_rate=GRPC_FEE_RATE)
+PAYOUT_TIMEOUT = 90  # Seconds before a payout is cancelled (if it was not submitted yet) and reported as failed
+
+# Payouts queued within PAYOUT_BATCH_WAIT seconds of each other share one multi-output transaction
+PAYOUT_BATCH_WAIT = 0.5
+PAYOUT_BATCH_MAX_OUTPUTS = 10
+payout_batcher = PayoutBatcher(payout_backend, max_wait=PAYOUT_BATCH_WAIT, max_outputs=PAYOUT_BATCH_MAX_OUTPUTS)
+
+# Every coin and payout, indexed in SQLite for reconciling the takings, and served (localhost only,
+# use 0.0.0.0 to reach it from the LAN) as a query and export API on HISTORY_PORT
+HISTORY_FILE = "history.sqlite3"
+HISTORY_HOST = "127.0.0.1"
+HISTORY_PORT = 8766
+history = HistoryStore(HISTORY_FILE)
+TRACKER_HISTORY_STATUS = {"confirmed": "confirmed", "resubmitted": "submitted", "failed": "failed"}
+OUTBOX_HISTORY_STATUS = {"sent": "confirmed", "submitted": "submitted", "held": "held"}
+
+# Follows submitted payouts the worker could not confirm in time: checks, resubmits, gives up
+def on_payout_status(status, payout):
+    history.update_payouts_by_txid(payout.txids, TRACKER_HISTORY_STATUS[status])
+    asyncio.create_task(send_message(kiosks.get(payout.kiosk), "payout-status", {
+        "status": status,
+        "amount": payout.amount,
+        "address": payout.address,
+        "txids": payout.txids
+    }))
+
+payout_tracker = PayoutTracker(payout_backend, on_status=on_payout_status)
+payout_tracker.load()
+
+# Coin machines driven by this server, each with its own pins, QR reader (I2C bus), coin calibration
+# and session journal. The UI picks one with ws://host:8765/?kiosk=<id>; without an id it gets the first.
+KIOSKS = [
+    {"id": DEFAULT_KIOSK_ID, "gpio_chip": 0, "button_pin": 17, "coin_pin": 22, "i2c_bus": 1,
+     "calibration_file": "coin_calibration.json",
+     "journal": "session_journal.jsonl", "snapshot": "session_snapshot.json"},
+]
+BUTTON_POLL_INTERVAL = 0.01  # Seconds between button reads
+DEBOUNCE_INTERVAL = 0.09
+HOLD_TO_RESET_INTERVAL = 4
+HARDWARE_RETRY_INTERVAL = 10  # Seconds between attempts to open a kiosk's GPIO chip and QR reader
+
+# Latency and throughput metrics, served as Prometheus text on METRICS_PORT (localhost only)
+# and sent every METRICS_INTERVAL seconds to websocket clients that subscribe to "metrics"
+METRICS_PORT = 9108
+METRICS_INTERVAL = 5
+metrics = MetricsRegistry()
+pulse_decode_seconds = metrics.histogram("changeomatic_pulse_decode_seconds", "Coin edge alert to decoding on the event loop")
+coin_to_ui_seconds = metrics.histogram("changeomatic_coin_to_ui_seconds", "Last coin pulse to coin-update queued for the UI")
+publish_seconds = metrics.histogram("changeomatic_ws_publish_seconds", "send_message() encode and fan-out to the client queues")
+delivery_seconds = metrics.histogram("changeomatic_ws_delivery_seconds", "Event queued to sent, per client")
+scan_seconds = metrics.histogram("changeomatic_scan_seconds", "QR scan duration", ["result"])
+payout_phase_seconds = metrics.histogram("changeomatic_payout_phase_seconds", "Duration of each payout phase reported by the worker", ["phase"])
+payout_seconds = metrics.histogram("changeomatic_payout_seconds", "Payout request to outcome", ["result"])
+loop_lag_seconds = metrics.histogram("changeomatic_loop_lag_seconds", "How late the event loop wakes up from a sleep")
+loop_lag_gauge = metrics.gauge("changeomatic_loop_lag_last_seconds", "Last measured event loop lag")
+outbox_wait_seconds = metrics.histogram("changeomatic_outbox_wait_seconds", "Payout stored in the outbox to sent")
+price_age_gauge = metrics.gauge(
+    "changeomatic_price_age_seconds", "Seconds since the feed's last successful fetch", ["feed"],
+    func=lambda: {(feed.name,): time.time() - feed.last_fetched if feed.last_fetched else None
+                  for feed in (kaspa_feed, usd_aud_feed)})
+loop_stall_seconds = metrics.histogram("changeomatic_loop_stall_seconds", "Event loop blocked longer than LOOP_STALL_THRESHOLD")
+metrics_subscribers = {}  # websocket -> Kiosk
+
+# Watchdog for the event loop: a stall longer than LOOP_STALL_THRESHOLD seconds (long enough to lose
+# coin pulses) is logged with the stack of what blocked it. LOOP_SLOW_CALLBACKS also turns on asyncio's
+# debug mode, which logs every callback slower than the threshold (slows the loop down, for diagnosis only)
+LOOP_STALL_THRESHOLD = 0.1
+LOOP_SLOW_CALLBACKS = False
+loop_watchdog = LoopWatchdog(threshold=LOOP_STALL_THRESHOLD, stall_histogram=loop_stall_seconds,
+                             slow_callbacks=LOOP_SLOW_CALLBACKS)
+
+# Admin commands (e.g. the sampling profiler) are taken from clients connected with
+# ws://host:8765/?admin=<CHANGEOMATIC_ADMIN_TOKEN>; without the variable there is no admin
+ADMIN_TOKEN = os.environ.get("CHANGEOMATIC_ADMIN_TOKEN")
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_MAX_SECONDS = 300
+loop_profiler = SamplingProfiler(threading.get_ident(), interval=PROFILE_INTERVAL)  # main() runs the loop on this thread
+
+# Payouts the node could not take (unreachable or not synced) are kept here with their locked quote,
+# the customer gets a receipt, and the outbox sends them once the node is back
+def on_outbox_status(status, payout):
+    history.update_payout(payout.key, OUTBOX_HISTORY_STATUS[status], payout.txid)
+    asyncio.create_task(send_message(kiosks.get(payout.kiosk), "payout-status", {
+        "status": status,
+        "amount": payout.amount,
+        "address": payout.address,
+        "reference": payout.key[:8]
+    }))
+
+payout_outbox = PayoutOutbox(payout_batcher, payout_tracker, wait_histogram=outbox_wait_seconds,
+                             on_status=on_outbox_status)
+payout_outbox.load()
+outbox_size_gauge = metrics.gauge("changeomatic_outbox_payouts", "Payouts waiting in the outbox",
+                                  func=lambda: {(): len(payout_outbox)})
+outbox_age_gauge = metrics.gauge("changeomatic_outbox_oldest_seconds", "Age of the oldest payout waiting in the outbox",
+                                 func=lambda: {(): payout_outbox.oldest_age})
+startup_gauge = metrics.gauge(
+    "changeomatic_startup_seconds", "Seconds from process start to each startup stage and subsystem readiness", ["stage"],
+    func=lambda: {(stage,): seconds for stage, seconds in {**startup_seconds, **readiness.seconds}.items()})
+subsystem_ready_gauge = metrics.gauge(
+    "changeomatic_subsystem_ready", "1 once the subsystem is ready, 0 while it is starting or failed", ["subsystem"],
+    func=lambda: {(subsystem,): 1 if readiness.is_ready(subsystem) else 0 for subsystem in readiness.states})
+wallet_utxos_gauge = metrics.gauge(
+    "changeomatic_wallet_utxos", "UTXOs in the worker's wallet cache", ["kind"],
+    func=lambda: {(kind,): wallet_status.get(kind) for kind in ("utxos", "presplit", "reserved")})
+wallet_balance_gauge = metrics.gauge("changeomatic_wallet_balance_kas", "Spendable hot wallet balance in the worker's cache",
+                                     func=lambda: {(): float(wallet_status["balance"]) if "balance" in wallet_status else None})
+fee_rate_gauge = metrics.gauge("changeomatic_fee_rate", "Cached fee estimate of the node (sompi per gram)",
+                               func=lambda: {(): wallet_status.get("fee_rate")})
+wallet_cache_age_gauge = metrics.gauge("changeomatic_wallet_cache_age_seconds", "Age of the worker's cached UTXOs",
+                                       func=lambda: {(): wallet_status.get("utxo_age")})
+node_online_gauge = metrics.gauge("changeomatic_payouts_online", "1 while payouts are sent right away, 0 while they go to the outbox",
+                                  func=lambda: {(): 1 if payout_outbox.online else 0})
+
+# Kaspa price and exchange rate, shared by all kiosks
 shared_data = {
-    "collected_amount": 0,  # Tracks the total amount collected
-    "recipient_address": "",
-    "kaspa_price": 100000,
-    "usd_to_aud": 1
+    "kaspa_price": kaspa_feed.get_data() or 100000,
+    "usd_to_aud": usd_aud_feed.get_data() or 1
 }
 
-#Coin detector variables
-signal_count = 0
-measuring = False
-start_time = None
-prev_time_high = None
-prev_time_low = None
-prev_state = 1  # Assuming idle state is HIGH
-
-# Timing thresholds (in milliseconds)
+# Timing thresholds (in milliseconds), used until calibrate_coins.py has measured this coin acceptor
 SIGNAL_MIN_DURATION = 22
 SIGNAL_MAX_DURATION = 38
 TIME_WINDOW = 200  # Time window to count signals (in milliseconds)
+COIN_CALIBRATION_FILE = "coin_calibration.json"
+MIN_CALIBRATION_CONFIDENCE = 0.8
+ONLINE_CALIBRATION = True  # Keep adjusting the thresholds to slow drift (e.g. as the acceptor warms up)
 
 signals_to_amount = {
     1: 1.00,
@@ -101,374 +233,570 @@ signals_to_amount = {
     5: 0.03
 }
 
+gpio_backends = {}  # chip number -> GPIO backend, shared by the kiosks wired to the same chip
+gpio_backends_lock = threading.Lock()  # The kiosks' hardware is opened on executor threads
+
+def create_kiosk(config):
+    """Recovers a kiosk's session from its journal. Its hardware is opened later, by start_kiosk()."""
+    kiosk = Kiosk(
+        config["id"],
+        SessionJournal(config.get("journal", f"session_journal.{config['id']}.jsonl"),
+                       config.get("snapshot", f"session_snapshot.{config['id']}.json")),
+        button_pin=config["button_pin"], coin_pin=config["coin_pin"],
+        calibration_file=config.get("calibration_file", COIN_CALIBRATION_FILE), delivery_histogram=delivery_seconds)
+    kiosk.recover()
+    kiosk.machine = ScreenMachine(kiosk, kiosk.screen, actions=screen_actions, guards=screen_guards,
+                                  on_screen=send_current_screen, trace=TraceBuffer(logger, sample_every=1))
+    readiness.register(f"hardware:{kiosk.id}")
+    return kiosk
+
+def open_kiosk_hardware(kiosk, config):
+    """Opens the kiosk's GPIO chip and QR reader and loads its coin calibration. Blocking, runs on an executor thread."""
+    from coin_calibration import PulseCalibration  # Loads numpy, which is not needed before the hardware is up
+
+    chip = config.get("gpio_chip", 0)
+    with gpio_backends_lock:
+        if chip not in gpio_backends:
+            gpio_backends[chip] = open_gpio_backend(chip_number=chip)  # lgpio on the Pi, CHANGEOMATIC_GPIO=sim for a simulated board
+    decoder = CoinPulseDecoder(SIGNAL_MIN_DURATION, SIGNAL_MAX_DURATION, TIME_WINDOW)
+    calibration = PulseCalibration.load(kiosk.calibration_file)
+    if calibration is not None and calibration.confidence >= MIN_CALIBRATION_CONFIDENCE:
+        calibration.apply(decoder)
+        gpio_logger.info(f"[{kiosk.id}] Loaded coin calibration: {calibration}")
+    else:
+        calibration = PulseCalibration(SIGNAL_MIN_DURATION, SIGNAL_MAX_DURATION, TIME_WINDOW)
+    kiosk.attach_hardware(gpio_backends[chip], open_code_reader(config.get("i2c_bus", 1)), decoder, calibration)
 
-# Current screen tracking
-current_screen = "welcome"  # Initial screen type
-
-# Logic for transitioning to the next screen (when all is normal)
-def get_next_screen(current_screen):
-    screen_order = [
-        "welcome", "wallet", "insert-coin", "confirm-amount", "scan-wallet", "error-page", "scan-wallet", "processing"
-    ]
-    current_index = screen_order.index(current_screen)
-    next_index = (current_index + 1) % len(screen_order)
-    return screen_order[next_index]
-
-# Button reading logic with debounce
-def read_button():
-    global LAST_PRESS_TIME, BUTTON_RELEASED, PRESS_THEN_RELEASE_HANDLED, current_screen
-    try:
-        current_state = lgpio.gpio_read(chip, BUTTON_PIN) == 1  # Button pressed if HIGH
-        if current_state and BUTTON_RELEASED and (time.time() - LAST_PRESS_TIME > DEBOUNCE_INTERVAL):
-            LAST_PRESS_TIME = time.time()
-            BUTTON_RELEASED = False  # Mark button as pressed
-            PRESS_THEN_RELEASE_HANDLED = False
-            return True
-        elif not current_state:
-            if not PRESS_THEN_RELEASE_HANDLED and (time.time() - LAST_PRESS_TIME > HOLD_TO_RESET_INTERVAL):
-                shared_data['recipient_address'] = ""
-                current_screen = "processing"  # which will be immediately advanced back to "welcome"
-                PRESS_THEN_RELEASE_HANDLED = True
-                logger.info("hold button detected for interval of:" + str(time.time() - LAST_PRESS_TIME))
-                return True
-            BUTTON_RELEASED = True  # Move this after checking the hold condition
-            LAST_PRESS_TIME = time.time()  # Reset LAST_PRESS_TIME on release
-        return False
-    except Exception as e:
-        logger.info(f"GPIO Error: {e}")
-        return False
-
-
-async def read_coin_selector():
-    global measuring, start_time, signal_count, prev_time_low, prev_state
-    state = lgpio.gpio_read(chip, COIN_PIN)
-    current_time = time.time() * 1000  # Convert to milliseconds
-
-    if state == 0 and prev_state == 1:  # Falling edge (LOW detected)
-        prev_time_low = current_time  # Record when LOW starts
-
-    if state == 1 and prev_state == 0:  # Rising edge (HIGH detected)
-        if prev_time_low is not None:
-            signal_duration = current_time - prev_time_low
-
-            # Check if it's a valid signal
-            if SIGNAL_MIN_DURATION <= signal_duration <= SIGNAL_MAX_DURATION:
-                if not measuring:
-                    measuring = True
-                    start_time = current_time  # Start the 350ms time window
-                    signal_count = 1  # First signal detected
-                    logger.info(f"Detecting first signal")
-                else:
-                    signal_count += 1  # Count additional valid signals
-                    logger.info(f"Detected {signal_count} signals")
-
-            prev_time_high = current_time  # Save the HIGH time
-
-    # Check if 350ms have passed since the first valid signal
-    if measuring and (current_time - start_time >= TIME_WINDOW):
-        await handle_coin_received(signals_to_amount.get(signal_count))
-        measuring = False  # Reset measurement
-        signal_count = 0  # Reset signal count
-
-    prev_state = state  # Update previous state
-
-# Example screen handlers with custom logic
-async def handle_insert_coin():
-    # automatically add money for testing here below
-    # asyncio.create_task(handle_coin_received(0.01))
-    return "confirm-amount"
-
-async def handle_coin_received(amount):
-    logger.info(f"Detected {signal_count} signals within {TIME_WINDOW}ms")
-    global shared_data
-    shared_data["collected_amount"] += amount
-    logger.info(f"1. Coin received: {amount} AUD. Total: {shared_data['collected_amount']} AUD.")
-    await send_message("coin-update", {
+async def start_kiosk(kiosk, config):
+    """Brings up the kiosk's hardware (retrying until it opens), then listens to its button and coin acceptor."""
+    subsystem = f"hardware:{kiosk.id}"
+    while True:
+        try:
+            await asyncio.to_thread(open_kiosk_hardware, kiosk, config)
+            break
+        except Exception as e:  # lgpio raises its own error type
+            gpio_logger.error(f"[{kiosk.id}] Could not open the kiosk hardware, retrying in {HARDWARE_RETRY_INTERVAL} s: {e}")
+            readiness.mark_failed(subsystem, str(e))
+            await asyncio.sleep(HARDWARE_RETRY_INTERVAL)
+    readiness.mark_ready(subsystem)
+    await asyncio.gather(button_listener(kiosk), coin_listener(kiosk))
+
+async def coin_listener(kiosk):
+    """Turns the kiosk's coin acceptor edge alerts into coin events for its screen machine."""
+    # Recent coin edges, only written to the log when a coin is not recognised (or every edge with gpio=DEBUG)
+    coin_trace = TraceBuffer(gpio_logger, sample_every=1 if gpio_logger.isEnabledFor(logging.DEBUG) else 0)
+    calibrator = None
+    if ONLINE_CALIBRATION:
+        from coin_calibration import OnlineCalibrator
+
+        def save_calibration(calibration):
+            asyncio.get_running_loop().run_in_executor(None, calibration.save, kiosk.calibration_file)
+
+        calibrator = OnlineCalibrator(kiosk.decoder, kiosk.calibration, min_confidence=MIN_CALIBRATION_CONFIDENCE,
+                                      on_update=save_calibration)
+    listener = CoinEdgeListener(kiosk.decoder, trace=coin_trace, delay_histogram=pulse_decode_seconds,
+                                calibrator=calibrator)
+    listener.attach(kiosk.gpio, kiosk.coin_pin)
+    async for signal_count in listener.coins():
+        gpio_logger.info(f"[{kiosk.id}] Detected {signal_count} signals within {kiosk.decoder.time_window_ms}ms")
+        amount = signals_to_amount.get(signal_count)
+        if amount is None:
+            coin_trace.dump(f"[{kiosk.id}] Ignoring unknown coin signal count: {signal_count}")
+            continue
+        kiosk.machine.post(COIN, amount=amount, edge_received=listener.last_edge_received)
+
+
+# Screen machine actions: called by the kiosk's ScreenMachine, one event at a time. They must not block;
+# scans and payouts run as tasks that post their result back as an event.
+
+async def add_coin(kiosk, event):
+    amount = event.data["amount"]
+    kiosk.journal.append("coin-received", amount=amount)
+    history.record_coin(kiosk.id, amount)
+    kiosk.collected_amount += amount
+    logger.info(f"[{kiosk.id}] 1. Coin received: {amount} AUD. Total: {kiosk.collected_amount} AUD.")
+    await send_message(kiosk, "coin-update", {
         "amount": amount,
-        "total_collected": shared_data["collected_amount"]
+        "total_collected": kiosk.collected_amount
     })
+    if event.data.get("edge_received"):
+        coin_to_ui_seconds.observe((time.monotonic_ns() - event.data["edge_received"]) / 1e9)
+
+async def start_scan(kiosk, event):
+    logger.info(f"[{kiosk.id}] 2. After Confirming amount: {kiosk.collected_amount} AUD")
+    await send_message(kiosk, "clear-error-logs", {})
+    kiosk.cancel_scan()
+    kiosk.scan_task = asyncio.create_task(scan_for_address(kiosk))  # Runs until it finds an address or is cancelled
+
+async def scan_for_address(kiosk):
+    # Codes that are not a valid mainnet address are skipped by the reader, which keeps scanning;
+    # the scan-wallet screen's timeout ends the scan
+    scan_start = time.monotonic()
+    result = await kiosk.code_reader.scan(timeout=None, accept=is_scanned_address_valid, on_reject=log_rejected_scan)
+    scan_seconds.observe(time.monotonic() - scan_start, "found")
+    kiosk.machine.post(SCAN_RESULT, address=address_from_qr(result).lower())
+
+def cancel_scan(kiosk, event):
+    kiosk.cancel_scan()
+
+def scan_timeout(kiosk, event):
+    kiosk.cancel_scan()
+    scan_seconds.observe(SCREEN_TIMEOUTS["scan-wallet"], "timeout")
+    logger.info(f"[{kiosk.id}] Failed to transmit due to general qr-code reading error, most likely - timeout.")
+    return "Ehhm...Something went wrong reading your QR-Code. /nTake your time, and hit the button to give it another try"
+
+def is_payout_in_flight(kiosk, event):
+    return kiosk.payout_task is not None
+
+def payout_busy(kiosk, event):
+    logger.info(f"[{kiosk.id}] Scanned an address while the previous payout is still being sent")
+    return "Hold on, your previous transaction is still on its way. /nHit the button to scan again in a moment"
+
+def has_no_money(kiosk, event):
+    return kiosk.collected_amount <= 0
+
+def record_address(kiosk, address):
+    logger.info(f"[{kiosk.id}] 3. QR Code Scan Successful. Address: {address}")
+    kiosk.recipient_address = address
+    kiosk.journal.append("address-scanned", address=address)
+
+def no_money(kiosk, event):
+    record_address(kiosk, event.data["address"])
+    logger.info(f"[{kiosk.id}] Failed to transmit due to missing amount: {kiosk.collected_amount}")
+    return f"${kiosk.collected_amount:.2f}... Well, that's not much, /nbut you can add coins at any time, /nhow about now? "
+
+def start_payout(kiosk, event):
+    record_address(kiosk, event.data["address"])
+    kiosk.payout_amount = kiosk.collected_amount  # Coins inserted while it runs stay credited
+    logger.info(f"[{kiosk.id}] 4. Requesting transaction..")
+    kiosk.payout_task = asyncio.create_task(pay_out(kiosk))
+
+async def pay_out(kiosk):
+    try:
+        outcome = await run_kaspa_transaction(kiosk)
+    except Exception:
+        payout_logger.exception(f"[{kiosk.id}] Payout failed")
+        outcome = "failed"
+    kiosk.machine.post(PAYOUT_OUTCOME, outcome=outcome)
+
+def is_payout_queued(kiosk, event):
+    return event.data["outcome"] == "queued"
+
+async def payout_settled(kiosk, event):
+    kiosk.payout_task = None
+    if event.data["outcome"] in ("sent", "queued"):
+        logger.info(f"[{kiosk.id}] 5. Transaction complete, resetting variables.")
+        kiosk.collected_amount = round(kiosk.collected_amount - kiosk.payout_amount, 2)
+        kiosk.recipient_address = ""
+        await send_message(kiosk, "coin-update", {
+            "amount": 0,
+            "total_collected": kiosk.collected_amount
+        })
+    kiosk.payout_amount = 0
+    logger.info(f"[{kiosk.id}] 6. After transaction completed..")
+    kiosk.press_then_release_handled = True
+
+def reset_session(kiosk, event):
+    kiosk.cancel_scan()
+    kiosk.recipient_address = ""
+    kiosk.journal.append("session-reset")
+
+screen_actions = {
+    "add-coin": add_coin,
+    "start-scan": start_scan,
+    "cancel-scan": cancel_scan,
+    "scan-timeout": scan_timeout,
+    "no-money": no_money,
+    "payout-busy": payout_busy,
+    "start-payout": start_payout,
+    "payout-settled": payout_settled,
+    "reset-session": reset_session,
+}
+screen_guards = {
+    "payout-in-flight": is_payout_in_flight,
+    "no-money": has_no_money,
+    "payout-queued": is_payout_queued,
+}
 
-async def handle_scan_user_address():
-    logger.info(f"2. After Confirming amount: {shared_data['collected_amount']} AUD")
-    async def wrapper():
-        result = await scan_qr_code(timeout=40)  # Await the QR scan result
-        await handle_scan_result(result is not None, result)
 
-    asyncio.create_task(wrapper())  # Run in the background without blocking
-    return "scan-wallet"
+def is_scanned_address_valid(code):
+    return is_valid_kaspa_address(address_from_qr(code))
 
+def log_rejected_scan(code):
+    qr_logger.info(f"Ignoring scanned code that is not a valid Kaspa address: {code!r}")
 
-async def send_current_screen(screen, notification=None):
-    global current_screen
-    current_screen = screen
-    await send_message("screen-change", {"screen": screen, "notification": notification})
 
-async def handle_scan_result(success, qr_code):
-    if current_screen != "scan-wallet":
-        logger.info("Ignoring a scan result that arrived after the user left the scan screen")
-        return
+async def send_current_screen(kiosk, screen, notification=None):
+    kiosk.set_screen(screen)
+    await send_message(kiosk, "screen-change", {"screen": screen, "notification": notification})
 
-    global PRESS_THEN_RELEASE_HANDLED
-    logger.info("3. After scan complete/failed")
+kiosk_configs = {config["id"]: config for config in KIOSKS}
+kiosks = {kiosk_id: create_kiosk(config) for kiosk_id, config in kiosk_configs.items()}
 
-    if success:
-        logger.info("QR Code Scan Successful. Address: {qr_code}")
-        shared_data["recipient_address"] = qr_code
-    else:
-        logger.info("QR Code Scan Failed. keep trying until timeout")
-        #shared_data["recipient_address"] = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8" #default value for testing
-        #return
-
-    logger.info("UI update sent.")
-    if shared_data['collected_amount'] <= 0:
-        logger.info(f"Failed to transmit due to missing amount: {shared_data['collected_amount']}")
-        await send_current_screen("error-page", f"${shared_data['collected_amount']:.2f}... Well, that's not much, /nbut you can add coins at any time, /nhow about now? ")
-    elif shared_data['recipient_address'] == "":
-        logger.info(f"Failed to transmit due to missing recipient address: { shared_data['recipient_address']}.")
-        await send_current_screen("error-page", f"The recipient address is wrong or missing. Look:  { shared_data['recipient_address']}.")
-    elif not success:
-        logger.info("Failed to transmit due to general qr-code reading error, most likely - timeout.")
-        await send_current_screen("error-page", "Ehhm...Something went wrong reading your QR-Code. /nTake your time, and hit the button to give it another try")
-    else:   # All good -  Send the Kaspa
-        await send_current_screen("processing")
-        logger.info("4. Requesting transaction..")
-        submission_result = await run_kaspa_transaction()
-        if submission_result:
-            logger.info("5. Transaction complete, resetting variables.")
-            shared_data['collected_amount']=0
-            shared_data['recipient_address']=""
-            await send_message("coin-update", {
-                "amount": 0,
-                "total_collected": 0
-            })
-        logger.info("6. After transaction completed..")
-        PRESS_THEN_RELEASE_HANDLED = True
 
+async def run_kaspa_transaction(kiosk):
 
-async def run_kaspa_transaction():
+    """
+    Sends the kiosk's payout through the payout batcher (and the transaction worker) and processes its logs in real-time.
 
-    """Runs the Node.js script and processes its logs in real-time."""
+    Returns "sent" once the payout is confirmed, "queued" if it was kept in the payout outbox
+    because the node is unreachable (or held there because it may have gone out: the worker
+    exited while sending it, or it timed out after the worker submitted it or could no longer
+    cancel it), or "failed".
+    """
 
-    amount_kaspa = str(shared_data['collected_amount'] / shared_data['usd_to_aud'] / shared_data['kaspa_price'])
-    logger.info(f"Prepare transmission... collected_amount: {shared_data['collected_amount']} "
+    amount_kaspa = str(kiosk.payout_amount / shared_data['usd_to_aud'] / shared_data['kaspa_price'])
+    payout_logger.info(f"[{kiosk.id}] Prepare transmission... collected_amount: {kiosk.payout_amount} "
        f"usd_aud: {shared_data['usd_to_aud']} "
        f"kaspa_price: {shared_data['kaspa_price']} "
-       f"to send: {str(shared_data['collected_amount'] / shared_data['usd_to_aud'] / shared_data['kaspa_price'])} Kaspa")
-
-    process = subprocess.Popen(
-        ["node", SIMPLE_TRANSACTION_JS,
-         "--encoding", "borsh", "--network", "mainnet",
-         "--address", shared_data["recipient_address"],
-                         "--amount", amount_kaspa],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
+       f"to send: {amount_kaspa} Kaspa")
+
+    # On disk before the payout is sent: after a crash, an unfinished payout must not go unnoticed
+    history_key = uuid.uuid4().hex  # Also the outbox key if the payout is queued
+    kiosk.journal.append("payout-started", amount=amount_kaspa, address=kiosk.recipient_address,
+                         collected=kiosk.payout_amount, key=history_key)
+    await kiosk.journal.sync()
+    history.record_payout(history_key, kiosk.id, kiosk.recipient_address, amount_kaspa, quote=get_quote(kiosk))
+
+    # While the node is known to be down (or a backlog is waiting), don't make the customer wait for a failure
+    if not payout_outbox.online:
+        return await queue_payout(kiosk, amount_kaspa, history_key)
 
     final_status = None
+    offline = unknown = submitted = pending = False
+    txid = None
+    payout_start = phase_start = time.monotonic()
 
     # Process real-time logs
-    while True:
-        output = process.stdout.readline()
-        if not output and process.poll() is not None:
-            break  # No more output and process has ended
-
-        output = output.strip()
-        if output:
-            try:
-                log_entry = json.loads(output)  # Expecting JSON logs
-                log_type = log_entry.get("type", "info")
-                log_message = log_entry.get("message", "")
-
-                logger.info(f"[{log_type.upper()}] {log_message}")
-                await send_message("submit-log", {
-                    "type": f"{log_type.upper()}",
-                    "message": f"{log_message}"
-                })
-
-                # Detect final success/failure state
-                if log_type == "success":
-                    final_status = True
-                    await send_message("submit-outcome", {
-                        "result": True
-                    })
-                    break
-                elif log_type == "error":
-                    final_status = False
-                    break
-
-            except json.JSONDecodeError:
-                logger.info(f"[UNKNOWN] {output}")  # Handle non-JSON outputs
+    async for log_entry in payout_batcher.payout(kiosk.recipient_address, amount_kaspa, timeout=PAYOUT_TIMEOUT,
+                                                 key=history_key):
+        log_type = log_entry.get("type", "info")
+        offline = offline or log_entry.get("offline") is True
+        unknown = unknown or log_entry.get("unknown") is True
+        submitted = submitted or log_entry.get("phase") == "submit"
+        txid = log_entry.get("txid") or txid
+        if log_type == "result":
+            final_status = final_status or log_entry.get("result") is True
+            continue
+        if log_type == "pending":
+            pending = True
+            payout_tracker.track(log_entry["txid"], log_entry.get("address"), log_entry.get("amount"), kiosk=kiosk.id)
+            history.update_payout(history_key, "submitted", txid)
+            continue
+
+        if log_entry.get("phase"):
+            now = time.monotonic()
+            payout_phase_seconds.observe(now - phase_start, log_entry["phase"])
+            phase_start = now
+
+        log_message = log_entry.get("message", "")
+        payout_logger.info(f"[{kiosk.id}] [{log_type.upper()}] {log_message}")
+        await send_message(kiosk, "submit-log", {
+            "type": f"{log_type.upper()}",
+            "message": f"{log_message}"
+        })
 
+        # Detect success as soon as it is logged
+        if log_type == "success" and not final_status:
+            final_status = True
+            await send_message(kiosk, "submit-outcome", {
+                "result": True
+            })
+
+    if not final_status and offline and not submitted:
+        payout_seconds.observe(time.monotonic() - payout_start, "queued")
+        payout_outbox.mark_offline()
+        return await queue_payout(kiosk, amount_kaspa, history_key)
+    if not final_status and (unknown or submitted) and not pending:
+        # Paying the customer again could pay twice: the money stays with the outbox until someone checks the wallet
+        payout_seconds.observe(time.monotonic() - payout_start, "failed")
+        return await queue_payout(kiosk, amount_kaspa, history_key, held=True, txid=txid)
+
+    payout_seconds.observe(time.monotonic() - payout_start, "success" if final_status else "failed")
+    kiosk.journal.append("payout-finished", result=bool(final_status), collected=kiosk.payout_amount)
+    if final_status or not pending:  # A pending payout's outcome comes from the payout tracker
+        history.update_payout(history_key, "confirmed" if final_status else "failed", txid)
     if not final_status:
-        await send_message("submit-outcome", {
+        await send_message(kiosk, "submit-outcome", {
         "result": False
     })
-    return final_status
-
-
-# Global variables
-signal_start_time = None  # Timestamp when the signal goes LOW
-signal_end_time = None    # Timestamp when the signal goes HIGH
-signal_count = 0          # To keep track of single or double signal
-last_signal_time = None   # To keep track of the last signal time
-
-# Constants
-SINGLE_SIGNAL_DURATION = 30 / 1000  # 40ms in seconds
-DOUBLE_SIGNAL_WINDOW = 200 / 1000  # 200ms window in seconds
-
-def coin_signal_callback(chip, gpio, level, tick):
-    global signal_start_time, signal_end_time, signal_count, last_signal_time
-
-    # Check if the signal is going LOW (falling edge)
-    if level == 0:
-        # Start of signal (LOW state)
-        signal_start_time = time.time()
-        logger.info("Signal started (LOW).")
-
-    # Check if the signal is going HIGH (rising edge)
-    elif level == 1 and signal_start_time is not None:
-        # End of signal (HIGH state)
-        signal_end_time = time.time()
-        signal_duration = signal_end_time - signal_start_time
-
-        # Check if the duration is valid (within 40ms)
-        if signal_duration >= SINGLE_SIGNAL_DURATION * 0.7:
-            logger.info(f"Signal detected, duration: {signal_duration*1000:.2f}ms")
-
-            # If no previous signal was counted
-            if signal_count == 0:
-                signal_count += 1
-                last_signal_time = signal_end_time
-                logger.info("Single signal detected!")
-
-            # If a previous signal was counted and the time difference is within 200ms, it's a double signal
-            elif signal_count == 1 and (signal_end_time - last_signal_time) <= DOUBLE_SIGNAL_WINDOW:
-                signal_count += 1
-                last_signal_time = signal_end_time
-                logger.info("Double signal detected!")
-
-            # If the signal is outside the 200ms window, reset signal count
-            if (signal_end_time - last_signal_time) > DOUBLE_SIGNAL_WINDOW:
-                logger.info(f"Signal count: {signal_count}")
-                # Reset after the time window has passed and wait for the next signal
-                signal_count = 1  # New signal detected, counting as a single
-                last_signal_time = signal_end_time
-
-    # Debugging: Print signal states (not required for final code)
-    # if signal_start_time:
-    logger.info(f"level: {level} Signal Start: {signal_start_time}, Signal End: {signal_end_time}, Signal Count: {signal_count}")
-
-# Interrupt-based coin signal handler
-# def coin_signal_callback(chip, gpio, level, tick):
-#     if gpio == COIN_PIN and level == 1:  # Rising edge detected
-#         asyncio.create_task(handle_coin_received(1))  # Assume $1 per pulse for now
-
-# GPIO listener to handle button and coin events
-async def button_listener():
-    global current_screen
+    return "sent" if final_status else "failed"
+
+
+def get_quote(kiosk):
+    """What the kiosk's payout amount is computed from."""
+    return {
+        "collected_amount": kiosk.payout_amount,
+        "kaspa_price": shared_data["kaspa_price"],
+        "usd_to_aud": shared_data["usd_to_aud"]
+    }
+
+async def queue_payout(kiosk, amount_kaspa, key, held=False, txid=None):
+    """Keeps the payout in the outbox (or holds it there), at the quote already shown, and sends the customer a receipt."""
+    payout = await payout_outbox.add(kiosk.recipient_address, amount_kaspa, quote=get_quote(kiosk), kiosk=kiosk.id,
+                                     key=key, held=held)
+    history.update_payout(key, payout.status, txid)  # A held payout's txid, if any, is where to look first
+    kiosk.journal.append("payout-queued", key=payout.key, collected=kiosk.payout_amount)
+    await send_message(kiosk, "payout-receipt", {
+        "reference": payout.key[:8],
+        "amount": amount_kaspa,
+        "address": payout.address,
+        "total_collected": kiosk.payout_amount,
+        "waiting": len(payout_outbox),
+        "held": held
+    })
+    return "queued"
+
+async def hold_interrupted_payout(kiosk):
+    """Holds the payout a crash cut short in the outbox, so it is neither paid again nor lost until the wallet is checked."""
+    payout = kiosk.interrupted_payout
+    key = payout.get("key")
+    held = next((queued for queued in payout_outbox.payouts if key is not None and queued.key == key), None)
+    if held is None:  # Unless it reached the outbox before the crash
+        held = await payout_outbox.add(payout["address"], payout["amount"], quote={"collected_amount": kiosk.payout_amount},
+                                       kiosk=kiosk.id, key=key, held=True)
+        history.update_payout(held.key, "held")
+    kiosk.journal.append("payout-queued", key=held.key, collected=kiosk.payout_amount)
+    kiosk.interrupted_payout = None
+    kiosk.payout_amount = 0
+
+
+# GPIO listener to handle a kiosk's button events
+async def button_listener(kiosk):
     while True:
-        if read_button():
-            logger.info("Button pressed")
-            if current_screen == "insert-coin":
-                current_screen = await handle_insert_coin()
-            elif current_screen == "confirm-amount" or current_screen == "error-page":
-                asyncio.create_task(handle_scan_user_address())  # Run it in the background
-                current_screen = "scan-wallet"  # Move to the next screen immediately
-                await send_message("clear-error-logs", {})
-            else:
-                current_screen = get_next_screen(current_screen)
-            await send_message("screen-change", {"screen": current_screen})
-        await read_coin_selector()
-        await asyncio.sleep(0.002)
-
-async def send_message(event, data):
-    """Send a JSON-formatted message asynchronously to all connected WebSocket clients."""
-    disconnected_clients = set()
-    for ws in connected_clients:
-        try:
-            message = json.dumps({"event": event, "data": data})
-            logger.info(message)
-            await ws.send(message)
-        except websockets.exceptions.ConnectionClosed:
-            disconnected_clients.add(ws)
+        kind = kiosk.read_button(DEBOUNCE_INTERVAL, HOLD_TO_RESET_INTERVAL)
+        if kind is not None:
+            gpio_logger.info(f"[{kiosk.id}] Button {kind}")
+            kiosk.machine.post(kind)
+        await asyncio.sleep(BUTTON_POLL_INTERVAL)
+
+async def send_message(kiosk, event, data):
+    """Queue a JSON-formatted message for the kiosk's WebSocket clients, or for every kiosk's if `kiosk` is None."""
+    start = time.perf_counter()
+    for target in (kiosks.values() if kiosk is None else (kiosk,)):
+        message = target.publish(event, data)
+    publish_seconds.observe(time.perf_counter() - start)
+    ws_logger.info(message if kiosk is not None else f"[all kiosks] {message}")
+
+# Fetching and updating data (Kaspa and USD/AUD rates) periodically.
+# A single task started by main() publishes to all kiosks; new clients get a state-snapshot instead.
+async def send_periodic_updates():
+    while True:
+        kaspa_price = kaspa_feed.get_data()  # Get Kaspa price
+        usd_to_aud = usd_aud_feed.get_data()  # Get USD to AUD rate
+
+        # Keep the last known values until the feeds have data
+        if kaspa_price is not None:
+            shared_data["kaspa_price"] = kaspa_price
+        if usd_to_aud is not None:
+            shared_data["usd_to_aud"] = usd_to_aud
+        if kaspa_feed.stale or usd_aud_feed.stale:
+            readiness.register("prices")  # Still starting: the cached values (if any) are shown, flagged stale
+        else:
+            readiness.mark_ready("prices")
+        # Send the update to all connected clients
+        await send_message(None, "exchange-update", get_exchange_data())
 
-    # Remove disconnected clients
-    connected_clients.difference_update(disconnected_clients)
+        price_logger.info("exchange-update:" + " kaspa_price:" + str(kaspa_price) + " usd_to_aud:" + str(usd_to_aud))
+        # Wait for the next fetched value, or re-send every 10 minutes
+        await price_oracle.wait_for_update(timeout=10 * 60)
 
-# Fetching and updating data (Kaspa and USD/AUD rates) periodically
-async def send_periodic_updates():
+def get_exchange_data():
+    return {
+        "kaspa_price": shared_data["kaspa_price"],
+        "usd_to_aud": shared_data["usd_to_aud"],
+        "stale": kaspa_feed.stale or usd_aud_feed.stale
+    }
+
+async def poll_wallet_status():
+    """Reads the worker's wallet cache for the metrics."""
+    while True:
+        if payout_backend.ready:
+            status = await payout_backend.request("wallet", timeout=10)
+            if isinstance(status, dict):
+                wallet_status.clear()
+                wallet_status.update(status)
+        await asyncio.sleep(WALLET_POLL_INTERVAL)
+
+async def send_metrics_updates():
+    """Sends the metrics to the clients that subscribed to them."""
     while True:
-        await asyncio.sleep(3)
-        kaspa_price = kaspa_fetcher.get_data()  # Get Kaspa price
-        usd_to_aud = usd_aud_fetcher.get_data()  # Get USD to AUD rate
+        await asyncio.sleep(METRICS_INTERVAL)
+        if metrics_subscribers:
+            snapshot = metrics.snapshot()
+            for websocket, kiosk in list(metrics_subscribers.items()):
+                kiosk.broadcaster.send_to(websocket, "metrics", snapshot)
+
+async def handle_client_message(kiosk, websocket, raw_message, admin=False):
+    """
+    Commands from a client, e.g. {"command": "subscribe", "topic": "metrics"}.
+
+    Admin clients can also {"command": "start", "topic": "profile", "seconds": 30, "format": "folded" or "svg"}
+    and {"command": "stop", "topic": "profile"}.
+    """
+    try:
+        message = json.loads(raw_message)
+        command, topic = message.get("command"), message.get("topic")
+    except (ValueError, AttributeError):
+        ws_logger.info(f"Ignoring malformed client message: {raw_message!r}")
+        return
+    if topic == "metrics" and command == "subscribe":
+        metrics_subscribers[websocket] = kiosk
+        kiosk.broadcaster.send_to(websocket, "metrics", metrics.snapshot())
+    elif topic == "metrics" and command == "unsubscribe":
+        metrics_subscribers.pop(websocket, None)
+    elif topic == "profile" and not admin:
+        ws_logger.info(f"Ignoring admin command from a client that is not admin: {raw_message!r}")
+    elif topic == "profile" and command == "start":
+        if loop_profiler.running:
+            kiosk.broadcaster.send_to(websocket, "profile-status", {"running": True, "error": "already running"})
+            return
+        try:
+            seconds = min(float(message.get("seconds", 30)), PROFILE_MAX_SECONDS)
+        except (TypeError, ValueError):
+            seconds = 30
+        asyncio.create_task(run_profile(kiosk, websocket, seconds, "svg" if message.get("format") == "svg" else "folded"))
+    elif topic == "profile" and command == "stop":
+        loop_profiler.stop()
+    else:
+        ws_logger.info(f"Ignoring unknown client command: {raw_message!r}")
+
+async def run_profile(kiosk, websocket, seconds, format):
+    """Samples the event loop for `seconds` (or until stopped), writes the profile file and tells the admin client."""
+    loop_profiler.start(seconds)
+    logger.info(f"Profiling the event loop for up to {seconds:.0f} s")
+    kiosk.broadcaster.send_to(websocket, "profile-status", {"running": True, "seconds": seconds})
+    await asyncio.to_thread(loop_profiler.join)
+    path = os.path.abspath(f"profile-{time.strftime('%Y%m%d-%H%M%S')}.{format}")
+    try:
+        await asyncio.to_thread(loop_profiler.write, path, format)
+    except OSError as e:
+        logger.error(f"Could not write the profile: {e}")
+        kiosk.broadcaster.send_to(websocket, "profile-status", {"running": False, "error": str(e)})
+        return
+    logger.info(f"Wrote {loop_profiler.samples} samples over {loop_profiler.seconds:.1f} s to {path}")
+    kiosk.broadcaster.send_to(websocket, "profile-status", {
+        "running": False,
+        "file": path,
+        "samples": loop_profiler.samples,
+        "seconds": loop_profiler.seconds,
+        "top": loop_profiler.top()
+    })
 
-        shared_data["kaspa_price"] = kaspa_price
-        shared_data["usd_to_aud"] = usd_to_aud
-        # Send the update to all connected clients
-        await send_message("exchange-update", {
-            "kaspa_price": kaspa_price,
-            "usd_to_aud": usd_to_aud
-        })
+def get_state_snapshot(kiosk):
+    """Everything a freshly connected UI needs to draw the kiosk's current screen."""
+    return {
+        "epoch": kiosk.broadcaster.epoch,
+        "kiosk": kiosk.id,
+        "screen": kiosk.screen,
+        "total_collected": kiosk.collected_amount,
+        "readiness": readiness.to_dict(),
+        **get_exchange_data()
+    }
+
+def get_query(websocket):
+    request = getattr(websocket, "request", None)
+    if request is None:
+        return {}
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(request.path).query)
+
+def get_resume_point(query):
+    """Returns the (epoch, seq) a reconnecting client asked to resume from (ws://...?epoch=E&resume=S), or None."""
+    try:
+        return int(query["epoch"][0]), int(query["resume"][0])
+    except (KeyError, ValueError):
+        return None
+
+def is_admin(query):
+    """Whether the client connected with ?admin=<CHANGEOMATIC_ADMIN_TOKEN>."""
+    return ADMIN_TOKEN is not None and hmac.compare_digest(query.get("admin", [""])[0].encode(), ADMIN_TOKEN.encode())
 
-        logger.info("exchange-update:" + " kaspa_price:" + str(kaspa_price) + " usd_to_aud:" + str(usd_to_aud))
-        # Wait before sending the next update (e.g., 10 minutes)
-        await asyncio.sleep(10 * 60)  # Adjust as needed
+def get_kiosk(query):
+    """The kiosk a client asked for with ws://...?kiosk=<id>, the first one if it did not ask, or None if unknown."""
+    if "kiosk" not in query:
+        return next(iter(kiosks.values()))
+    return kiosks.get(query["kiosk"][0])
 
 async def client_handler(websocket, path=None):
-    global current_screen
-    logger.info("WebSocket connected. current screen:" + current_screen)
-    connected_clients.add(websocket)
+    query = get_query(websocket)
+    kiosk = get_kiosk(query)
+    if kiosk is None:
+        ws_logger.info(f"Refusing a client for unknown kiosk {query['kiosk'][0]!r}")
+        await websocket.close(code=4004, reason="unknown kiosk")
+        return
+    admin = is_admin(query)
+    protocol, encoding = negotiate(query)  # ?protocol=2 for the compact protocol (wire_protocol.py)
+    ws_logger.info(f"[{kiosk.id}] WebSocket {'admin ' if admin else ''}connected ({protocol}"
+                   f"{'/' + encoding if protocol == 'compact' else ''}). current screen:" + kiosk.screen)
+    kiosk.broadcaster.add(websocket, protocol, encoding)
     try:
         # Log active connections immediately
-        logger.info(f"Active connections: {len(connected_clients)}")
-
-        # Send initial screen change message
-        await send_message("screen-change", {"screen": current_screen})
-        await send_periodic_updates()
+        ws_logger.info(f"[{kiosk.id}] Active connections: {len(kiosk.broadcaster)}")
+
+        # Send only what a reconnecting client missed, or the full current state
+        resume_point = get_resume_point(query)
+        if resume_point is not None and kiosk.broadcaster.resume(websocket, *resume_point):
+            ws_logger.info(f"[{kiosk.id}] Client resumed from seq {resume_point[1]}")
+        else:
+            kiosk.broadcaster.send_to(websocket, "state-snapshot", get_state_snapshot(kiosk))
+        if "first-frame" not in startup_seconds:
+            startup_seconds["first-frame"] = time.monotonic() - startup_began
+            logger.info(f"[startup] First frame queued {startup_seconds['first-frame']:.2f} s after start")
 
         # Handle WebSocket until it closes
-        await websocket.wait_closed()
+        try:
+            async for raw_message in websocket:
+                await handle_client_message(kiosk, websocket, raw_message, admin)
+        except websockets.exceptions.ConnectionClosed:
+            pass
 
     finally:
-        logger.info("WebSocket disconnected. ")
-        connected_clients.discard(websocket)
+        ws_logger.info(f"[{kiosk.id}] WebSocket disconnected. ")
+        kiosk.broadcaster.remove(websocket)
+        metrics_subscribers.pop(websocket, None)
         # Log active connections when a client disconnects
-        logger.info(f"Active connections: {len(connected_clients)}")
-
-async def run_transaction_retries():
-    process = await asyncio.create_subprocess_exec(
-        "node", MONITOR_JS, "--encoding", "borsh", "--network", "mainnet",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-
-    async def read_output(stream):
-        while True:
-            line = await stream.readline()
-            if not line:
-                break
-            logger.info(f"[MONITOR] {line.decode().strip()}")
-
-    task_stdout = asyncio.create_task(read_output(process.stdout))
-    task_stderr = asyncio.create_task(read_output(process.stderr))
-
-    await asyncio.gather(task_stdout, task_stderr)
+        ws_logger.info(f"[{kiosk.id}] Active connections: {len(kiosk.broadcaster)}")
 
 async def main():
+    loop_watchdog.start()
+    startup_seconds["import"] = time.monotonic() - startup_began
+    logger.info(f"[startup] Modules imported and sessions recovered in {startup_seconds['import']:.2f} s")
+    readiness.register("websocket", "prices", "payouts")
+    for kiosk in kiosks.values():
+        if kiosk.interrupted_payout is not None:
+            await hold_interrupted_payout(kiosk)
+
+    # Serve the recovered sessions and cached prices first, so the UI is not stuck on "Reconnecting"
     server = await websockets.serve(client_handler, "0.0.0.0", 8765)
-    logger.info("WebSocket server running on ws://0.0.0.0:8765")
-
-    # asyncio.create_task(run_transaction_retries())
-
-    # Start periodic data updates in the background
+    logger.info(f"WebSocket server running on ws://0.0.0.0:8765 for kiosks: {', '.join(kiosks)}")
+    readiness.mark_ready("websocket")
+    kiosk_tasks = [kiosk.machine.run() for kiosk in kiosks.values()]
     asyncio.create_task(send_periodic_updates())
 
-    await asyncio.gather(server.wait_closed(), button_listener())
+    # Then bring up everything else concurrently; each subsystem reports its readiness when it is up
+    await asyncio.to_thread(history.open)
+    asyncio.create_task(serve_history(history, HISTORY_HOST, HISTORY_PORT))
+    payout_backend.start()
+    payout_tracker.start()
+    payout_outbox.start()
+    price_oracle.start()
+    kiosk_tasks += [start_kiosk(kiosk, kiosk_configs[kiosk_id]) for kiosk_id, kiosk in kiosks.items()]
+    await serve_metrics(metrics, "127.0.0.1", METRICS_PORT)
+    asyncio.create_task(measure_loop_lag(loop_lag_seconds, loop_lag_gauge))
+    asyncio.create_task(send_metrics_updates())
+    asyncio.create_task(poll_wallet_status())
+
+    await asyncio.gather(server.wait_closed(), *kiosk_tasks)
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     finally:
-        lgpio.gpiochip_close(chip)
+        for gpio in gpio_backends.values():
+            gpio.close()
+        for kiosk in kiosks.values():
+            kiosk.close()
+        history.close()
+        loop_watchdog.stop()
         logger.info("end.")
+        log_listener.stop()
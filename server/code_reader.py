@@ -1,99 +1,188 @@
-import smbus2  # Use smbus2 for better I2C control
+import os
 import struct
+import threading
 import time
 import asyncio
-import re
 
 from smbus2 import SMBus, i2c_msg
 
+from log_setup import get_logger
+
+logger = get_logger("qr")
+
 I2C_BUS = 1
 I2C_ADDR = 0x0C
 MAX_LENGTH = 254
 I2C_READ_CHUNK_SIZE = 32  # Maximum bytes per I2C transaction
+I2C_M_RD = 0x0001  # Read flag of an i2c_msg
 
-bus = SMBus(I2C_BUS)
 
-async def read_tiny_code_reader():
-    try:
-        # Step 1: Read first 2 bytes for content length
-        write = i2c_msg.write(I2C_ADDR, [0x00])  # Set pointer to 0
-        read = i2c_msg.read(I2C_ADDR, 2)  # Read 2 bytes
-        bus.i2c_rdwr(write, read)
-        raw_length = list(read)
+class TinyCodeReader:
+    """
+    Scans the Tiny Code Reader on a dedicated thread.
 
-        if len(raw_length) < 2:
-            print("x", end="", flush=True)
-            return None
+    The I2C transfers never run on the event loop. While a scan() is waiting, the thread polls
+    the reader, fast after it last saw something and slowing down while nothing is in view, and
+    hands the first code it reads to the waiting coroutine through a future. Cancelling scan()
+    (or its timeout) is therefore instant, whatever the bus is doing.
+    """
 
-        content_length = struct.unpack("<H", bytes(raw_length))[0]
+    def __init__(self, bus=None, address=I2C_ADDR, min_interval=0.02, max_interval=0.2, bus_number=I2C_BUS):
+        """
+        :param bus: SMBus-like object; SMBus(bus_number) is opened on the first scan if not given.
+        :param address: I2C address of the reader.
+        :param min_interval: Poll interval (seconds) right after content was seen.
+        :param max_interval: Poll interval the reader slows down to while nothing is in view.
+        """
+        self.bus = bus
+        self.address = address
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.bus_number = bus_number
+        self.errors = 0  # Consecutive I2C errors
+        self._active = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._waiter = None  # (loop, future, accept, on_reject) of the scan in progress
+        self._last_code = None
+
+    def read_frame(self):
+        """Reads the current code from the reader. Returns bytes or None."""
+        # Step 1: Read first 2 bytes for content length
+        write = i2c_msg.write(self.address, [0x00])  # Set pointer to 0
+        read = i2c_msg.read(self.address, 2)  # Read 2 bytes
+        self.bus.i2c_rdwr(write, read)
+        content_length = struct.unpack("<H", bytes(list(read)))[0]
 
         # Validate length
         if content_length == 0 or content_length > MAX_LENGTH:
             return None
 
         # Step 2: Read the full content in one transaction
-        read = i2c_msg.read(I2C_ADDR, content_length + 2)
-        bus.i2c_rdwr(read)
-        content_bytes = list(read)[2:]
-
-        print(f" [{time.time()}] Found QR Code, in read_tiny_code_reader.")
-        return {
-            "content_length": content_length,
-            "content_bytes": bytes(content_bytes)
-        }
-
-    except Exception as e:
-        print(f"Error reading from I2C: {e}")
-        return None
-
-async def scan_qr_code(timeout=40, callback=None):
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        message = await read_tiny_code_reader()
-        if message:
-            qr_code = message["content_bytes"].decode('utf-8', errors='ignore')
-            # print(f"[{time.time()}] QR Code detected: {qr_code}")
-            print(".", end="", flush=True)
-            if callback:
-                if asyncio.iscoroutinefunction(callback):
-                    await callback(True, qr_code)
-                else:
-                    callback(True, qr_code)
-            return qr_code
-        await asyncio.sleep(0.05)
-
-    print(f"[{time.time()}] QR Code timeout reached")
-    if callback:
-        if asyncio.iscoroutinefunction(callback):
-            await callback(False, None)
-        else:
-            callback(False, None)
-    return None
-
-
-
-async def is_valid_kaspa_address(address: str) -> bool:
+        read = i2c_msg.read(self.address, content_length + 2)
+        self.bus.i2c_rdwr(read)
+        return bytes(list(read)[2:])
+
+    async def scan(self, timeout=40, accept=None, on_reject=None):
+        """
+        Waits up to `timeout` seconds for a code. Returns the decoded text, or None on timeout.
+
+        :param accept: Optional check run on the reader thread; codes it returns False for are
+                       skipped and scanning goes on. It must be fast and thread safe.
+        :param on_reject: Optional callback(code), called on the loop for every skipped code.
+        """
+        self._ensure_thread()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiter = (loop, future, accept, on_reject)
+        self._last_code = None
+        self._active.set()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._active.clear()
+            self._waiter = None
+
+    def close(self):
+        self._stop.set()
+        self._active.set()  # Wake the thread so it can exit
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def _ensure_thread(self):
+        if self.bus is None:
+            self.bus = SMBus(self.bus_number)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="tiny-code-reader", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        interval = self.min_interval
+        while not self._stop.is_set():
+            self._active.wait()
+            if self._stop.is_set():
+                break
+            try:
+                content = self.read_frame()
+                self.errors = 0
+            except OSError as e:
+                self.errors += 1
+                if self.errors == 1 or self.errors % 100 == 0:
+                    logger.warning(f"Error reading from I2C ({self.errors} in a row): {e}")
+                content = None
+                interval = self.max_interval
+
+            if content is None:
+                interval = min(interval * 1.5, self.max_interval)
+            else:
+                interval = self.min_interval
+                self._deliver(content.decode("utf-8", errors="ignore"))
+            self._stop.wait(interval)
+
+    def _deliver(self, code):
+        # The reader reports the same code on every frame while it is in view
+        if code == self._last_code:
+            return
+        self._last_code = code
+        waiter = self._waiter
+        if waiter is None:
+            return
+        loop, future, accept, on_reject = waiter
+        if accept is not None and not accept(code):
+            if on_reject is not None:
+                loop.call_soon_threadsafe(on_reject, code)
+            return
+        loop.call_soon_threadsafe(self._resolve, future, code)
+
+    @staticmethod
+    def _resolve(future, code):
+        if not future.done():
+            future.set_result(code)
+
+
+class FakeCodeReaderBus:
     """
-    Validates a Kaspa public address based on length, prefix, and character set.
+    SMBus stand-in that behaves like a Tiny Code Reader, for running and timing scans off the Pi.
 
-    Returns:
-        True if valid, False otherwise.
+    show() puts a code in view, hide() takes it away. Like the reader, every i2c_rdwr() call
+    reads the frame from its start. Every call takes `transfer_time` seconds, roughly what a
+    transfer costs on a real 100 kHz bus.
     """
 
-    print ("validating received address:", address)
-    # Kaspa address must start with "kaspa:"
-    if not address.startswith("kaspa:"):
-        return False
-
-    # Remove the prefix for further checks
-    base32_part = address[6:]
-
-    # Length check (62-64 characters excluding "kaspa:")
-    if not (62 <= len(base32_part) <= 64):
-        return False
-
-    # Base32 Bech32m character validation (A-Z, 2-7)
-    if not re.fullmatch(r"[a-z0-9]+", base32_part):
-        return False
-
-    return True
+    def __init__(self, transfer_time=0.001):
+        self.transfer_time = transfer_time
+        self.transfers = 0
+        self._pointer = 0
+        self._buffer = bytes(2 + MAX_LENGTH)
+
+    def show(self, code):
+        content = code.encode("utf-8")[:MAX_LENGTH]
+        self._buffer = struct.pack("<H", len(content)) + content.ljust(MAX_LENGTH, b"\0")
+
+    def hide(self):
+        self._buffer = bytes(2 + MAX_LENGTH)
+
+    def i2c_rdwr(self, *messages):
+        self.transfers += 1
+        time.sleep(self.transfer_time)
+        self._pointer = 0
+        for message in messages:
+            if message.flags & I2C_M_RD:
+                data = self._buffer[self._pointer:self._pointer + message.len]
+                for i, byte in enumerate(data):
+                    message.buf[i] = bytes([byte])
+                self._pointer += message.len
+            else:
+                self._pointer = message.buf[0][0]
+
+    def close(self):
+        pass
+
+
+def open_code_reader(bus_number=I2C_BUS, address=I2C_ADDR):
+    """Returns a reader on I2C bus `bus_number`, or on a FakeCodeReaderBus with CHANGEOMATIC_QR=sim."""
+    if os.environ.get("CHANGEOMATIC_QR") == "sim":
+        return TinyCodeReader(bus=FakeCodeReaderBus(), address=address)
+    return TinyCodeReader(address=address, bus_number=bus_number)
@@ -0,0 +1,345 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from coin_decoder import NS_PER_MS
+from log_setup import get_logger
+
+logger = get_logger("gpio")
+
+
+class PulseCalibration:
+    """Pulse timing thresholds derived for one coin acceptor, saved as JSON and loaded at startup."""
+
+    FIELDS = ("min_duration_ms", "max_duration_ms", "time_window_ms", "confidence", "width_ms", "gap_ms",
+              "pulses", "calibrated_at")
+
+    def __init__(self, min_duration_ms, max_duration_ms, time_window_ms, confidence=0.0, width_ms=None,
+                 gap_ms=None, pulses=0, calibrated_at=None):
+        """
+        :param min_duration_ms: Shortest LOW pulse accepted as a signal.
+        :param max_duration_ms: Longest LOW pulse accepted as a signal.
+        :param time_window_ms: Window after the first signal during which signals are counted.
+        :param confidence: 0 to 1, how well the measured pulses support these thresholds.
+        :param width_ms: Typical pulse width measured.
+        :param gap_ms: Typical gap between the pulses of one coin measured.
+        :param pulses: Number of pulses the calibration is based on.
+        """
+        self.min_duration_ms = min_duration_ms
+        self.max_duration_ms = max_duration_ms
+        self.time_window_ms = time_window_ms
+        self.confidence = confidence
+        self.width_ms = width_ms
+        self.gap_ms = gap_ms
+        self.pulses = pulses
+        self.calibrated_at = calibrated_at if calibrated_at is not None else time.time()
+
+    def __repr__(self):
+        return (f"PulseCalibration({self.min_duration_ms:.1f}-{self.max_duration_ms:.1f} ms pulses, "
+                f"{self.time_window_ms:.0f} ms window, confidence {self.confidence:.2f}, {self.pulses} pulses)")
+
+    def apply(self, decoder):
+        decoder.set_thresholds(self.min_duration_ms, self.max_duration_ms, self.time_window_ms)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def save(self, path):
+        tmp_file = path + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_file, path)
+        except OSError as e:
+            logger.warning(f"Could not save coin calibration: {e}")
+
+    @classmethod
+    def load(cls, path):
+        """The saved calibration, or None if there is none (or it cannot be read)."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+
+class PulseTimings:
+    """
+    Ring buffers of recent LOW pulse widths and in-coin gaps (HIGH time between two pulses), in ms.
+
+    feed() takes single edges as they arrive; add_edges() takes whole arrays (e.g. a PulseTrace)
+    and is vectorized. HIGH periods longer than `max_gap_ms` are idle time between coins, not gaps.
+    """
+
+    def __init__(self, size=4096, max_gap_ms=100):
+        self.size = size
+        self.max_gap_ms = max_gap_ms
+        self._widths = np.zeros(size, dtype=np.float64)
+        self._gaps = np.zeros(size, dtype=np.float64)
+        self.width_total = 0  # Pulses ever added
+        self.gap_total = 0
+        self._last_level = None
+        self._last_tick = None
+
+    def feed(self, level, tick):
+        """Adds one edge. Returns the pulse width if the edge ended a pulse, otherwise None."""
+        width = None
+        if self._last_tick is not None and level != self._last_level:
+            duration = (tick - self._last_tick) / NS_PER_MS
+            if level == 1:
+                self._widths[self.width_total % self.size] = width = duration
+                self.width_total += 1
+            elif duration <= self.max_gap_ms:
+                self._gaps[self.gap_total % self.size] = duration
+                self.gap_total += 1
+        self._last_level = level
+        self._last_tick = tick
+        return width
+
+    def add_edges(self, levels, ticks):
+        levels = np.asarray(levels, dtype=np.int8)
+        durations = np.diff(np.asarray(ticks, dtype=np.int64)) / NS_PER_MS
+        rising = (levels[:-1] == 0) & (levels[1:] == 1)
+        falling = (levels[:-1] == 1) & (levels[1:] == 0)
+        gaps = durations[falling]
+        self._extend("_widths", "width_total", durations[rising])
+        self._extend("_gaps", "gap_total", gaps[gaps <= self.max_gap_ms])
+        if len(levels):
+            self._last_level = int(levels[-1])
+            self._last_tick = int(ticks[-1])
+
+    def _extend(self, buffer_name, total_name, values):
+        buffer = getattr(self, buffer_name)
+        total = getattr(self, total_name)
+        values = values[-self.size:]
+        positions = (total + np.arange(len(values))) % self.size
+        buffer[positions] = values
+        setattr(self, total_name, total + len(values))
+
+    def widths(self, last=None):
+        """The buffered pulse widths, oldest first (only the `last` ones if given)."""
+        return self._recent(self._widths, self.width_total, last)
+
+    def gaps(self, last=None):
+        return self._recent(self._gaps, self.gap_total, last)
+
+    def _recent(self, buffer, total, last):
+        count = min(total, self.size, last or self.size)
+        positions = (total - count + np.arange(count)) % self.size
+        return buffer[positions]
+
+
+def cluster_1d(values, clusters=3, iterations=20):
+    """
+    k-means on 1-D values, in log space so clusters scale with the value.
+
+    Starting centres are spread over the value percentiles; empty clusters end up with a NaN centre.
+
+    :return: (cluster label of each value, cluster centres)
+    """
+    logs = np.log(np.maximum(values, 0.01))
+    centers = np.percentile(logs, np.linspace(10, 90, clusters))
+    labels = np.zeros(len(values), dtype=np.intp)
+    for _ in range(iterations):
+        labels = np.argmin(np.abs(logs[:, None] - centers[None, :]), axis=1)
+        new_centers = np.array([logs[labels == k].mean() if np.any(labels == k) else np.nan
+                                for k in range(len(centers))])
+        if np.allclose(new_centers, centers, equal_nan=True):
+            break
+        centers = new_centers
+    return labels, np.exp(centers)
+
+
+def split_signal(values, margin):
+    """
+    Splits measured durations into the dominant cluster (the coin signal) and the rest (noise).
+
+    The largest k-means cluster is the signal, together with any cluster within `2 * margin` of
+    it, since one broad signal can be split over several clusters.
+    """
+    if len(values) < 3:
+        return values, values[:0]
+    labels, centers = cluster_1d(values)
+    signal_center = centers[np.bincount(labels, minlength=len(centers)).argmax()]
+    signal_labels = np.flatnonzero(np.abs(np.log(centers / signal_center)) < np.log(1 + 2 * margin))
+    is_signal = np.isin(labels, signal_labels)
+    return values[is_signal], values[~is_signal]
+
+
+def calibrate(widths, gaps, max_signals=5, margin=0.25, min_pulses=50, default_window_ms=200):
+    """
+    Derives pulse thresholds from measured pulse widths and in-coin gaps (ms).
+
+    Widths and gaps are each clustered into signal and noise (see split_signal()). The accepted
+    width range is the signal's median +/- the larger of 4 robust standard deviations and
+    `margin` of the median, kept clear of the noise clusters. The time window covers
+    `max_signals` pulses at the slowest (99th percentile) signal width and gap.
+
+    Confidence is the share of signal pulses inside the range, times the share of all pulses
+    that are not near misses just outside it, scaled down below `min_pulses` pulses.
+
+    :return: PulseCalibration, or None with no pulses to go on.
+    """
+    widths = np.asarray(widths, dtype=np.float64)
+    gaps = np.asarray(gaps, dtype=np.float64)
+    if len(widths) == 0:
+        return None
+
+    signal, noise = split_signal(widths, margin)
+    width = float(np.median(signal))
+    spread = 1.4826 * float(np.median(np.abs(signal - width)))
+    half_range = max(4 * spread, margin * width)
+    min_ms, max_ms = width - half_range, width + half_range
+    below, above = noise[noise < width], noise[noise > width]
+    if len(below):
+        min_ms = max(min_ms, (below.max() + signal.min()) / 2)
+    if len(above):
+        max_ms = min(max_ms, (above.min() + signal.max()) / 2)
+
+    gap = None
+    window_ms = default_window_ms
+    if len(gaps):
+        gaps, _ = split_signal(gaps, margin)
+        gap = float(np.median(gaps))
+        period = float(np.percentile(signal, 99) + np.percentile(gaps, 99))
+        window_ms = (max_signals - 1) * period + margin * period
+
+    inside = np.mean((signal >= min_ms) & (signal <= max_ms))
+    near_miss = np.mean(((widths >= min_ms - half_range / 2) & (widths < min_ms)) |
+                        ((widths > max_ms) & (widths <= max_ms + half_range / 2)))
+    confidence = float(inside * (1 - near_miss) * min(1.0, len(signal) / min_pulses))
+
+    return PulseCalibration(round(min_ms, 2), round(max_ms, 2), round(window_ms, 1), round(confidence, 3),
+                            width_ms=round(width, 2), gap_ms=None if gap is None else round(gap, 2),
+                            pulses=int(len(signal)))
+
+
+class OnlineCalibrator:
+    """
+    Follows slow drift in pulse timing while the server runs.
+
+    Sees every coin edge (CoinEdgeListener passes them on). Every `update_every` pulses the
+    thresholds move a fraction `alpha` toward a calibration of the recent pulses.
+
+    A two-sided Page-Hinkley test on the pulse widths detects a sudden, sustained shift away from
+    the calibrated width. Once `drift_pulses` pulses have arrived since the estimated change
+    point, the thresholds jump to a calibration of just those pulses, if it is confident enough.
+    Thresholds are only changed between coins; `on_update(calibration)` is called on changes.
+    """
+
+    def __init__(self, decoder, calibration, timings=None, alpha=0.1, update_every=50, recent_pulses=200,
+                 min_confidence=0.8, drift_tolerance=0.05, drift_threshold=1.0, drift_pulses=30, on_update=None):
+        """
+        :param decoder: CoinPulseDecoder whose thresholds are adjusted.
+        :param calibration: PulseCalibration in use at startup.
+        :param alpha: Fraction of the way the thresholds move towards the recent calibration per update.
+        :param update_every: Pulses between updates.
+        :param recent_pulses: Pulses the update calibration is based on.
+        :param min_confidence: Calibrations below this confidence are ignored.
+        :param drift_tolerance: Deviation per pulse the drift test ignores, as a fraction of the calibrated width.
+        :param drift_threshold: Accumulated deviation that counts as drift, as a multiple of the calibrated width.
+        :param drift_pulses: Pulses after the change point to recalibrate from.
+        """
+        self.decoder = decoder
+        self.calibration = calibration
+        self.timings = timings if timings is not None else PulseTimings()
+        self.alpha = alpha
+        self.update_every = update_every
+        self.recent_pulses = recent_pulses
+        self.min_confidence = min_confidence
+        self.drift_tolerance = drift_tolerance
+        self.drift_threshold = drift_threshold
+        self.drift_pulses = drift_pulses
+        self.on_update = on_update
+        self.drifts = 0
+        self._pending = None  # Calibration waiting for the decoder to be idle
+        self._pulses_at_update = 0
+        self._stable_since = 0  # First pulse of the current timing regime
+        self._drift_since = None  # Estimated change point of a detected drift
+        self._reset_drift_test()
+
+    def _reset_drift_test(self):
+        total = self.timings.width_total
+        self._sum_up = self._min_up = 0.0
+        self._sum_down = self._max_down = 0.0
+        self._up_since = self._down_since = total
+
+    def feed(self, level, tick):
+        width = self.timings.feed(level, tick)
+        if width is not None:
+            total = self.timings.width_total
+            if self._drift_since is not None:
+                if total - self._drift_since >= self.drift_pulses:
+                    self._recalibrate()
+            else:
+                self._check_drift(width)
+                if total - self._pulses_at_update >= self.update_every:
+                    self._update()
+        if self._pending is not None and not self.decoder.measuring:
+            self._apply(self._pending)
+
+    def _check_drift(self, width):
+        reference = self.calibration.width_ms
+        if reference is None or not 0.5 * reference <= width <= 1.5 * reference:
+            return  # No reference yet, or a glitch
+        tolerance = self.drift_tolerance * reference
+        total = self.timings.width_total
+        self._sum_up += width - reference - tolerance
+        if self._sum_up < self._min_up:
+            self._min_up, self._up_since = self._sum_up, total
+        self._sum_down += width - reference + tolerance
+        if self._sum_down > self._max_down:
+            self._max_down, self._down_since = self._sum_down, total
+        threshold = self.drift_threshold * reference
+        if self._sum_up - self._min_up > threshold:
+            self._drift_since = self._up_since
+        elif self._max_down - self._sum_down > threshold:
+            self._drift_since = self._down_since
+        if self._drift_since is not None:
+            self._reset_drift_test()
+
+    def _recalibrate(self):
+        since, self._drift_since = self._drift_since, None
+        count = self.timings.width_total - since
+        recent = calibrate(self.timings.widths(last=count), self.timings.gaps(last=count),
+                           min_pulses=self.drift_pulses)
+        if recent is None or recent.confidence < self.min_confidence:
+            return
+        self.drifts += 1
+        logger.warning(f"Coin pulse timing drifted from {self.calibration.width_ms} ms to {recent.width_ms} ms, "
+                       f"recalibrated: {recent}")
+        self._stable_since = since
+        self._pulses_at_update = self.timings.width_total
+        self._pending = recent
+
+    def _update(self):
+        total = self._pulses_at_update = self.timings.width_total
+        count = min(self.recent_pulses, total - self._stable_since)
+        recent = calibrate(self.timings.widths(last=count), self.timings.gaps(last=count))
+        if recent is None or recent.confidence < self.min_confidence:
+            return
+        current = self.calibration
+
+        def blend(old, new):
+            return round(old + self.alpha * (new - old), 2) if old is not None and new is not None else new
+
+        self._pending = PulseCalibration(
+            blend(current.min_duration_ms, recent.min_duration_ms),
+            blend(current.max_duration_ms, recent.max_duration_ms),
+            blend(current.time_window_ms, recent.time_window_ms),
+            confidence=recent.confidence,
+            width_ms=blend(current.width_ms, recent.width_ms),
+            gap_ms=blend(current.gap_ms, recent.gap_ms),
+            pulses=current.pulses + self.update_every,
+        )
+
+    def _apply(self, calibration):
+        self._pending = None
+        self.calibration = calibration
+        calibration.apply(self.decoder)
+        logger.debug(f"Coin pulse thresholds updated: {calibration}")
+        if self.on_update is not None:
+            self.on_update(calibration)
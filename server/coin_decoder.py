@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import time
+
+NS_PER_MS = 1_000_000
+
+
+class CoinPulseDecoder:
+    """
+    Counts valid coin acceptor pulses and reports how many arrived within the time window.
+
+    The decoder is fed (level, tick) edges, where `tick` is a nanosecond timestamp taken when
+    the edge happened (lgpio's kernel tick). It never reads a clock itself, so the result does
+    not depend on how quickly the edges are processed.
+    """
+
+    def __init__(self, min_duration_ms=22, max_duration_ms=38, time_window_ms=200):
+        """
+        :param min_duration_ms: Shortest LOW pulse accepted as a signal.
+        :param max_duration_ms: Longest LOW pulse accepted as a signal.
+        :param time_window_ms: Window after the first valid signal during which signals are counted.
+        """
+        self.set_thresholds(min_duration_ms, max_duration_ms, time_window_ms)
+        self.prev_tick_low = None  # Tick of the last falling edge
+        self.window_start = None   # Tick of the first valid signal, None when idle
+        self.signal_count = 0
+
+    def set_thresholds(self, min_duration_ms, max_duration_ms, time_window_ms):
+        """Changes the pulse and window timing, e.g. to calibrated values. Takes effect from the next edge."""
+        self.min_duration = int(min_duration_ms * NS_PER_MS)
+        self.max_duration = int(max_duration_ms * NS_PER_MS)
+        self.time_window = int(time_window_ms * NS_PER_MS)
+        self.time_window_ms = time_window_ms
+
+    @property
+    def measuring(self):
+        return self.window_start is not None
+
+    def feed(self, level, tick):
+        """
+        Processes one edge.
+
+        :return: The signal count of a coin whose window closed before this edge, otherwise None.
+        """
+        finished = None
+        if self.measuring and tick - self.window_start >= self.time_window:
+            finished = self._close_window()
+
+        if level == 0:  # Falling edge (LOW detected)
+            self.prev_tick_low = tick
+        elif self.prev_tick_low is not None:  # Rising edge (HIGH detected)
+            signal_duration = tick - self.prev_tick_low
+            self.prev_tick_low = None
+            if self.min_duration <= signal_duration <= self.max_duration:
+                if not self.measuring:
+                    self.window_start = tick
+                    self.signal_count = 1
+                else:
+                    self.signal_count += 1
+        return finished
+
+    def flush(self):
+        """Closes the current window, returning its signal count (None if no window was open)."""
+        if not self.measuring:
+            return None
+        return self._close_window()
+
+    def _close_window(self):
+        count = self.signal_count
+        self.window_start = None
+        self.signal_count = 0
+        return count
+
+
+class CoinEdgeListener:
+    """
+    Bridges GPIO edge alerts into the asyncio loop.
+
+    on_edge() is called from the GPIO alert thread: it only appends to a deque (atomic in
+    CPython, no lock needed) and wakes the loop. coins() drains the deque on the loop and
+    yields a signal count for every coin the decoder recognises.
+    """
+
+    # Extra time to wait past the window for the last rising edge to reach the loop
+    WINDOW_GRACE = 0.02
+
+    def __init__(self, decoder, max_pending_edges=1024, trace=None, delay_histogram=None, calibrator=None):
+        """
+        :param decoder: CoinPulseDecoder fed with the edges.
+        :param max_pending_edges: Edges kept while the loop is busy; the oldest are dropped beyond that.
+        :param trace: Optional log_setup.TraceBuffer that records every edge.
+        :param delay_histogram: Optional metrics.Histogram of seconds from edge alert to decoding on the loop.
+        :param calibrator: Optional coin_calibration.OnlineCalibrator that also sees every edge.
+        """
+        self.decoder = decoder
+        self.trace = trace
+        self.delay_histogram = delay_histogram
+        self.calibrator = calibrator
+        self.last_edge_received = None  # time.monotonic_ns() of the last decoded edge's alert
+        self._edges = collections.deque(maxlen=max_pending_edges)
+        self._wakeup = asyncio.Event()
+        self._loop = None
+        self._deadline = None
+
+    def attach(self, gpio, pin):
+        """Starts receiving edges for `pin` from the GPIO backend. Must be called from the loop."""
+        self._loop = asyncio.get_running_loop()
+        gpio.claim_alert(pin)
+        gpio.add_edge_callback(pin, self.on_edge)
+
+    def on_edge(self, level, tick):
+        self._edges.append((level, tick, time.monotonic_ns()))
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def coins(self):
+        """Yields the signal count of each coin as soon as its time window closes."""
+        while True:
+            timeout = None
+            if self._deadline is not None:
+                timeout = max(0, self._deadline - self._loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._edges:
+                level, tick, received = self._edges.popleft()
+                self.last_edge_received = received
+                if self.delay_histogram is not None:
+                    self.delay_histogram.observe((time.monotonic_ns() - received) / 1e9)
+                if self.trace is not None:
+                    self.trace.record("edge", level, tick)
+                if self.calibrator is not None:
+                    self.calibrator.feed(level, tick)
+                was_measuring = self.decoder.measuring
+                count = self.decoder.feed(level, tick)
+                if count is not None:
+                    self._deadline = None
+                    yield count
+                if self.decoder.measuring and (not was_measuring or count is not None):
+                    self._deadline = self._loop.time() + self.decoder.time_window_ms / 1000 + self.WINDOW_GRACE
+
+            if self._deadline is not None and self._loop.time() >= self._deadline:
+                self._deadline = None
+                count = self.decoder.flush()
+                if count is not None:
+                    yield count
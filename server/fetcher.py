@@ -1,66 +1,200 @@
+import asyncio
+import json
+import os
+import random
+import statistics
 import threading
 import time
-import requests
 
-class DataFetcher:
-    """A robust threaded fetcher that retries every 2 minutes on failure."""
+from log_setup import get_logger
 
-    def __init__(self, name, url, key=None, sub_key=None, interval_minutes=10, retry_minutes=2):
+logger = get_logger("price")
+
+
+class PriceSource:
+    """One API endpoint that reports a value, and where to find it in the JSON response."""
+
+    def __init__(self, name, url, path=()):
         """
         :param name: Identifier for logging/debugging.
         :param url: API endpoint to fetch data from.
-        :param key: Top-level JSON key to extract.
-        :param sub_key: (Optional) Nested key inside `key`, e.g., "AUD" inside "rates".
-        :param interval_minutes: Normal fetch interval (in minutes).
-        :param retry_minutes: Retry interval if data fetch fails.
+        :param path: Keys leading to the value, e.g. ("rates", "AUD").
         """
         self.name = name
         self.url = url
-        self.key = key
-        self.sub_key = sub_key
+        self.path = tuple(path)
+
+    def extract(self, data):
+        for key in self.path:
+            data = data.get(key) if isinstance(data, dict) else None
+        # bool is an int too, but a source reporting true/false has no price
+        return float(data) if isinstance(data, (int, float)) and not isinstance(data, bool) else None
+
+
+class PriceFeed:
+    """A value (e.g. the Kaspa price) aggregated from several sources, refreshed on an interval."""
+
+    def __init__(self, name, sources, interval_minutes=10, retry_minutes=2, ttl_minutes=30, max_deviation=0.05):
+        """
+        :param name: Identifier for logging and the cache file.
+        :param sources: PriceSource list, fetched concurrently.
+        :param interval_minutes: Normal fetch interval (in minutes).
+        :param retry_minutes: First retry interval after a failed fetch, doubled on every further failure.
+        :param ttl_minutes: Age after which the value is flagged as stale.
+        :param max_deviation: Values further than this fraction from the median are rejected as outliers.
+        """
+        self.name = name
+        self.sources = sources
         self.interval = interval_minutes * 60  # Normal interval (seconds)
         self.retry_interval = retry_minutes * 60  # Retry interval (seconds)
+        self.ttl = ttl_minutes * 60
+        self.max_deviation = max_deviation
         self.data = None  # Stores last known good value
         self.last_fetched = None  # Timestamp of last successful fetch
-        self.thread = threading.Thread(target=self._fetch_periodically, daemon=True)
+        self.failures = 0
 
-    def fetch(self):
-        """Fetches data from the API and updates the internal state."""
-        try:
-            response = requests.get(self.url, headers={"accept": "application/json"}, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            # Extract relevant data
-            new_data = None
-            if self.key:
-                extracted_data = data.get(self.key, {})
-                new_data = extracted_data.get(self.sub_key) if self.sub_key else extracted_data
-            else:
-                new_data = data
-
-            # If valid data is found, update the stored value
-            if new_data is not None:
-                self.data = new_data
-                self.last_fetched = time.time()  # Update timestamp
-                print(f"[{self.name}] ✅ Updated data: {self.data}")
-
-        except requests.RequestException as e:
-            print(f"[{self.name}] ⚠️ Fetch failed: {e}. Retrying in {self.retry_interval//60} minutes...")
-
-    def _fetch_periodically(self):
-        """Runs fetch() at regular intervals, retrying every 2 minutes on failure."""
-        while True:
-            self.fetch()
-            if self.data is None:
-                time.sleep(self.retry_interval)  # Retry in 2 min if failed
-            else:
-                time.sleep(self.interval)  # Normal interval
-
-    def start(self):
-        """Starts the background fetch thread."""
-        self.thread.start()
+    @property
+    def stale(self):
+        return self.last_fetched is None or time.time() - self.last_fetched > self.ttl
 
     def get_data(self):
         """Returns the last known good value."""
         return self.data
+
+    def aggregate(self, values):
+        """Median of the values that agree with each other; outliers are dropped when there are 3 or more."""
+        if not values:
+            return None
+        median = statistics.median(values)
+        if len(values) >= 3:
+            values = [value for value in values if abs(value - median) <= median * self.max_deviation]
+        return statistics.median(values)
+
+    def next_delay(self):
+        """Seconds until the next fetch: the interval, or a jittered exponential backoff after failures."""
+        if self.failures == 0:
+            return self.interval
+        backoff = min(self.retry_interval * 2 ** (self.failures - 1), self.interval)
+        return backoff * random.uniform(0.8, 1.2)
+
+
+class PriceOracle:
+    """
+    Keeps a set of PriceFeeds up to date on the asyncio loop.
+
+    All feeds share one pooled HTTP session; the blocking requests and the cache writes run in
+    the default executor, so the loop never waits on the network or the SD card. The last known
+    good values are saved to `cache_file` and loaded at startup, so the UI has real rates from
+    the first frame after a reboot.
+    """
+
+    def __init__(self, feeds, cache_file="price_cache.json", timeout=10):
+        self.feeds = {feed.name: feed for feed in feeds}
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.session = None  # Opened by the first fetch, so importing requests does not delay startup
+        self._session_lock = threading.Lock()
+        self._cache_lock = threading.Lock()  # Feeds updated together save from two executor threads at once
+        self.updated = asyncio.Event()
+        self._tasks = []
+
+    def __getitem__(self, name):
+        return self.feeds[name]
+
+    def load_cache(self):
+        """Restores the last known good values (and when they were fetched) from the cache file."""
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        for name, entry in cache.items():
+            feed = self.feeds.get(name)
+            if feed is not None and entry.get("value") is not None:
+                feed.data = entry["value"]
+                feed.last_fetched = entry.get("fetched")
+                logger.info(f"[{name}] Loaded cached value: {feed.data}")
+
+    async def save_cache(self):
+        """Writes the feeds' values to the cache file, off the loop."""
+        try:
+            await asyncio.to_thread(self._write_cache)
+        except OSError as e:
+            logger.warning(f"Could not save price cache: {e}")
+
+    def _write_cache(self):
+        tmp_file = self.cache_file + ".tmp"
+        with self._cache_lock:  # Read under the lock, so the last write has the latest values
+            cache = {name: {"value": feed.data, "fetched": feed.last_fetched} for name, feed in self.feeds.items()}
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, self.cache_file)
+
+    def start(self):
+        """Starts one refresh task per feed."""
+        for feed in self.feeds.values():
+            self._tasks.append(asyncio.create_task(self._refresh_periodically(feed)))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        if self.session is not None:
+            self.session.close()
+
+    async def wait_for_update(self, timeout=None):
+        """Waits until any feed gets a new value (or `timeout` seconds pass)."""
+        try:
+            await asyncio.wait_for(self.updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.updated.clear()
+
+    async def refresh(self, feed):
+        """Fetches all of the feed's sources concurrently and updates it. Returns True on success."""
+        results = await asyncio.gather(*(self._fetch(source) for source in feed.sources))
+        values = [value for value in results if value is not None]
+        new_data = feed.aggregate(values)
+        if new_data is None:
+            feed.failures += 1
+            logger.warning(f"[{feed.name}] All sources failed. Retrying in {feed.next_delay():.0f} seconds...")
+            return False
+
+        feed.data = new_data
+        feed.last_fetched = time.time()
+        feed.failures = 0
+        logger.info(f"[{feed.name}] Updated data: {feed.data} ({len(values)}/{len(feed.sources)} sources)")
+        self.updated.set()
+        await self.save_cache()
+        return True
+
+    async def _fetch(self, source):
+        try:
+            return await asyncio.to_thread(self._get, source)
+        except (OSError, ValueError) as e:  # requests.RequestException is an OSError
+            logger.warning(f"[{source.name}] Fetch failed: {e}")
+            return None
+
+    def _get(self, source):
+        response = self._get_session().get(source.url, headers={"accept": "application/json"}, timeout=self.timeout)
+        response.raise_for_status()
+        return source.extract(response.json())
+
+    def _get_session(self):
+        with self._session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self.session = requests.Session()
+                self.session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+                self.session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+            return self.session
+
+    async def _refresh_periodically(self, feed):
+        # A value loaded from the cache is only refreshed once it is due
+        if feed.last_fetched is not None:
+            await asyncio.sleep(max(0, feed.interval - (time.time() - feed.last_fetched)))
+        while True:
+            await self.refresh(feed)
+            await asyncio.sleep(feed.next_delay())
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+
+class LgpioBackend:
+    """GPIO access on the Raspberry Pi through lgpio."""
+
+    def __init__(self, chip_number=0):
+        import lgpio  # Only available on the Pi
+        self._lgpio = lgpio
+        self.chip = lgpio.gpiochip_open(chip_number)
+        self._callbacks = []
+
+    def claim_input(self, pin, idle_level=None):
+        self._lgpio.gpio_claim_input(self.chip, pin)
+
+    def claim_alert(self, pin, idle_level=None):
+        """Claims `pin` for edge alerts on both edges."""
+        self._lgpio.gpio_claim_alert(self.chip, pin, self._lgpio.BOTH_EDGES)
+
+    def read(self, pin):
+        return self._lgpio.gpio_read(self.chip, pin)
+
+    def add_edge_callback(self, pin, func):
+        """
+        Calls func(level, tick) on every edge of `pin`.
+
+        The callback runs on lgpio's alert thread. `tick` is the kernel timestamp
+        of the edge in nanoseconds, so it is unaffected by how late Python gets to it.
+        """
+        def on_alert(chip, gpio, level, tick):
+            if level in (0, 1):  # 2 is a watchdog timeout, not an edge
+                func(level, tick)
+
+        callback = self._lgpio.callback(self.chip, pin, self._lgpio.BOTH_EDGES, on_alert)
+        self._callbacks.append(callback)
+        return callback
+
+    def close(self):
+        for callback in self._callbacks:
+            callback.cancel()
+        self._callbacks.clear()
+        self._lgpio.gpiochip_close(self.chip)
+
+
+class SimulatedGpio:
+    """
+    In-memory stand-in for LgpioBackend, for running the server off the Pi.
+
+    Levels are changed with set_level() (or the pulse/press helpers), and edge callbacks
+    fire on the calling thread with a time.monotonic_ns() tick, like lgpio's alert thread would.
+    """
+
+    def __init__(self):
+        self._levels = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def claim_input(self, pin, idle_level=1):
+        self._levels.setdefault(pin, idle_level)
+
+    def claim_alert(self, pin, idle_level=1):
+        self._levels.setdefault(pin, idle_level)
+
+    def read(self, pin):
+        return self._levels.get(pin, 1)
+
+    def add_edge_callback(self, pin, func):
+        self._callbacks.setdefault(pin, []).append(func)
+        return func
+
+    def set_level(self, pin, level, tick=None):
+        with self._lock:
+            if self._levels.get(pin) == level:
+                return
+            self._levels[pin] = level
+        tick = time.monotonic_ns() if tick is None else tick
+        for func in self._callbacks.get(pin, ()):
+            func(level, tick)
+
+    def inject_pulses(self, pin, count, width_ms=30, gap_ms=15):
+        """Plays `count` LOW pulses on `pin` from a background thread, like a coin acceptor does."""
+        def run():
+            for i in range(count):
+                self.set_level(pin, 0)
+                time.sleep(width_ms / 1000)
+                self.set_level(pin, 1)
+                if i < count - 1:
+                    time.sleep(gap_ms / 1000)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def press_button(self, pin, hold_seconds=0.2):
+        """Holds `pin` HIGH for `hold_seconds` from a background thread."""
+        def run():
+            self.set_level(pin, 1)
+            time.sleep(hold_seconds)
+            self.set_level(pin, 0)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self._callbacks.clear()
+
+
+def open_gpio_backend(name=None, chip_number=0):
+    """Returns the GPIO backend selected by `name` or the CHANGEOMATIC_GPIO env variable ("lgpio" or "sim")."""
+    name = name or os.environ.get("CHANGEOMATIC_GPIO", "lgpio")
+    if name == "sim":
+        return SimulatedGpio()
+    return LgpioBackend(chip_number)
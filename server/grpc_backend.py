@@ -0,0 +1,395 @@
+import asyncio
+import math
+
+import grpc
+from kaspy.protos import rpc_pb2
+from kaspy.protos.messages_pb2 import KaspadMessage
+from kaspy.protos.messages_pb2_grpc import RPCStub
+
+from kaspa_tx import (TransactionError, Utxo, address_of_secret, build_transaction, sign_transaction,
+                      transaction_id)
+from log_setup import get_logger
+from payout_backend import InProcessPayoutBackend, sompi_to_kaspa_string
+
+logger = get_logger("payout")
+
+# How the node rejects a transaction it already has; a double spend is "already spent by transaction ..."
+ALREADY_SUBMITTED = ("is already in the mempool", "was already accepted")
+# Transport failures: the call is retried on the next node (InvalidStateError: the stream had ended)
+CONNECTION_ERRORS = (grpc.RpcError, ConnectionError, OSError, asyncio.TimeoutError, asyncio.InvalidStateError)
+
+
+class NodeError(Exception):
+    """An error the node answered with, e.g. a rejected transaction."""
+
+
+class NodeUnreachableError(ConnectionError):
+    """No node could be reached."""
+
+
+class NodeConnection:
+    """
+    One gRPC MessageStream to a node.
+
+    The stream answers requests in order, so a connection handles one call at a time; the
+    stream is (re)opened by the first call after it failed.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.channel = None
+        self.stream = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self):
+        return self._lock.locked()
+
+    async def call(self, name, message):
+        """Sends the `name`Request message (e.g. "getInfo") and returns the node's `name`Response."""
+        async with self._lock:
+            try:
+                if self.stream is None or self.stream.done():
+                    self.channel = grpc.aio.insecure_channel(self.target)
+                    self.stream = RPCStub(self.channel).MessageStream()
+                await self.stream.write(KaspadMessage(**{f"{name}Request": message}))
+                while True:
+                    response = await self.stream.read()
+                    if response is grpc.aio.EOF:
+                        raise ConnectionError(f"{self.target} closed the stream")
+                    if response.WhichOneof("payload") == f"{name}Response":
+                        break
+            except BaseException:
+                self.discard()  # A late answer would go to the next call
+                raise
+        payload = getattr(response, f"{name}Response")
+        if payload.error.message:
+            raise NodeError(payload.error.message)
+        return payload
+
+    def discard(self):
+        if self.channel is not None:
+            asyncio.ensure_future(self.channel.close())
+        self.channel = None
+        self.stream = None
+
+
+class Node:
+    def __init__(self, target, connections):
+        self.target = target
+        self.connections = [NodeConnection(target) for _ in range(connections)]
+        self.healthy = False
+        self.latency = None  # Seconds the last health check took
+        self.detail = "not checked yet"
+        self.checked_at = None
+
+    def __repr__(self):
+        return f"Node({self.target!r}, healthy={self.healthy})"
+
+
+class NodePool:
+    """
+    Connections to several Kaspa nodes, health-checked in the background, with failover.
+
+    Every `health_interval` seconds each node gets a getInfo call: it is healthy if it answers,
+    is synced and has the UTXO index, and the call's time ranks it. Calls go to the fastest
+    healthy node, on the least busy of its connections, then to the other nodes in order. A
+    transport failure marks the node unhealthy and moves the call to the next node; an error
+    the node answers with (NodeError) is raised as it is.
+    """
+
+    def __init__(self, targets, connections_per_node=2, health_interval=10, call_timeout=10):
+        """
+        :param targets: "host:port" of the nodes' gRPC interfaces (16110 on mainnet), in order of preference.
+        :param connections_per_node: Streams opened to each node, so a slow call does not hold up the others.
+        :param call_timeout: Seconds before a call counts as failed and is retried on the next node.
+        """
+        self.nodes = [Node(target, connections_per_node) for target in targets]
+        self.health_interval = health_interval
+        self.call_timeout = call_timeout
+        self._checker = None
+
+    @property
+    def healthy(self):
+        return any(node.healthy for node in self.nodes)
+
+    def best(self):
+        return self.ordered()[0] if self.nodes else None
+
+    def ordered(self):
+        """The nodes in the order calls try them: healthy ones first, fastest first, then preference."""
+        return sorted(self.nodes, key=lambda node: (not node.healthy, node.latency if node.healthy else math.inf))
+
+    def describe(self):
+        return "; ".join(f"{node.target}: {node.detail}" for node in self.nodes)
+
+    async def start(self):
+        """Checks every node once, then keeps checking them in the background."""
+        await self.check_all()
+        if self._checker is None:
+            self._checker = asyncio.create_task(self._check_periodically())
+
+    async def close(self):
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+        for node in self.nodes:
+            for connection in node.connections:
+                connection.discard()
+
+    async def check_all(self):
+        await asyncio.gather(*(self._check(node) for node in self.nodes))
+
+    async def call(self, name, message, timeout=None):
+        """
+        Calls `name` on the best node that answers.
+
+        :raises NodeError: if the node answered with an error.
+        :raises NodeUnreachableError: if no node could be reached.
+        """
+        errors = []
+        for node in self.ordered():
+            connection = min(node.connections, key=lambda connection: connection.busy)
+            try:
+                return await asyncio.wait_for(connection.call(name, message), timeout or self.call_timeout)
+            except CONNECTION_ERRORS as e:
+                self._mark_down(node, e)
+                errors.append(f"{node.target}: {node.detail}")
+                logger.warning(f"{name} failed on {node.target} ({node.detail}), trying the next node")
+        raise NodeUnreachableError("; ".join(errors) or "no nodes configured")
+
+    async def _check(self, node):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            info = await asyncio.wait_for(node.connections[0].call("getInfo", rpc_pb2.GetInfoRequestMessage()),
+                                          self.call_timeout)
+        except (NodeError, *CONNECTION_ERRORS) as e:
+            self._mark_down(node, e)
+            return
+        was_healthy = node.healthy
+        node.latency = loop.time() - started
+        node.checked_at = loop.time()
+        node.healthy = info.isSynced and info.isUtxoIndexed
+        node.detail = (f"{info.serverVersion}, {node.latency * 1000:.0f} ms" if node.healthy
+                       else "not synced" if not info.isSynced else "no UTXO index")
+        if node.healthy != was_healthy:
+            logger.info(f"Kaspa node {node.target} is {'healthy' if node.healthy else 'unhealthy'}: {node.detail}")
+
+    @staticmethod
+    def _mark_down(node, error):
+        node.detail = (error.details() if isinstance(error, grpc.aio.AioRpcError)
+                       else "timed out" if isinstance(error, asyncio.TimeoutError) else str(error)) or type(error).__name__
+        if node.healthy:
+            logger.warning(f"Kaspa node {node.target} is unhealthy: {node.detail}")
+        node.healthy = False
+
+    async def _check_periodically(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_all()
+
+
+def _utxo(entry):
+    utxo_entry = entry.utxoEntry
+    return Utxo(entry.outpoint.transactionId, entry.outpoint.index, utxo_entry.amount,
+                utxo_entry.scriptPublicKey.version, bytes.fromhex(utxo_entry.scriptPublicKey.scriptPublicKey),
+                utxo_entry.blockDaaScore, utxo_entry.isCoinbase)
+
+
+def _rpc_transaction(tx):
+    return rpc_pb2.RpcTransaction(
+        version=tx.version,
+        inputs=[rpc_pb2.RpcTransactionInput(
+            previousOutpoint=rpc_pb2.RpcOutpoint(transactionId=tx_input.utxo.transaction_id, index=tx_input.utxo.index),
+            signatureScript=tx_input.signature_script.hex(),
+            sequence=tx_input.sequence,
+            sigOpCount=tx_input.sig_op_count,
+        ) for tx_input in tx.inputs],
+        outputs=[rpc_pb2.RpcTransactionOutput(
+            amount=output.amount,
+            scriptPublicKey=rpc_pb2.RpcScriptPublicKey(version=output.script_version, scriptPublicKey=output.script.hex()),
+        ) for output in tx.outputs],
+        lockTime=tx.lock_time,
+        subnetworkId=tx.subnetwork_id.hex(),
+        gas=tx.gas,
+        payload=tx.payload.hex(),
+    )
+
+
+class GrpcPayoutBackend(InProcessPayoutBackend):
+    """
+    Pays out from this process over the nodes' gRPC interface, without the Node worker.
+
+    Builds and signs the transactions itself (kaspa_tx.py) and sends them through a NodePool,
+    so a node going down fails over to the next one. A submission retried on another node is
+    the same signed transaction, so it cannot pay twice. Keeps the wallet's UTXOs cached and
+    refreshed in the background like the worker does; the fee rate is configured, since the
+    gRPC interface has no fee estimate.
+    """
+
+    def __init__(self, nodes, private_key, network="mainnet", fee_rate=1.0, connections_per_node=2,
+                 health_interval=10, utxo_max_age=60, confirm_checks=15, on_state=None):
+        """
+        :param nodes: "host:port" of the nodes, see NodePool.
+        :param private_key: Hot wallet private key, 64 hex digits (as in KASPA_PRIVATE_KEY).
+        :param network: "mainnet" or "testnet-<n>".
+        :param fee_rate: Sompi per gram of transaction mass (1 is the minimum relay fee).
+        :param utxo_max_age: Seconds the cached UTXOs are used for before a payout refetches them.
+        :param confirm_checks: Seconds to wait for the confirmation before reporting the payout pending.
+        """
+        prefix = "kaspa" if network == "mainnet" else "kaspatest"
+        super().__init__(network_prefix=prefix, on_state=on_state)
+        if not nodes:
+            raise ValueError("No Kaspa nodes configured for the gRPC payout backend")
+        try:
+            self.secret = bytes.fromhex(private_key)
+            self.source_address = address_of_secret(self.secret, prefix)
+        except (ValueError, TransactionError):
+            raise ValueError("KASPA_PRIVATE_KEY is missing or not a 64 digit hex key") from None
+        self.fee_rate = fee_rate
+        self.utxo_max_age = utxo_max_age
+        self.confirm_checks = confirm_checks
+        self.pool = NodePool(nodes, connections_per_node=connections_per_node, health_interval=health_interval)
+        self.utxos = {}  # outpoint -> Utxo of the hot wallet
+        self.reserved = set()  # Outpoints spent by our submitted transactions, until the node stops listing them
+        self.utxos_at = None
+        self._warmer = None
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    async def connect(self):
+        await self.pool.start()
+        self._warmer = asyncio.create_task(self._keep_warm())
+        if not self.pool.healthy:
+            logger.warning(f"No healthy Kaspa node yet, payouts fail until one is: {self.pool.describe()}")
+            return f"no healthy node yet ({len(self.pool.nodes)} configured)"
+        return f"gRPC via {self.pool.best().target}"
+
+    async def close(self):
+        if self._warmer is not None:
+            self._warmer.cancel()
+            self._warmer = None
+        await self.pool.close()
+
+    async def refresh_utxos(self):
+        response = await self.pool.call("getUtxosByAddresses",
+                                        rpc_pb2.GetUtxosByAddressesRequestMessage(addresses=[self.source_address]))
+        utxos = [_utxo(entry) for entry in response.entries]
+        self.utxos = {utxo.outpoint: utxo for utxo in utxos if not utxo.is_coinbase}
+        self.reserved &= set(self.utxos)
+        self.utxos_at = self._now()
+
+    async def _keep_warm(self):
+        while True:
+            if self.pool.healthy:
+                try:
+                    await self.refresh_utxos()
+                except (NodeError, NodeUnreachableError) as e:
+                    logger.warning(f"Wallet cache refresh failed: {e}")
+            await asyncio.sleep(self.pool.health_interval)
+
+    async def send(self, request, outputs):
+        try:
+            if not self.pool.healthy:
+                await self.pool.check_all()
+            if not self.pool.healthy:
+                raise NodeUnreachableError(self.pool.describe())
+            if self.utxos_at is None or self._now() - self.utxos_at > self.utxo_max_age:
+                await self.refresh_utxos()
+        except (NodeError, NodeUnreachableError) as e:
+            request.log(f"Node unreachable: {e}", "error", offline=True)
+            return False
+        spendable = [utxo for outpoint, utxo in self.utxos.items() if outpoint not in self.reserved]
+        if not spendable:
+            request.log("No UTXOs found for address", "error")
+            return False
+
+        total = sum(output.sompi for output in outputs)
+        if len(outputs) == 1:
+            request.log(f"Attempting to send {outputs[0].amount} KASPA ({total} sompi) to {outputs[0].address}",
+                        "info", "connect")
+        else:
+            request.log(f"Attempting to send {total} sompi to {len(outputs)} addresses in one transaction", "info", "connect")
+        try:
+            tx = build_transaction(spendable, [(output.address, output.sompi) for output in outputs],
+                                   self.source_address, self.fee_rate)
+        except TransactionError as e:
+            request.log(f"Transaction creation failed: {e}", "error")
+            return False
+
+        if request.cancelled:
+            request.log("Payout cancelled before submission.", "error")
+            return False
+        request.signing = True
+        request.log(f"Signing transaction ({len(tx.inputs)} inputs, fee {sompi_to_kaspa_string(tx.fee)} KAS)...",
+                    "info", "build")
+        await asyncio.to_thread(sign_transaction, tx, self.secret)  # Pure Python, about 20 ms per input
+
+        request.log("Submitting transaction...", "info", "sign")
+        txid = transaction_id(tx)
+        try:
+            response = await self.pool.call("submitTransaction", rpc_pb2.SubmitTransactionRequestMessage(
+                transaction=_rpc_transaction(tx), allowOrphan=False))
+        except NodeError as e:
+            self.utxos_at = None  # The cache may be out of date (e.g. inputs already spent): refetch next time
+            if not any(reason in str(e) for reason in ALREADY_SUBMITTED):  # Not e.g. "already spent"
+                request.log(f"Transaction rejected: {e}", "error")
+                return False
+            # A node that failed after accepting it passed it on; the retry found it already there
+            logger.info(f"Transaction {txid} was already accepted: {e}")
+        except NodeUnreachableError as e:
+            self.utxos_at = None
+            request.log(f"Node unreachable: {e}", "error", offline=True)
+            return False
+        else:
+            if response.transactionId != txid:
+                logger.warning(f"Node reported TXID {response.transactionId}, computed {txid}")
+                txid = response.transactionId
+        self.reserved.update(tx_input.utxo.outpoint for tx_input in tx.inputs)
+        self.submitted(outputs, txid)
+        request.log(f"Transaction sent. TXID: {txid}. Waiting for confirmation...", "info", "submit", txid=txid)
+
+        addresses = list(dict.fromkeys(output.address for output in outputs))
+        for _ in range(self.confirm_checks):  # Once per second
+            try:
+                if await self.check(addresses, [txid]):
+                    request.log(f"Transaction confirmed! TXID: {txid}", "success", "confirm", txid=txid)
+                    return True
+            except (NodeError, NodeUnreachableError) as e:
+                logger.info(f"Confirmation check failed: {e}")
+            await asyncio.sleep(1)
+
+        paid = [{"address": output.address, "amount": output.amount} for output in outputs]
+        request.log("Transaction unconfirmed! Don't worry - I will keep checking in the background "
+                    "and resend if needed.", "warn")
+        request.log(f"Pending TXID: {txid}", "pending", txid=txid, **paid[0], outputs=paid)
+        return False
+
+    async def check(self, addresses=(), txids=()):
+        response = await self.pool.call("getUtxosByAddresses",
+                                        rpc_pb2.GetUtxosByAddressesRequestMessage(addresses=list(addresses)))
+        wanted = set(txids)
+        return list(dict.fromkeys(entry.outpoint.transactionId for entry in response.entries
+                                  if entry.outpoint.transactionId in wanted))
+
+    async def status(self):
+        info = await self.pool.call("getInfo", rpc_pb2.GetInfoRequestMessage())
+        return info.isSynced
+
+    async def wallet(self):
+        spendable = [utxo for outpoint, utxo in self.utxos.items() if outpoint not in self.reserved]
+        best = self.pool.best()
+        return {
+            "utxos": len(spendable),
+            "reserved": len(self.reserved),
+            "balance": sompi_to_kaspa_string(sum(utxo.amount for utxo in spendable)),
+            "presplit": None,
+            "fee_rate": self.fee_rate,
+            "synced": self.pool.healthy,
+            "subscribed": False,
+            "utxo_age": None if self.utxos_at is None else self._now() - self.utxos_at,
+            "status_age": None if best is None or best.checked_at is None else self._now() - best.checked_at,
+            "node": best.target if best is not None and best.healthy else None,
+        }
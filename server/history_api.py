@@ -0,0 +1,117 @@
+"""
+HTTP API over the HistoryStore, for reconciling the takings:
+
+    GET /payouts?since=&until=&kiosk=&address=&status=&txid=&limit=100&cursor=
+    GET /coins?since=&until=&kiosk=&limit=100&cursor=
+    GET /totals/daily?since=&until=&kiosk=
+    GET /totals/coins?since=&until=&kiosk=
+    GET /export/payouts.csv, /export/payouts.jsonl, /export/coins.csv, /export/coins.jsonl (same filters, no paging)
+
+`since` and `until` are unix times or ISO 8601 dates/datetimes (local time); for the totals
+they are days, both included. Listings are newest first and return {"items": [...], "next": cursor},
+with a null "next" on the last page. Exports stream every matching row.
+"""
+import asyncio
+import csv
+import io
+import json
+
+from history_store import COIN_COLUMNS, PAYOUT_COLUMNS, HistoryError
+from log_setup import get_logger
+
+logger = get_logger("history")
+
+EXPORT_COLUMNS = {
+    "payouts": [column for column in PAYOUT_COLUMNS if column not in ("amount_sompi", "collected_cents")]
+    + ["amount", "collected_amount"],
+    "coins": [column for column in COIN_COLUMNS if column != "amount_cents"] + ["amount"],
+}
+
+
+def create_history_app(store):
+    """The FastAPI app serving `store`. Its endpoints are plain functions, so the queries run on the thread pool."""
+    from fastapi import FastAPI, HTTPException
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI(title="Change-o-matic history")
+
+    def query(func, **kwargs):
+        try:
+            return func(**kwargs)
+        except HistoryError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @app.get("/payouts")
+    def list_payouts(since: str = None, until: str = None, kiosk: str = None, address: str = None,
+                     status: str = None, txid: str = None, limit: int = 100, cursor: str = None):
+        items, next_cursor = query(store.payouts, since=since, until=until, kiosk=kiosk, address=address,
+                                   status=status, txid=txid, limit=limit, cursor=cursor)
+        return {"items": items, "next": next_cursor}
+
+    @app.get("/coins")
+    def list_coins(since: str = None, until: str = None, kiosk: str = None, limit: int = 100, cursor: str = None):
+        items, next_cursor = query(store.coins, since=since, until=until, kiosk=kiosk, limit=limit, cursor=cursor)
+        return {"items": items, "next": next_cursor}
+
+    @app.get("/totals/daily")
+    def daily_totals(since: str = None, until: str = None, kiosk: str = None):
+        return query(store.daily_totals, since=since, until=until, kiosk=kiosk)
+
+    @app.get("/totals/coins")
+    def coin_counts(since: str = None, until: str = None, kiosk: str = None):
+        return query(store.coin_counts, since=since, until=until, kiosk=kiosk)
+
+    @app.get("/export/{table}.{format}")
+    def export(table: str, format: str, since: str = None, until: str = None, kiosk: str = None,
+               address: str = None, status: str = None, txid: str = None):
+        if table not in EXPORT_COLUMNS or format not in ("csv", "jsonl"):
+            raise HTTPException(status_code=404, detail="no such export")
+        filters = {"since": since, "until": until, "kiosk": kiosk}
+        if table == "payouts":
+            filters.update(address=address, status=status, txid=txid)
+        query(store.payouts if table == "payouts" else store.coins, limit=1, **filters)  # A bad filter is a 400, not a cut stream
+        rows = (store.iter_payouts if table == "payouts" else store.iter_coins)(**filters)
+        return StreamingResponse(export_lines(rows, format, EXPORT_COLUMNS[table]),
+                                 media_type="text/csv" if format == "csv" else "application/x-ndjson",
+                                 headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'})
+
+    return app
+
+
+def export_lines(rows, format, columns):
+    """The rows as CSV (with a header) or JSON lines, a chunk of lines at a time."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, extrasaction="ignore") if format == "csv" else None
+    if writer is not None:
+        writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + "\n")
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def create_history_server(store, host, port):
+    """The uvicorn server for the history API. Importing fastapi takes a while, so it is built off the loop."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(create_history_app(store), host=host, port=port, lifespan="off",
+                                           log_config=None, access_log=False))
+    server.install_signal_handlers = lambda: None  # Ctrl+C is the main script's
+    return server
+
+
+async def serve_history(store, host="127.0.0.1", port=8766):
+    """Serves the history API on the running event loop until cancelled. Needs fastapi and uvicorn."""
+    try:
+        server = await asyncio.to_thread(create_history_server, store, host, port)
+    except ImportError as e:
+        logger.error(f"History API not started: {e}")
+        return
+    logger.info(f"History API running on http://{host}:{port}")
+    await server.serve()
@@ -0,0 +1,128 @@
+"""
+Measures the history store: write throughput, and query and export latency on a big history.
+
+    python3 history_benchmark.py [--days 365] [--coins-per-day 2000] [--payouts-per-day 200] [--kiosks 2]
+                                 [--repeat 20] [--no-http]
+
+Fills a temporary database with `--days` days of coins and payouts through HistoryStore's
+writer thread (as the server records them), then times the daily totals and per-denomination
+counts over the last 30 days and the whole history, the first and a deep page of payouts by
+time, address and status, and a full CSV export. Unless --no-http, it also serves the history
+API with uvicorn and times the same over HTTP.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+
+from history_store import HistoryStore, local_day
+
+COINS = [0.05, 0.10, 0.20, 0.50, 1.00, 2.00]
+
+
+def fill(store, days, coins_per_day, payouts_per_day, kiosks, rng):
+    start = time.time() - days * 86400
+    addresses = [f"kaspa:q{index:060d}" for index in range(500)]
+    records = 0
+    for day in range(days):
+        for index in range(coins_per_day):
+            store.record_coin(f"kiosk-{index % kiosks}", rng.choice(COINS), at=start + day * 86400 + index * 86400 / coins_per_day)
+        for index in range(payouts_per_day):
+            key = f"{day:05d}-{index:05d}"
+            at = start + day * 86400 + index * 86400 / payouts_per_day
+            store.record_payout(key, f"kiosk-{index % kiosks}", rng.choice(addresses), f"{rng.uniform(1, 400):.8f}",
+                                quote={"collected_amount": 12.5, "kaspa_price": 0.1, "usd_to_aud": 1.5}, at=at)
+            store.update_payout(key, rng.choices(["confirmed", "failed", "held"], [97, 2, 1])[0], txid=f"{day * 100000 + index:064x}")
+        records += coins_per_day + payouts_per_day * 2
+    return records, addresses
+
+
+def timed(label, func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"{label:>34}: p50 {times[len(times) // 2] * 1000:8.2f} ms, max {times[-1] * 1000:8.2f} ms")
+    return result
+
+
+def serve(store, port):
+    """Runs the history API on a loop of its own in a background thread."""
+    from history_api import serve_history
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_until_complete, args=(serve_history(store, "127.0.0.1", port),), daemon=True).start()
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/totals/daily?since=2100-01-01").read()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("the history API did not come up")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--coins-per-day", type=int, default=2000)
+    parser.add_argument("--payouts-per-day", type=int, default=200)
+    parser.add_argument("--kiosks", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--port", type=int, default=18766)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-http", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(os.path.join(directory, "history.sqlite3"))
+        store.open()
+        start = time.perf_counter()
+        records, addresses = fill(store, args.days, args.coins_per_day, args.payouts_per_day, args.kiosks,
+                                  random.Random(args.seed))
+        queued = time.perf_counter() - start
+        store.flush()
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(store.path) + os.path.getsize(store.path + "-wal")
+        print(f"{records} records: queued in {queued:.2f} s ({queued / records * 1e6:.1f} us each), "
+              f"written at {records / elapsed:,.0f}/s, {size / 1e6:.0f} MB")
+
+        month = local_day(time.time() - 30 * 86400)
+        _, cursor = store.payouts(limit=5000)
+        deep_cursor = cursor
+        for _ in range(9):
+            _, deep_cursor = store.payouts(limit=5000, cursor=deep_cursor)
+        timed("daily totals, 30 days", lambda: store.daily_totals(since=month), args.repeat)
+        timed(f"daily totals, {args.days} days", lambda: store.daily_totals(), args.repeat)
+        timed("coin counts, 30 days", lambda: store.coin_counts(since=month), args.repeat)
+        timed("payouts, first page", lambda: store.payouts(), args.repeat)
+        timed("payouts, page at 50000", lambda: store.payouts(cursor=deep_cursor), args.repeat)
+        timed("payouts to an address", lambda: store.payouts(address=addresses[7]), args.repeat)
+        timed("held payouts", lambda: store.payouts(status="held"), args.repeat)
+        timed("payout by txid", lambda: store.payouts(txid=f"{12 * 100000 + 34:064x}"), args.repeat)
+        rows = timed("export all payouts (rows)", lambda: sum(1 for _ in store.iter_payouts()), 3)
+        print(f"{'':>34}  {rows} payouts exported")
+
+        if not args.no_http:
+            serve(store, args.port)
+            base = f"http://127.0.0.1:{args.port}"
+
+            def get(path):
+                with urllib.request.urlopen(base + path) as response:
+                    return len(response.read())
+
+            timed("HTTP daily totals, 30 days", lambda: get(f"/totals/daily?since={month}"), args.repeat)
+            timed("HTTP coin counts, 30 days", lambda: get(f"/totals/coins?since={month}"), args.repeat)
+            timed("HTTP payouts, first page", lambda: get("/payouts"), args.repeat)
+            size = timed("HTTP export payouts.csv", lambda: get("/export/payouts.csv"), 3)
+            print(f"{'':>34}  {size / 1e6:.1f} MB streamed")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
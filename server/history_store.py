@@ -0,0 +1,326 @@
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+from log_setup import get_logger
+from payout_backend import kaspa_to_sompi, sompi_to_kaspa_string
+
+logger = get_logger("history")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coins (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    day TEXT NOT NULL,
+    kiosk TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coins_time ON coins (time);
+
+-- Coins per day, kiosk and denomination, kept up to date by the trigger: the totals never read the coins
+CREATE TABLE IF NOT EXISTS coin_days (
+    day TEXT NOT NULL,
+    kiosk TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, kiosk, amount_cents)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS coins_count AFTER INSERT ON coins BEGIN
+    INSERT INTO coin_days VALUES (new.day, new.kiosk, new.amount_cents, 1)
+    ON CONFLICT DO UPDATE SET count = count + 1;
+END;
+
+CREATE TABLE IF NOT EXISTS payouts (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    time REAL NOT NULL,
+    day TEXT NOT NULL,
+    updated REAL NOT NULL,
+    kiosk TEXT NOT NULL,
+    address TEXT NOT NULL,
+    amount_sompi INTEGER NOT NULL,
+    collected_cents INTEGER,
+    kaspa_price REAL,
+    usd_to_aud REAL,
+    status TEXT NOT NULL,
+    txid TEXT
+);
+CREATE INDEX IF NOT EXISTS payouts_time ON payouts (time);
+CREATE INDEX IF NOT EXISTS payouts_address ON payouts (address, time);
+CREATE INDEX IF NOT EXISTS payouts_status ON payouts (status, time);
+CREATE INDEX IF NOT EXISTS payouts_txid ON payouts (txid);
+CREATE INDEX IF NOT EXISTS payouts_day ON payouts (day, kiosk, status, amount_sompi);
+"""
+
+# Payout statuses, in the order a payout can go through them
+PAYOUT_STATUSES = ("started", "queued", "submitted", "confirmed", "failed", "held")
+PAYOUT_COLUMNS = ("id", "key", "time", "updated", "kiosk", "address", "amount_sompi", "collected_cents",
+                  "kaspa_price", "usd_to_aud", "status", "txid")
+COIN_COLUMNS = ("id", "time", "kiosk", "amount_cents")
+
+
+class HistoryError(ValueError):
+    """A history query with a bad filter or cursor."""
+
+
+def local_day(timestamp):
+    """The kiosk's local calendar day of a unix time, as "YYYY-MM-DD"."""
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+
+def parse_time(value):
+    """A unix time from a number or an ISO 8601 date or datetime (local time unless it has an offset)."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HistoryError(f"not a unix time or ISO 8601 date: {value!r}") from None
+
+
+def parse_day(value):
+    """A "YYYY-MM-DD" day from an ISO 8601 date, or None."""
+    if value is None:
+        return None
+    try:
+        return datetime.date.fromisoformat(value[:10]).isoformat()
+    except ValueError:
+        raise HistoryError(f"not an ISO 8601 date: {value!r}") from None
+
+
+class HistoryStore:
+    """
+    Indexed history of coins and payouts in SQLite, for reconciling takings.
+
+    The record_*() and update_*() calls never block: they queue their statement for a writer
+    thread, which commits whatever has queued up in one transaction (WAL mode, so readers are
+    never blocked). Queries run on the caller's thread with a read-only connection per thread,
+    so they can be made from FastAPI's thread pool while the server keeps writing.
+
+    Coins and payouts are stored with their local `day`. A trigger keeps a count of coins per day,
+    kiosk and denomination, and a covering index on (day, kiosk, status, amount) sums the payouts,
+    so the daily totals never read the tables themselves. Listings are paged with keyset cursors
+    on (time, id), newest first, so a page costs the same however far back it is.
+    """
+
+    def __init__(self, path="history.sqlite3", max_batch=500):
+        """
+        :param path: SQLite database file, created with its schema if missing.
+        :param max_batch: Statements committed in one transaction at most.
+        """
+        self.path = path
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._readers = threading.local()
+        self._thread = None
+        self._flushed = threading.Condition()
+        self._queued = 0
+        self._written = 0
+
+    def open(self):
+        """Creates the schema if needed and starts the writer thread. Blocking, call it off the loop."""
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        self._thread = threading.Thread(target=self._write_loop, args=(connection,), name="history-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Writes what is queued and stops the writer thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def flush(self, timeout=None):
+        """Waits until everything queued so far is committed. Returns False on timeout."""
+        with self._flushed:
+            target = self._queued
+            return self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+    # Writes
+
+    def record_coin(self, kiosk, amount, at=None):
+        """A coin of `amount` AUD inserted at `kiosk`."""
+        at = time.time() if at is None else at
+        self._put("INSERT INTO coins (time, day, kiosk, amount_cents) VALUES (?, ?, ?, ?)",
+                  (at, local_day(at), kiosk, round(amount * 100)))
+
+    def record_payout(self, key, kiosk, address, amount, quote=None, status="started", at=None):
+        """
+        A payout of `amount` KAS to `address`, identified by `key` from then on.
+
+        :param quote: collected_amount (AUD), kaspa_price and usd_to_aud the amount was computed from.
+        """
+        at = time.time() if at is None else at
+        quote = quote or {}
+        collected = quote.get("collected_amount")
+        self._put("INSERT OR IGNORE INTO payouts (key, time, day, updated, kiosk, address, amount_sompi, "
+                  "collected_cents, kaspa_price, usd_to_aud, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  (key, at, local_day(at), at, kiosk, address, kaspa_to_sompi(amount) or 0,
+                   None if collected is None else round(collected * 100),
+                   quote.get("kaspa_price"), quote.get("usd_to_aud"), status))
+
+    def update_payout(self, key, status, txid=None):
+        """Moves the payout to `status`, keeping its txid if `txid` is None."""
+        self._put("UPDATE payouts SET status = ?, txid = COALESCE(?, txid), updated = ? WHERE key = ?",
+                  (status, txid, time.time(), key))
+
+    def update_payouts_by_txid(self, txids, status):
+        """Moves the payouts sent in any of `txids` (a resubmitted payout has several) to `status`."""
+        for txid in txids:
+            self._put("UPDATE payouts SET status = ?, updated = ? WHERE txid = ?", (status, time.time(), txid))
+
+    def _put(self, sql, params):
+        with self._flushed:
+            self._queued += 1
+        self._queue.put((sql, params))
+
+    def _write_loop(self, connection):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            try:
+                with connection:
+                    for sql, params in batch:
+                        connection.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error(f"Could not write {len(batch)} history records: {e}")
+            with self._flushed:
+                self._written += len(batch)
+                self._flushed.notify_all()
+        connection.close()
+
+    # Queries
+
+    def payouts(self, since=None, until=None, kiosk=None, address=None, status=None, txid=None, limit=100, cursor=None):
+        """
+        Payouts made in [since, until), newest first. Returns (rows, next_cursor).
+
+        `next_cursor` is None on the last page; pass it back as `cursor` for the next one.
+        """
+        if status is not None and status not in PAYOUT_STATUSES:
+            raise HistoryError(f"unknown payout status {status!r}")
+        filters = {"kiosk": kiosk, "address": address, "status": status, "txid": txid}
+        rows, next_cursor = self._page("payouts", PAYOUT_COLUMNS, filters, since, until, limit, cursor)
+        for row in rows:
+            row["amount"] = sompi_to_kaspa_string(row.pop("amount_sompi"))
+            collected_cents = row.pop("collected_cents")
+            row["collected_amount"] = None if collected_cents is None else collected_cents / 100
+        return rows, next_cursor
+
+    def coins(self, since=None, until=None, kiosk=None, limit=100, cursor=None):
+        """Coins inserted in [since, until), newest first. Returns (rows, next_cursor)."""
+        rows, next_cursor = self._page("coins", COIN_COLUMNS, {"kiosk": kiosk}, since, until, limit, cursor)
+        for row in rows:
+            row["amount"] = row.pop("amount_cents") / 100
+        return rows, next_cursor
+
+    def iter_payouts(self, batch=1000, **filters):
+        """Every payout matching the filters of payouts(), newest first, fetched a page at a time."""
+        return self._iterate(self.payouts, batch, filters)
+
+    def iter_coins(self, batch=1000, **filters):
+        """Every coin matching the filters of coins(), newest first, fetched a page at a time."""
+        return self._iterate(self.coins, batch, filters)
+
+    def daily_totals(self, since=None, until=None, kiosk=None):
+        """
+        Per local day in [since, until] (ISO dates, inclusive): coins inserted and AUD collected,
+        and per payout status the payouts and KAS paid. Oldest day first.
+        """
+        where, params = self._day_filter(since, until, kiosk)
+        days = {}
+        for day, coins, cents in self._reader().execute(
+                f"SELECT day, SUM(count), SUM(count * amount_cents) FROM coin_days {where} GROUP BY day", params):
+            days[day] = {"day": day, "coins": coins, "collected": cents / 100, "payouts": {}}
+        for day, status, payouts, sompi in self._reader().execute(
+                f"SELECT day, status, COUNT(*), SUM(amount_sompi) FROM payouts {where} GROUP BY day, status", params):
+            totals = days.setdefault(day, {"day": day, "coins": 0, "collected": 0.0, "payouts": {}})
+            totals["payouts"][status] = {"count": payouts, "amount": sompi_to_kaspa_string(sompi)}
+        return [days[day] for day in sorted(days)]
+
+    def coin_counts(self, since=None, until=None, kiosk=None):
+        """Per local day in [since, until] (ISO dates, inclusive), how many coins of each denomination (AUD) came in."""
+        where, params = self._day_filter(since, until, kiosk)
+        days = {}
+        for day, cents, count in self._reader().execute(
+                f"SELECT day, amount_cents, SUM(count) FROM coin_days {where} GROUP BY day, amount_cents", params):
+            days.setdefault(day, {"day": day, "counts": {}})["counts"][f"{cents / 100:.2f}"] = count
+        return [days[day] for day in sorted(days)]
+
+    def _reader(self):
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            connection = self._readers.connection = self._connect(read_only=True)
+        return connection
+
+    def _connect(self, read_only=False):
+        if read_only:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # Coins and payouts are journalled elsewhere first
+        return connection
+
+    def _page(self, table, columns, filters, since, until, limit, cursor):
+        if not 1 <= limit <= 10000:
+            raise HistoryError("limit must be between 1 and 10000")
+        conditions, params = [], []
+        for column, value in filters.items():
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        since, until = parse_time(since), parse_time(until)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(until)
+        if cursor is not None:
+            try:
+                cursor_time, cursor_id = cursor.split("_")
+                params += [float(cursor_time), float(cursor_time), int(cursor_id)]
+            except ValueError:
+                raise HistoryError(f"bad cursor {cursor!r}") from None
+            conditions.append("time <= ? AND (time < ? OR id < ?)")  # The first term bounds the index range
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._reader().execute(
+            f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY time DESC, id DESC LIMIT ?",
+            params + [limit + 1]).fetchall()
+        next_cursor = f"{rows[limit - 1][columns.index('time')]!r}_{rows[limit - 1][0]}" if len(rows) > limit else None
+        return [dict(zip(columns, row)) for row in rows[:limit]], next_cursor
+
+    @staticmethod
+    def _iterate(query, batch, filters):
+        cursor = None
+        while True:
+            rows, cursor = query(limit=batch, cursor=cursor, **filters)
+            yield from rows
+            if cursor is None:
+                return
+
+    @staticmethod
+    def _day_filter(since, until, kiosk):
+        conditions, params = [], []
+        for condition, value in (("day >= ?", parse_day(since)), ("day <= ?", parse_day(until)), ("kiosk = ?", kiosk)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
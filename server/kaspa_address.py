@@ -0,0 +1,124 @@
+import functools
+
+CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+CHARSET_MAP = {c: i for i, c in enumerate(CHARSET)}
+CHECKSUM_LENGTH = 8  # 40 bit checksum, in 5 bit characters
+
+# Address version -> payload length in bytes
+VERSIONS = {
+    0: 32,  # PubKey (Schnorr)
+    1: 33,  # PubKeyECDSA
+    8: 32,  # ScriptHash
+}
+NETWORK_PREFIXES = {"kaspa", "kaspatest", "kaspasim", "kaspadev"}
+
+
+class InvalidAddressError(ValueError):
+    pass
+
+
+def polymod(values):
+    """The cashaddr checksum function Kaspa uses, over 5 bit values."""
+    c = 1
+    for d in values:
+        c0 = c >> 35
+        c = ((c & 0x07ffffffff) << 5) ^ d
+        if c0 & 0x01:
+            c ^= 0x98f2bc8e61
+        if c0 & 0x02:
+            c ^= 0x79b76d99e2
+        if c0 & 0x04:
+            c ^= 0xf33e5fb3c4
+        if c0 & 0x08:
+            c ^= 0xae2eabe2a8
+        if c0 & 0x10:
+            c ^= 0x1e4f43e470
+    return c ^ 1
+
+
+def checksum(prefix, payload):
+    return polymod([ord(c) & 0x1f for c in prefix] + [0] + payload + [0] * CHECKSUM_LENGTH)
+
+
+def convert_bits(data, from_bits, to_bits, pad):
+    """Regroups a list of `from_bits` integers into `to_bits` integers."""
+    acc = 0
+    bits = 0
+    result = []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append((acc >> bits) & max_value)
+    if pad and bits:
+        result.append((acc << (to_bits - bits)) & max_value)
+    elif not pad and (bits >= from_bits or (acc << (to_bits - bits)) & max_value):
+        raise InvalidAddressError("Invalid padding")
+    return result
+
+
+def decode_address(address):
+    """
+    Decodes a Kaspa address ("kaspa:qpp6...") and verifies its checksum.
+
+    :return: (prefix, version, payload bytes)
+    :raises InvalidAddressError: if the address is malformed.
+    """
+    if address.lower() != address and address.upper() != address:
+        raise InvalidAddressError("Mixed case")
+    address = address.lower()
+    prefix, separator, encoded = address.partition(":")
+    if not separator or prefix not in NETWORK_PREFIXES:
+        raise InvalidAddressError(f"Unknown network prefix: {prefix!r}")
+    if len(encoded) <= CHECKSUM_LENGTH:
+        raise InvalidAddressError("Too short")
+
+    try:
+        values = [CHARSET_MAP[c] for c in encoded]
+    except KeyError as e:
+        raise InvalidAddressError(f"Invalid character: {e.args[0]!r}") from None
+
+    payload5, checksum5 = values[:-CHECKSUM_LENGTH], values[-CHECKSUM_LENGTH:]
+    expected = 0
+    for value in checksum5:
+        expected = (expected << 5) | value
+    if checksum(prefix, payload5) != expected:
+        raise InvalidAddressError("Bad checksum")
+
+    payload = convert_bits(payload5, 5, 8, pad=False)
+    version, data = payload[0], bytes(payload[1:])
+    if VERSIONS.get(version) != len(data):
+        raise InvalidAddressError(f"Unknown version {version} for a {len(data)} byte payload")
+    return prefix, version, data
+
+
+def encode_address(prefix, version, data):
+    """The reverse of decode_address()."""
+    payload5 = convert_bits([version] + list(data), 8, 5, pad=True)
+    value = checksum(prefix, payload5)
+    checksum5 = [(value >> 5 * (CHECKSUM_LENGTH - 1 - i)) & 0x1f for i in range(CHECKSUM_LENGTH)]
+    return prefix + ":" + "".join(CHARSET[v] for v in payload5 + checksum5)
+
+
+def address_from_qr(code):
+    """The address part of a scanned code: wallets may add whitespace or a "?amount=..." query."""
+    return code.strip().split("?", 1)[0]
+
+
+@functools.lru_cache(maxsize=256)
+def is_valid_kaspa_address(address, network_prefix="kaspa"):
+    """
+    Validates a Kaspa address: network prefix, character set, checksum, version and payload length.
+
+    Results are cached, since the reader keeps reporting the same code while it is in view.
+
+    Returns:
+        True if valid, False otherwise.
+    """
+    try:
+        prefix, _, _ = decode_address(address)
+    except InvalidAddressError:
+        return False
+    return prefix == network_prefix
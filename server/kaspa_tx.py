@@ -0,0 +1,363 @@
+import hashlib
+import os
+
+from kaspa_address import decode_address, encode_address
+
+SOMPI_PER_KASPA = 100_000_000
+SUBNETWORK_ID_NATIVE = bytes(20)
+SIGHASH_ALL = 0x01
+
+# Mass parameters of the Kaspa mainnet consensus
+MASS_PER_TX_BYTE = 1
+MASS_PER_SCRIPT_PUB_KEY_BYTE = 10
+MASS_PER_SIG_OP = 1000
+STORAGE_MASS_PARAMETER = SOMPI_PER_KASPA * 10_000
+MAX_STANDARD_MASS = 100_000
+
+SIGNATURE_SCRIPT_LENGTH = 66  # OP_DATA_65, 64 byte Schnorr signature, sighash type
+MAX_INPUTS = 10
+MIN_CHANGE = SOMPI_PER_KASPA // 5  # Smaller change is left to the fee: its storage mass would cost more than it is worth
+
+# secp256k1
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+
+class TransactionError(ValueError):
+    pass
+
+
+class InsufficientFundsError(TransactionError):
+    pass
+
+
+class Utxo:
+    """An unspent output of the wallet, as getUtxosByAddresses returns it."""
+
+    __slots__ = ("transaction_id", "index", "amount", "script_version", "script", "block_daa_score", "is_coinbase")
+
+    def __init__(self, transaction_id, index, amount, script_version, script, block_daa_score=0, is_coinbase=False):
+        self.transaction_id = transaction_id  # Hex
+        self.index = index
+        self.amount = amount  # Sompi
+        self.script_version = script_version
+        self.script = script  # bytes
+        self.block_daa_score = block_daa_score
+        self.is_coinbase = is_coinbase
+
+    @property
+    def outpoint(self):
+        return f"{self.transaction_id}:{self.index}"
+
+
+class TxInput:
+    __slots__ = ("utxo", "signature_script", "sequence", "sig_op_count")
+
+    def __init__(self, utxo, signature_script=b"", sequence=0, sig_op_count=1):
+        self.utxo = utxo
+        self.signature_script = signature_script
+        self.sequence = sequence
+        self.sig_op_count = sig_op_count
+
+
+class TxOutput:
+    __slots__ = ("amount", "script_version", "script")
+
+    def __init__(self, amount, script_version, script):
+        self.amount = amount
+        self.script_version = script_version
+        self.script = script
+
+
+class Transaction:
+    """A native Kaspa transaction: version 0, no lock time, gas or payload."""
+
+    def __init__(self, inputs, outputs):
+        self.version = 0
+        self.inputs = inputs
+        self.outputs = outputs
+        self.lock_time = 0
+        self.subnetwork_id = SUBNETWORK_ID_NATIVE
+        self.gas = 0
+        self.payload = b""
+
+    @property
+    def fee(self):
+        return sum(tx_input.utxo.amount for tx_input in self.inputs) - sum(output.amount for output in self.outputs)
+
+
+def pay_to_address_script(address):
+    """The (script version, script public key) paying `address`."""
+    _, version, data = decode_address(address)
+    if version == 0:  # Schnorr public key: OP_DATA_32 <key> OP_CHECKSIG
+        return 0, b"\x20" + data + b"\xac"
+    if version == 1:  # ECDSA public key: OP_DATA_33 <key> OP_CHECKSIGECDSA
+        return 0, b"\x21" + data + b"\xab"
+    # Script hash: OP_BLAKE2B OP_DATA_32 <hash> OP_EQUAL
+    return 0, b"\xaa\x20" + data + b"\x87"
+
+
+# BIP340 Schnorr signatures over secp256k1, as Kaspa uses them
+
+def _point_add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a[0] == b[0] and a[1] != b[1]:
+        return None
+    if a == b:
+        slope = 3 * a[0] * a[0] * pow(2 * a[1], -1, P) % P
+    else:
+        slope = (b[1] - a[1]) * pow(b[0] - a[0], -1, P) % P
+    x = (slope * slope - a[0] - b[0]) % P
+    return x, (slope * (a[0] - x) - a[1]) % P
+
+
+def _point_mul(point, scalar):
+    result = None
+    while scalar:
+        if scalar & 1:
+            result = _point_add(result, point)
+        point = _point_add(point, point)
+        scalar >>= 1
+    return result
+
+
+def _tagged_hash(tag, data):
+    tag_hash = hashlib.sha256(tag.encode()).digest()
+    return hashlib.sha256(tag_hash + tag_hash + data).digest()
+
+
+def _lift_x(x):
+    if x >= P:
+        return None
+    y_squared = (pow(x, 3, P) + 7) % P
+    y = pow(y_squared, (P + 1) // 4, P)
+    if pow(y, 2, P) != y_squared:
+        return None
+    return x, y if y % 2 == 0 else P - y
+
+
+def schnorr_public_key(secret):
+    """The 32 byte x-only public key of a 32 byte secret key."""
+    d = int.from_bytes(secret, "big")
+    if not 0 < d < N:
+        raise TransactionError("Invalid private key")
+    return _point_mul(G, d)[0].to_bytes(32, "big")
+
+
+def schnorr_sign(secret, message, aux_rand=None):
+    """BIP340 signature of a 32 byte message."""
+    d0 = int.from_bytes(secret, "big")
+    if not 0 < d0 < N:
+        raise TransactionError("Invalid private key")
+    public = _point_mul(G, d0)
+    d = d0 if public[1] % 2 == 0 else N - d0
+    aux_rand = os.urandom(32) if aux_rand is None else aux_rand
+    t = (d ^ int.from_bytes(_tagged_hash("BIP0340/aux", aux_rand), "big")).to_bytes(32, "big")
+    public_x = public[0].to_bytes(32, "big")
+    k0 = int.from_bytes(_tagged_hash("BIP0340/nonce", t + public_x + message), "big") % N
+    if k0 == 0:
+        raise TransactionError("Nonce is zero, sign again")
+    r = _point_mul(G, k0)
+    k = k0 if r[1] % 2 == 0 else N - k0
+    r_x = r[0].to_bytes(32, "big")
+    e = int.from_bytes(_tagged_hash("BIP0340/challenge", r_x + public_x + message), "big") % N
+    return r_x + ((k + e * d) % N).to_bytes(32, "big")
+
+
+def schnorr_verify(public_key, message, signature):
+    public = _lift_x(int.from_bytes(public_key, "big"))
+    r = int.from_bytes(signature[:32], "big")
+    s = int.from_bytes(signature[32:], "big")
+    if public is None or r >= P or s >= N:
+        return False
+    e = int.from_bytes(_tagged_hash("BIP0340/challenge", signature[:32] + public_key + message), "big") % N
+    point = _point_add(_point_mul(G, s), _point_mul(public, N - e))
+    return point is not None and point[1] % 2 == 0 and point[0] == r
+
+
+def address_of_secret(secret, prefix="kaspa"):
+    """The Schnorr pay-to-public-key address of a private key, like PrivateKey.toAddress() in the Kaspa SDK."""
+    return encode_address(prefix, 0, schnorr_public_key(secret))
+
+
+# Signature hash (SigHashAll) and mass, following rusty-kaspa's consensus code
+
+class _SigningHasher:
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=32, key=b"TransactionSigningHash")
+
+    def update(self, data):
+        self._hash.update(data)
+        return self
+
+    def u8(self, value):
+        return self.update(value.to_bytes(1, "little"))
+
+    def u16(self, value):
+        return self.update(value.to_bytes(2, "little"))
+
+    def u32(self, value):
+        return self.update(value.to_bytes(4, "little"))
+
+    def u64(self, value):
+        return self.update(value.to_bytes(8, "little"))
+
+    def var_bytes(self, data):
+        return self.u64(len(data)).update(data)
+
+    def outpoint(self, utxo):
+        return self.update(bytes.fromhex(utxo.transaction_id)).u32(utxo.index)
+
+    def script_public_key(self, version, script):
+        return self.u16(version).var_bytes(script)
+
+    def digest(self):
+        return self._hash.digest()
+
+
+def signature_hash(tx, input_index):
+    """The SigHashAll message input `input_index` signs."""
+    previous_outputs = _SigningHasher()
+    sequences = _SigningHasher()
+    sig_op_counts = _SigningHasher()
+    for tx_input in tx.inputs:
+        previous_outputs.outpoint(tx_input.utxo)
+        sequences.u64(tx_input.sequence)
+        sig_op_counts.u8(tx_input.sig_op_count)
+    outputs = _SigningHasher()
+    for output in tx.outputs:
+        outputs.u64(output.amount).script_public_key(output.script_version, output.script)
+    payload_hash = bytes(32) if tx.subnetwork_id == SUBNETWORK_ID_NATIVE and not tx.payload \
+        else _SigningHasher().var_bytes(tx.payload).digest()
+
+    tx_input = tx.inputs[input_index]
+    utxo = tx_input.utxo
+    return (_SigningHasher()
+            .u16(tx.version)
+            .update(previous_outputs.digest())
+            .update(sequences.digest())
+            .update(sig_op_counts.digest())
+            .outpoint(utxo)
+            .script_public_key(utxo.script_version, utxo.script)
+            .u64(utxo.amount)
+            .u64(tx_input.sequence)
+            .u8(tx_input.sig_op_count)
+            .update(outputs.digest())
+            .u64(tx.lock_time)
+            .update(tx.subnetwork_id)
+            .u64(tx.gas)
+            .update(payload_hash)
+            .u8(SIGHASH_ALL)
+            .digest())
+
+
+def transaction_id(tx):
+    """The transaction's id (hex): its hash without the signature scripts, so signing does not change it."""
+    hasher = hashlib.blake2b(digest_size=32, key=b"TransactionID")
+    hasher.update(tx.version.to_bytes(2, "little") + len(tx.inputs).to_bytes(8, "little"))
+    for tx_input in tx.inputs:
+        hasher.update(bytes.fromhex(tx_input.utxo.transaction_id) + tx_input.utxo.index.to_bytes(4, "little"))
+        hasher.update(bytes(8) + tx_input.sequence.to_bytes(8, "little"))  # Empty signature script
+    hasher.update(len(tx.outputs).to_bytes(8, "little"))
+    for output in tx.outputs:
+        hasher.update(output.amount.to_bytes(8, "little") + output.script_version.to_bytes(2, "little"))
+        hasher.update(len(output.script).to_bytes(8, "little") + output.script)
+    hasher.update(tx.lock_time.to_bytes(8, "little") + tx.subnetwork_id + tx.gas.to_bytes(8, "little"))
+    hasher.update(len(tx.payload).to_bytes(8, "little") + tx.payload)
+    return hasher.hexdigest()
+
+
+def sign_transaction(tx, secret):
+    """Signs every input (all must pay to the secret's public key)."""
+    for index, tx_input in enumerate(tx.inputs):
+        signature = schnorr_sign(secret, signature_hash(tx, index))
+        tx_input.signature_script = b"\x41" + signature + bytes([SIGHASH_ALL])
+
+
+def compute_mass(tx, signature_script_length=SIGNATURE_SCRIPT_LENGTH):
+    """Mass from the transaction's size, output scripts and signature operations (inputs counted as signed)."""
+    size = 2 + 8 + 8 + 8 + len(SUBNETWORK_ID_NATIVE) + 8 + 32 + 8 + len(tx.payload)
+    size += len(tx.inputs) * (32 + 4 + 8 + signature_script_length + 8)
+    size += sum(8 + 2 + 8 + len(output.script) for output in tx.outputs)
+    script_mass = sum(2 + len(output.script) for output in tx.outputs) * MASS_PER_SCRIPT_PUB_KEY_BYTE
+    sig_op_mass = sum(tx_input.sig_op_count for tx_input in tx.inputs) * MASS_PER_SIG_OP
+    return size * MASS_PER_TX_BYTE + script_mass + sig_op_mass
+
+
+def storage_mass(tx):
+    """
+    KIP-9 storage mass: outputs cost C/amount, inputs give back C/mean input amount each.
+
+    Uses the arithmetic mean for the inputs in every case, which is never less than the
+    consensus value, so the fee is never too low.
+    """
+    outputs = sum(STORAGE_MASS_PARAMETER // output.amount for output in tx.outputs)
+    input_total = sum(tx_input.utxo.amount for tx_input in tx.inputs)
+    inputs = len(tx.inputs) * (STORAGE_MASS_PARAMETER // (input_total // len(tx.inputs)))
+    return max(0, outputs - inputs)
+
+
+def transaction_mass(tx):
+    return max(compute_mass(tx), storage_mass(tx))
+
+
+def select_inputs(utxos, needed, max_inputs=MAX_INPUTS):
+    """The smallest single UTXO that covers `needed` (a pre-split one, ideally), else the largest ones until they do."""
+    ascending = sorted(utxos, key=lambda utxo: utxo.amount)
+    for utxo in ascending:
+        if utxo.amount >= needed:
+            return [utxo]
+    inputs = []
+    total = 0
+    for utxo in reversed(ascending[-max_inputs:]):
+        inputs.append(utxo)
+        total += utxo.amount
+        if total >= needed:
+            break
+    return inputs
+
+
+def build_transaction(utxos, payments, change_address, fee_rate=1.0):
+    """
+    Builds an unsigned transaction paying `payments` ([(address, sompi)]) from `utxos`.
+
+    The change goes back to `change_address`; the fee is the transaction's mass times
+    `fee_rate` (sompi per gram).
+
+    :raises InsufficientFundsError: if the UTXOs cannot cover the payments and the fee.
+    :raises TransactionError: if the transaction would be over the standard mass limit.
+    """
+    outputs = [TxOutput(amount, *pay_to_address_script(address)) for address, amount in payments]
+    total = sum(amount for _, amount in payments)
+    change_script = pay_to_address_script(change_address)
+    # Some room for the fee, so a single pre-split UTXO is only picked if it also covers that
+    inputs = [TxInput(utxo) for utxo in select_inputs(utxos, total + total // 100 + 100_000)]
+    input_total = sum(tx_input.utxo.amount for tx_input in inputs)
+    if input_total < total:
+        raise InsufficientFundsError(f"The wallet has {input_total} sompi in {len(inputs)} inputs, "
+                                     f"{total} sompi needed")
+
+    tx = Transaction(inputs, outputs)
+    fee = 0
+    for _ in range(5):  # The change's storage mass depends on the fee, which depends on the mass
+        change = input_total - total - fee
+        tx.outputs = outputs + ([TxOutput(change, *change_script)] if change >= MIN_CHANGE else [])
+        new_fee = int(transaction_mass(tx) * fee_rate + 0.999999)
+        if new_fee == fee:
+            break
+        fee = new_fee
+    if input_total < total + fee:
+        raise InsufficientFundsError(f"The wallet has {input_total} sompi in {len(inputs)} inputs, "
+                                     f"{total + fee} sompi needed with the fee")
+    change = input_total - total - fee
+    tx.outputs = outputs + ([TxOutput(change, *change_script)] if change >= MIN_CHANGE else [])
+    mass = transaction_mass(tx)
+    if mass > MAX_STANDARD_MASS:
+        raise TransactionError(f"Transaction mass {mass} is over the standard limit of {MAX_STANDARD_MASS} "
+                               "(payouts too small, or too many inputs)")
+    return tx
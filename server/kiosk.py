@@ -0,0 +1,143 @@
+import time
+
+from broadcaster import Broadcaster
+from log_setup import get_logger
+from screen_machine import BUTTON, HOLD
+
+logger = get_logger()
+gpio_logger = get_logger("gpio")
+
+DEFAULT_KIOSK_ID = "main"
+
+
+class Kiosk:
+    """
+    One coin machine and its customer session.
+
+    Holds what used to be module globals in click-socket.py: the machine's GPIO pins, QR reader,
+    coin decoder and button debounce state, the session (screen, inserted money, scanned
+    address) with its journal, and the websocket clients showing this machine. One server can
+    run several kiosks; the price oracle and the payout worker are shared between them.
+
+    `machine` is the kiosk's ScreenMachine, set up by the server; `screen` follows it. The
+    hardware is attached after startup, so the UI can be served before GPIO and I2C are up.
+    """
+
+    def __init__(self, kiosk_id, journal, button_pin=17, coin_pin=22, calibration_file="coin_calibration.json",
+                 delivery_histogram=None):
+        """
+        :param kiosk_id: Name the UI connects with (ws://host:8765/?kiosk=<id>).
+        :param journal: SessionJournal of this machine's session.
+        :param calibration_file: Coin calibration of this machine's acceptor, loaded with the hardware.
+        """
+        self.id = kiosk_id
+        self.journal = journal
+        self.button_pin = button_pin
+        self.coin_pin = coin_pin
+        self.calibration_file = calibration_file
+        # Set by attach_hardware(), once the server is already serving the recovered session
+        self.gpio = None
+        self.code_reader = None
+        self.decoder = None
+        self.calibration = None
+        self.broadcaster = Broadcaster(delivery_histogram=delivery_histogram)
+        self.machine = None
+        self.scan_task = None
+        self.payout_task = None
+
+        self.screen = "welcome"
+        self.collected_amount = 0
+        self.payout_amount = 0  # AUD of the payout in flight, taken off collected_amount when it settles
+        self.recipient_address = ""
+        self.interrupted_payout = None  # Journalled payout a crash cut short, until the server holds it in the outbox
+
+        # Button debounce state
+        self.last_press_time = 0
+        self.button_released = True
+        self.press_then_release_handled = True
+
+    def __repr__(self):
+        return f"Kiosk({self.id!r})"
+
+    def recover(self):
+        """Restores the session from the journal. Returns the number of journal events replayed."""
+        recovery_start = time.perf_counter()
+        replayed = self.journal.recover()
+        state = self.journal.state
+        logger.info(f"[{self.id}] Recovered session in {(time.perf_counter() - recovery_start) * 1000:.1f} ms "
+                    f"({replayed} journal events): {state.to_dict()}")
+        self.collected_amount = state.collected_amount
+        self.recipient_address = state.recipient_address
+        if state.payout is not None:
+            # It may have gone out, so its money is not offered again; the server holds it for a wallet check
+            get_logger("payout").error(
+                f"[{self.id}] A payout of {state.payout['amount']} KAS to {state.payout['address']} "
+                "was interrupted and its outcome is unknown: holding it until the wallet is checked")
+            self.interrupted_payout = state.payout
+            self.payout_amount = state.payout.get("collected", state.collected_amount)
+            self.collected_amount = round(state.collected_amount - self.payout_amount, 2)
+            self.recipient_address = ""
+        self.screen = state.screen
+        if self.screen in ("scan-wallet", "processing", "receipt"):  # A scan or payout in progress cannot be resumed
+            self.screen = "confirm-amount" if self.collected_amount > 0 else "welcome"
+        return replayed
+
+    def attach_hardware(self, gpio, code_reader, decoder, calibration):
+        """
+        :param gpio: GPIO backend the button and coin acceptor are wired to (may be shared with other kiosks).
+        :param code_reader: TinyCodeReader of this machine.
+        :param decoder: CoinPulseDecoder for the coin acceptor, with `calibration` applied.
+        """
+        self.gpio = gpio
+        self.code_reader = code_reader
+        self.decoder = decoder
+        self.calibration = calibration
+        self.claim_pins()
+
+    def claim_pins(self):
+        """Claims the button pin (the coin pin is claimed for alerts by the coin listener)."""
+        self.gpio.claim_input(self.button_pin, idle_level=0)
+
+    def read_button(self, debounce_interval, hold_interval):
+        """
+        Polls the button with debounce. Returns the screen machine event it makes: BUTTON for a
+        press, HOLD once it was held for `hold_interval` seconds (on release), or None.
+        """
+        try:
+            current_state = self.gpio.read(self.button_pin) == 1  # Button pressed if HIGH
+            if current_state and self.button_released and (time.time() - self.last_press_time > debounce_interval):
+                self.last_press_time = time.time()
+                self.button_released = False  # Mark button as pressed
+                self.press_then_release_handled = False
+                return BUTTON
+            elif not current_state:
+                if not self.press_then_release_handled and (time.time() - self.last_press_time > hold_interval):
+                    self.press_then_release_handled = True
+                    gpio_logger.info(f"[{self.id}] hold button detected for interval of:"
+                                     f"{time.time() - self.last_press_time}")
+                    return HOLD
+                self.button_released = True  # Move this after checking the hold condition
+                self.last_press_time = time.time()  # Reset last_press_time on release
+            return None
+        except Exception as e:
+            gpio_logger.warning(f"[{self.id}] GPIO Error: {e}")
+            return None
+
+    def set_screen(self, screen):
+        self.screen = screen
+        self.journal.append("screen", screen=screen)
+
+    def publish(self, event, data):
+        """Queues an event for this kiosk's websocket clients. Returns the encoded message."""
+        return self.broadcaster.publish(event, data)
+
+    def cancel_scan(self):
+        if self.scan_task is not None:
+            self.scan_task.cancel()
+            self.scan_task = None
+
+    def close(self):
+        """Closes the QR reader and the journal. Call on shutdown, after the loop stopped."""
+        if self.code_reader is not None:
+            self.code_reader.close()
+        self.journal.close()
@@ -0,0 +1,203 @@
+import collections
+import json
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOGGER_NAME = "MyLogger"
+SUBSYSTEMS = ("gpio", "ws", "payout", "price", "qr", "history", "loop")
+
+
+def get_logger(subsystem=None):
+    """The server logger, or the child logger of one subsystem (e.g. "gpio")."""
+    return logging.getLogger(f"{LOGGER_NAME}.{subsystem}" if subsystem else LOGGER_NAME)
+
+
+class TimestampCache:
+    """Formats record times as "%Y-%m-%d %H:%M:%S.mmm", building the seconds part once per second."""
+
+    def __init__(self):
+        self._second = None
+        self._prefix = ""
+
+    def format(self, created):
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        return f"{self._prefix}.{int((created - second) * 1000):03d}"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, subsystem, message and any `extra={"fields": {...}}`."""
+
+    def __init__(self):
+        super().__init__()
+        self._timestamps = TimestampCache()
+
+    def format(self, record):
+        entry = {
+            "ts": self._timestamps.format(record.created),
+            "level": record.levelname,
+            "subsystem": record.name[len(LOGGER_NAME) + 1:] or "main",
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class CustomFormatter(logging.Formatter):
+    """Human readable console format: [time] [LEVEL] message."""
+
+    def __init__(self):
+        super().__init__()
+        self._timestamps = TimestampCache()
+
+    def format(self, record):
+        return f"[{self._timestamps.format(record.created)}] [{record.levelname}] {record.getMessage()}"
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that flushes to the SD card at most every `flush_interval` seconds.
+
+    Warnings and errors are flushed straight away. flush_pending() writes out whatever is
+    buffered; the QueueListener calls it when the queue goes quiet.
+    """
+
+    def __init__(self, *args, flush_interval=1.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._force_flush = False
+
+    def emit(self, record):
+        self._force_flush = record.levelno >= logging.WARNING
+        super().emit(record)
+
+    def flush(self):
+        if self._force_flush or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush_pending()
+
+    def flush_pending(self):
+        super().flush()
+        self._last_flush = time.monotonic()
+
+
+class LoopQueueHandler(QueueHandler):
+    """
+    Puts records on the queue without formatting them.
+
+    The stdlib QueueHandler formats every record in the caller so it can be pickled; the
+    listener here runs in the same process, so all formatting is left to its thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class FlushingQueueListener(QueueListener):
+    """QueueListener that flushes batched handlers whenever no record arrived for `flush_interval`."""
+
+    def __init__(self, log_queue, *handlers, flush_interval=1.0):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    if isinstance(handler, BatchedRotatingFileHandler):
+                        handler.flush_pending()
+
+    def stop(self):
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+            handler.close()
+
+
+def parse_levels(spec):
+    """Parses "gpio=DEBUG,ws=WARNING" into {"gpio": logging.DEBUG, "ws": logging.WARNING}."""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        subsystem, _, level = item.partition("=")
+        levels[subsystem.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def setup_logging(log_file, max_bytes, backup_count, levels=None, flush_interval=1.0, console=True):
+    """
+    Routes the server logger through a queue to a background thread.
+
+    Logging calls on the event loop only append to the queue. The listener thread writes JSON
+    lines to a rotating `log_file` (flushed in batches) and a readable line to the console.
+
+    :param levels: Per-subsystem levels, e.g. {"gpio": logging.WARNING}. Defaults to the
+                   CHANGEOMATIC_LOG_LEVELS env variable ("gpio=DEBUG,ws=WARNING").
+    :param console: Also write readable lines to stderr.
+    :return: The started listener; stop() it on shutdown to flush the last records.
+    """
+    if levels is None:
+        levels = parse_levels(os.environ.get("CHANGEOMATIC_LOG_LEVELS", ""))
+
+    file_handler = BatchedRotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                              encoding="utf-8", flush_interval=flush_interval)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(CustomFormatter())
+        handlers.append(console_handler)
+
+    # Skip collecting caller/thread/process details for every record: nothing we write uses them
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    log_queue = queue.SimpleQueue()
+    logger = get_logger()
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(LoopQueueHandler(log_queue))
+    for subsystem in SUBSYSTEMS:
+        get_logger(subsystem).setLevel(levels.get(subsystem, logging.INFO))
+
+    listener = FlushingQueueListener(log_queue, *handlers, flush_interval=flush_interval)
+    listener.start()
+    return listener
+
+
+class TraceBuffer:
+    """
+    Ring buffer of recent hot-path events (e.g. coin edges), kept instead of logging each one.
+
+    record() only appends a tuple. dump() writes the buffered events to a logger, for when
+    something goes wrong (e.g. an unknown coin signal), and every `sample_every`-th event can
+    optionally be logged at DEBUG as it happens.
+    """
+
+    def __init__(self, logger, size=256, sample_every=0):
+        self.logger = logger
+        self.events = collections.deque(maxlen=size)
+        self.sample_every = sample_every
+        self._count = 0
+
+    def record(self, event, *values):
+        self.events.append((time.monotonic_ns(), event, values))
+        self._count += 1
+        if self.sample_every and self._count % self.sample_every == 0:
+            self.logger.debug("trace %s %s", event, values)
+
+    def dump(self, reason):
+        self.logger.info(f"{reason} (last {len(self.events)} trace events attached)",
+                         extra={"fields": {"trace": [[ns, event, list(values)] for ns, event, values in self.events]}})
+        self.events.clear()
@@ -0,0 +1,62 @@
+"""
+Measures what a logger.info() call costs the calling thread (i.e. the event loop).
+
+    python3 logging_benchmark.py [--records 20000]
+
+Compares the old setup (RotatingFileHandler written and flushed in the caller) with
+log_setup.setup_logging() (records queued, formatted and written by a background thread).
+Log files go to a temporary directory.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+from log_setup import get_logger, setup_logging
+
+MESSAGE = '{"event": "submit-log", "data": {"type": "INFO", "message": "Submitting transaction..."}, "seq": 42}'
+
+
+class OldFormatter(logging.Formatter):
+    def format(self, record):
+        record.asctime = self.formatTime(record, "%Y-%m-%d %H:%M:%S.%f")[:-3]
+        return f"[{record.asctime}] [{record.levelname}] {record.getMessage()}"
+
+
+def time_calls(logger, records):
+    start = time.perf_counter()
+    for _ in range(records):
+        logger.info(MESSAGE)
+    return (time.perf_counter() - start) / records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        old_logger = logging.getLogger("benchmark.old")
+        old_logger.propagate = False
+        old_logger.setLevel(logging.DEBUG)
+        handler = RotatingFileHandler(os.path.join(directory, "old.log"), maxBytes=1024 * 1024, backupCount=2, encoding="utf-8")
+        handler.setFormatter(OldFormatter())
+        old_logger.addHandler(handler)
+        old = time_calls(old_logger, args.records)
+        handler.close()
+
+        listener = setup_logging(os.path.join(directory, "new.log"), 1024 * 1024, 2, console=False)
+        new = time_calls(get_logger("ws"), args.records)
+        drain_start = time.perf_counter()
+        listener.stop()
+        drain = time.perf_counter() - drain_start
+
+    print(f"synchronous RotatingFileHandler: {old * 1e6:7.2f} us per call")
+    print(f"queued (log_setup):              {new * 1e6:7.2f} us per call ({old / new:.1f}x less)")
+    print(f"background thread drained the backlog in {drain * 1e3:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
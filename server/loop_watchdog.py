@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import html
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+
+from log_setup import get_logger
+
+logger = get_logger("loop")
+
+
+class ForwardToLoopLogger(logging.Handler):
+    """Sends asyncio's own log records (e.g. debug mode's slow callback reports) to the "loop" logger."""
+
+    def emit(self, record):
+        record.name = logger.name
+        logger.handle(record)
+
+
+def frame_label(code):
+    """A frame as "function (file:line)", the usual collapsed-stack label."""
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_stack(thread_id):
+    """The frames the thread is running, outermost first, or [] if it is gone."""
+    frame = sys._current_frames().get(thread_id)
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def describe_running(loop, frames):
+    """What `loop` is running in its thread's `frames`: the task being stepped or the callback, or None."""
+    task = asyncio.current_task(loop)
+    if task is not None:
+        coro = task.get_coro()
+        return f"task {task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+    for frame in reversed(frames):
+        if frame.f_code.co_name == "_run" and frame.f_code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+            return f"callback {frame.f_locals.get('self')!r}"
+    return None
+
+
+class LoopWatchdog:
+    """
+    Detects the event loop being blocked, and captures what blocked it.
+
+    A callback on the loop stamps a heartbeat every `interval` seconds, and a watchdog thread
+    checks it. Once the heartbeat is `threshold` seconds late, the thread takes the loop thread's
+    stack (the callback or task step that is running, down to the blocking call) and, when the
+    loop runs again, the stall's duration goes to `stall_histogram` and the stack to the log.
+    A stall longer than `hang_after` seconds is logged right away from the thread too.
+
+    With `slow_callbacks` the loop also runs in asyncio debug mode, which logs every callback
+    that takes longer than `threshold` (debug mode slows the loop down, so only for diagnosis).
+    """
+
+    def __init__(self, threshold=0.1, interval=None, hang_after=5, stall_histogram=None, slow_callbacks=False,
+                 on_stall=None):
+        """
+        :param threshold: Seconds the loop may be blocked before it counts as a stall.
+        :param interval: Seconds between heartbeats and checks (a quarter of `threshold` by default).
+        :param stall_histogram: Optional Histogram of the stall durations.
+        :param on_stall: Optional callable(seconds, running, stack) called on the loop after each stall.
+        """
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self.hang_after = hang_after
+        self.stall_histogram = stall_histogram
+        self.slow_callbacks = slow_callbacks
+        self.on_stall = on_stall
+        self.stalls = 0
+        self.loop = None
+        self.loop_thread_id = None
+        self._beat = 0.0
+        self._handle = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts watching the running loop."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        if self.slow_callbacks:
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.threshold
+            asyncio_logger = logging.getLogger("asyncio")
+            if not any(isinstance(handler, ForwardToLoopLogger) for handler in asyncio_logger.handlers):
+                asyncio_logger.addHandler(ForwardToLoopLogger())
+                asyncio_logger.propagate = False
+        self._heartbeat()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _heartbeat(self):
+        self._beat = time.monotonic()
+        self._handle = self.loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval) and not self.loop.is_closed():
+            beat = self._beat
+            if time.monotonic() - beat < self.threshold:
+                continue
+            frames = thread_stack(self.loop_thread_id)
+            running = describe_running(self.loop, frames)
+            stack = [frame_label(frame.f_code) for frame in frames]
+            del frames
+            hung = False
+            while self._beat == beat and not self._stop.wait(self.interval) and not self.loop.is_closed():
+                if not hung and time.monotonic() - beat > self.hang_after:
+                    hung = True
+                    logger.error(f"Event loop blocked for over {self.hang_after} s, in {running or 'unknown'}",
+                                 extra={"fields": {"stack": stack}})
+            if self._beat != beat and not self.loop.is_closed():
+                # Blocked from when the heartbeat was due until it ran
+                seconds = self._beat - beat - self.interval
+                self.loop.call_soon_threadsafe(self._stalled, seconds, running, stack)
+
+    def _stalled(self, seconds, running, stack):
+        self.stalls += 1
+        if self.stall_histogram is not None:
+            self.stall_histogram.observe(seconds)
+        logger.warning(f"Event loop blocked for {seconds * 1000:.0f} ms, in {running or 'unknown'}",
+                       extra={"fields": {"stack": stack}})
+        if self.on_stall is not None:
+            self.on_stall(seconds, running, stack)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop's) every `interval` seconds from a thread of its own.
+
+    The samples are counted per stack, and written in the collapsed-stack format (one
+    "outer;...;inner count" line per stack, as read by flamegraph.pl and speedscope) or as a
+    self-contained flame graph SVG. Frames inside the selector's wait show up as the loop being idle.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.seconds = 0.0  # Sampled so far
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None):
+        """Starts sampling, for `duration` seconds or until stop()."""
+        self.stacks.clear()
+        self.samples = 0
+        self.seconds = 0.0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(duration,), name="loop-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Ends sampling early. Does not wait for the sampling thread, join() does."""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _sample(self, duration):
+        codes = {}  # code object -> label, formatted once
+        start = time.monotonic()
+        deadline = start + duration if duration is not None else None
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                code = frame.f_code
+                label = codes.get(code)
+                if label is None:
+                    label = codes[code] = frame_label(code)
+                labels.append(label)
+                frame = frame.f_back
+            if labels:
+                labels.reverse()
+                self.stacks[";".join(labels)] += 1
+                self.samples += 1
+            self.seconds = time.monotonic() - start
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+    def top(self, count=10):
+        """The `count` innermost frames the thread spent most samples in, as (label, samples)."""
+        leaves = collections.Counter()
+        for stack, samples in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += samples
+        return leaves.most_common(count)
+
+    def write(self, path, format="folded"):
+        """Writes the samples to `path` as collapsed stacks ("folded") or a flame graph ("svg")."""
+        with open(path, "w", encoding="utf-8") as f:
+            if format == "svg":
+                f.write(flame_graph_svg(self.stacks, f"{self.samples} samples over {self.seconds:.1f} s"))
+            else:
+                for stack, samples in self.stacks.most_common():
+                    f.write(f"{stack} {samples}\n")
+
+
+def flame_graph_svg(stacks, title, width=1200, row_height=16):
+    """A flame graph of collapsed `stacks` ({"outer;...;inner": samples}) as a standalone SVG."""
+    root = {"samples": 0, "children": {}}
+    for stack, samples in stacks.items():
+        root["samples"] += samples
+        node = root
+        for label in stack.split(";"):
+            node = node["children"].setdefault(label, {"samples": 0, "children": {}})
+            node["samples"] += samples
+
+    rects = []
+    depth_max = 0
+
+    def layout(node, x, depth):
+        nonlocal depth_max
+        depth_max = max(depth_max, depth)
+        for label, child in sorted(node["children"].items()):
+            child_width = width * child["samples"] / root["samples"]
+            if child_width >= 0.5:
+                rects.append((x, depth, child_width, label, child["samples"]))
+                layout(child, x, depth + 1)
+            x += child_width
+
+    if root["samples"]:
+        layout(root, 0.0, 0)
+    height = (depth_max + 2) * row_height + 24
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+             f'<text x="4" y="16">{html.escape(title)}</text>']
+    for x, depth, rect_width, label, samples in rects:
+        y = height - (depth + 1) * row_height
+        hue = 10 + zlib.crc32(label.encode()) % 50
+        text = html.escape(label[:int(rect_width / 7)]) if rect_width > 21 else ""
+        parts.append(f'<g><title>{html.escape(label)} ({samples} samples, {100 * samples / root["samples"]:.1f}%)</title>'
+                     f'<rect x="{x:.1f}" y="{y}" width="{rect_width:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+                     f'<text x="{x + 3:.1f}" y="{y + row_height - 4}">{text}</text></g>')
+    parts.append("</svg>\n")
+    return "\n".join(parts)
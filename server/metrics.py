@@ -0,0 +1,158 @@
+import asyncio
+import bisect
+
+from log_setup import get_logger
+
+logger = get_logger("ws")
+
+# Seconds; covers sub-millisecond loop work up to slow payouts
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, label_values)) + "}"
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram, optionally split by labels."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                labels = format_labels(self.label_names + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        """Count, mean and bucket-estimated p50/p99 for each label set."""
+        result = {}
+        for label_values, series in self._series.items():
+            counts = series[:-1]
+            total = sum(counts)
+            result[",".join(map(str, label_values)) or "all"] = {
+                "count": total,
+                "mean": series[-1] / total if total else None,
+                "p50": self._quantile(counts, total, 0.5),
+                "p99": self._quantile(counts, total, 0.99),
+            }
+        return result
+
+    def _quantile(self, counts, total, q):
+        if not total:
+            return None
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= q * total:
+                return bound
+        return float("inf")
+
+
+class Gauge:
+    """A value that is set directly, or read from `func` (returning {label values: value}) when rendered."""
+
+    def __init__(self, name, help_text, label_names=(), func=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.func = func
+        self._values = {}
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def values(self):
+        return self.func() if self.func is not None else self._values
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self.values().items():
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+    def snapshot(self):
+        return {",".join(map(str, label_values)) or "all": value for label_values, value in self.values().items()}
+
+
+class MetricsRegistry:
+    """The server's metrics, rendered as Prometheus text or as a compact dict for the websocket."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, label_names=(), func=None):
+        return self.metrics.setdefault(name, Gauge(name, help_text, label_names, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+async def serve_metrics(registry, host="127.0.0.1", port=9108):
+    """Serves GET /metrics in the Prometheus text format. Returns the asyncio server."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass  # Skip the headers
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render()
+            else:
+                status, body = "404 Not Found", "Not found\n"
+            payload = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\n"
+                         f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics endpoint running on http://{host}:{port}/metrics")
+    return server
+
+
+async def measure_loop_lag(histogram, gauge, interval=0.5):
+    """Records how late the event loop wakes up from a sleep: anything above 0 is time it was blocked."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        histogram.observe(lag)
+        gauge.set(lag)
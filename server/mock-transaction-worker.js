@@ -0,0 +1,209 @@
+const readline = require("readline");
+
+// Mock of install/transaction-worker.js: same stdin/stdout protocol, no node or wallet needed.
+// --delay-factor=N stretches every step N times, to simulate a slow node.
+// Batches ({"outputs": [...]}) take as long as a single payout, like one real multi-output transaction.
+// --confirm-after=S makes transactions confirm only S seconds after submission, so payouts end up
+// pending and the server's payout tracker has to check them.
+// --offline-for=S makes the node unreachable for the first S seconds: status checks fail and payouts
+// fail with "offline": true, like the real worker when it cannot reach its node.
+// The wallet cache is mocked too: a warm cache skips the UTXO lookup, which costs 300 ms (times the delay
+// factor) when it is cold or with --no-wallet-cache. --presplit-count=N keeps N payout-sized UTXOs.
+const argValue = name => {
+    const arg = process.argv.find(arg => arg.startsWith(`--${name}=`));
+    return arg ? Number(arg.split("=")[1]) : undefined;
+};
+const delayFactor = argValue("delay-factor") ?? 1;
+const confirmAfter = (argValue("confirm-after") ?? 0) * 1000;
+const offlineUntil = Date.now() + (argValue("offline-for") ?? 0) * 1000;
+const isOnline = () => Date.now() >= offlineUntil;
+const walletCache = !process.argv.includes("--no-wallet-cache");
+const presplitCount = argValue("presplit-count") ?? 0;
+const sleep = ms => new Promise(res => setTimeout(res, ms * delayFactor));
+const submittedAt = new Map();  // txid -> submission time
+
+// `phase` marks the end of a payout step (connect, build, sign, submit, confirm), for the server's metrics
+function log(message, level = "info", id = null, phase = undefined, fields = {}) {
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: level, message, id, phase, ...fields }));
+}
+
+const WARM_MAX_AGE_MS = 60 * 1000;
+const wallet = { utxos: 20, presplit: presplitCount, utxosAt: 0, statusAt: 0 };
+
+// Refreshes the mocked cache in the background, like keepWalletWarm() in the real worker
+async function keepWalletWarm() {
+    while (walletCache) {
+        if (isOnline()) {
+            wallet.utxosAt = wallet.statusAt = Date.now();
+            if (wallet.presplit < presplitCount / 2) {
+                wallet.utxos += presplitCount - wallet.presplit;
+                wallet.presplit = presplitCount;
+                log(`Split UTXOs off the wallet, ${wallet.presplit} payout-sized now`);
+            }
+        }
+        await new Promise(res => setTimeout(res, 10 * 1000));
+    }
+}
+
+const isConfirmed = txid => submittedAt.has(txid) && Date.now() - submittedAt.get(txid) >= confirmAfter;
+const submittedKeys = new Map();  // idempotency key -> txid
+
+// Same checks as the real worker; a mock address is valid if it starts with "kaspa"
+function checkOutput(id, { address, amount, key }, index) {
+    const fields = index === undefined ? {} : { output: index };
+    if (key && submittedKeys.has(key)) {
+        const txid = submittedKeys.get(key);
+        log(`Payout ${key} was already submitted, TXID: ${txid}`, "error", id, undefined, { ...fields, duplicate: true, txid });
+        return null;
+    }
+    if (!amount) {
+        log("Missing amount.", "error", id, undefined, fields);
+        return null;
+    }
+    const amountSompi = Math.round(Number(amount) * 100000000);
+    if (!(amountSompi > 0)) {
+        log("Invalid amount. Must be greater than zero.", "error", id, undefined, fields);
+        return null;
+    }
+    if (typeof address !== "string" || !address.startsWith("kaspa")) {
+        log(`Invalid address: ${address}`, "error", id, undefined, fields);
+        return null;
+    }
+    return { address, amount, amountSompi, key };
+}
+
+async function sendKaspaTransaction(id, outputs) {
+    const info = (message, level = "info", phase = undefined, fields = {}) => log(message, level, id, phase, fields);
+    if (!outputs.length) {
+        info("No valid outputs to send.", "error");
+        return false;
+    }
+
+    if (!isOnline()) {
+        await sleep(300);
+        info("Node unreachable: mock node is offline", "error", undefined, { offline: true });
+        return false;
+    }
+
+    if (!walletCache || Date.now() - wallet.utxosAt > WARM_MAX_AGE_MS) {
+        await sleep(300);  // UTXO lookup and sync check
+        wallet.utxosAt = walletCache ? Date.now() : 0;
+    }
+    const totalSompi = outputs.reduce((total, output) => total + output.amountSompi, 0);
+    info(`Attempting to send ${totalSompi} sompi to ${outputs.length} address(es)`, "info", "connect");
+    await sleep(300);
+
+    if (cancelledRequests.has(id)) {
+        info("Payout cancelled before submission.", "error");
+        return false;
+    }
+    signingRequests.add(id);  // Too late to cancel from here on
+
+    info("Signing transaction...", "info", "build");
+    await sleep(400);
+
+    info("Submitting transaction...", "info", "sign");
+    await sleep(500);
+
+    const txid = String(Math.round(1000 + Math.random() * 100000));
+    submittedAt.set(txid, Date.now());
+    wallet.utxos = Math.max(1, wallet.utxos - 1);  // Change comes back as a new UTXO, except for a pre-split input
+    if (wallet.presplit > 0)
+        wallet.presplit--;
+    else
+        wallet.utxos++;
+    outputs.filter(output => output.key).forEach(output => submittedKeys.set(output.key, txid));
+    info(`Transaction sent. TXID: ${txid}. Waiting for confirmation...`, "info", "submit", { txid });
+    await sleep(1200);
+
+    if (!isConfirmed(txid)) {
+        const paid = outputs.map(({ address, amount }) => ({ address, amount }));
+        info("Transaction unconfirmed! Don't worry - I will keep checking in the background and resend if needed.", "warn");
+        info(`Pending TXID: ${txid}`, "pending", undefined, { txid, ...paid[0], outputs: paid });
+        return false;
+    }
+    info(`Transaction confirmed! TXID: ${txid}`, "success", "confirm", { txid });
+    return true;
+}
+
+function checkTransactions({ id, txids }) {
+    const result = txids.filter(isConfirmed);
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result }));
+}
+
+function walletStatus({ id }) {
+    const result = {
+        utxos: wallet.utxos, reserved: 0, balance: String(wallet.utxos * 100), presplit: presplitCount > 0 ? wallet.presplit : null,
+        fee_rate: 1, synced: isOnline(), subscribed: walletCache,
+        utxo_age: wallet.utxosAt ? (Date.now() - wallet.utxosAt) / 1000 : null,
+        status_age: wallet.statusAt ? (Date.now() - wallet.statusAt) / 1000 : null,
+    };
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result }));
+}
+
+function checkStatus({ id }) {
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result: isOnline() }));
+}
+
+async function handleRequest(request) {
+    const { id } = request;
+    const batch = Array.isArray(request.outputs);
+    const outputs = batch ? request.outputs : [{ address: request.address, amount: request.amount, key: request.key }];
+    const checked = outputs.map((output, index) => checkOutput(id, output, batch ? index : undefined));
+    const result = await sendKaspaTransaction(id, checked.filter(output => output !== null));
+    activeRequests.delete(id);
+    cancelledRequests.delete(id);
+    signingRequests.delete(id);
+    const perOutput = batch ? { outputs: checked.map(output => output !== null && result) } : {};
+    console.log(JSON.stringify({ timestamp: new Date().toISOString(), type: "result", id, result, ...perOutput }));
+}
+
+let queue = Promise.resolve();
+const activeRequests = new Set();     // queued or running request ids
+const cancelledRequests = new Set();  // {"id": 1, "cancel": true} received before submission
+const signingRequests = new Set();    // past the last cancel check, being signed or submitted
+const input = readline.createInterface({ input: process.stdin });
+input.on("line", (line) => {
+    let request;
+    try {
+        request = JSON.parse(line);
+    } catch (error) {
+        log(`Ignoring malformed request: ${line}`, "warn");
+        return;
+    }
+    if (request.method === "check") {
+        checkTransactions(request);
+        return;
+    }
+    if (request.method === "status") {
+        checkStatus(request);
+        return;
+    }
+    if (request.method === "wallet") {
+        walletStatus(request);
+        return;
+    }
+    if (request.cancel) {
+        // Answered right away: the server needs to know whether the payout may still go out
+        if (signingRequests.has(request.id)) {
+            log("Too late to cancel, the transaction is being signed or was sent.", "warn", request.id, undefined, { cancelled: false });
+            return;
+        }
+        if (activeRequests.has(request.id))
+            cancelledRequests.add(request.id);
+        log("Cancel accepted, the payout will not be submitted.", "info", request.id, undefined, { cancelled: true });
+        return;
+    }
+    activeRequests.add(request.id);
+    queue = queue.then(() => handleRequest(request));
+});
+input.on("close", async () => {
+    await queue;
+    process.exit(0);
+});
+
+sleep(300).then(() => {
+    log(`Connected to mock-rpc-client`);
+    log("Transaction worker ready", "ready");
+    keepWalletWarm();
+});
@@ -0,0 +1,431 @@
+import asyncio
+import collections
+import itertools
+import os
+from decimal import Decimal, InvalidOperation, ROUND_DOWN
+
+from kaspa_address import is_valid_kaspa_address
+from log_setup import get_logger
+
+logger = get_logger("payout")
+
+TERMINAL_TYPE = "result"
+SOMPI_PER_KASPA = 100_000_000
+MAX_SUBMITTED_KEYS = 10000
+
+
+class PayoutBackend:
+    """
+    What the payout batcher, outbox and tracker need from whatever sends the transactions.
+
+    payout() and payout_batch() return async generators of log entries ({"type": "info" |
+    "warn" | "error" | "pending" | "success", "message": ..., "phase": ...}) that end with a
+    {"type": "result", "result": ...} entry. "phase" marks the end of a payout step (connect,
+    build, sign, submit, confirm). An unconfirmed payout gets a "pending" entry with its "txid".
+    With an idempotency key, a payout is never submitted twice: the refusal is an "error" entry
+    with "duplicate": true and the earlier "txid". Failures because the node could not be reached
+    carry "offline": true, and failures after which the payout may still have been submitted
+    (the Node worker exited while handling it) carry "unknown": true. Closing the generator or running past `timeout` cancels the payout if
+    it was not submitted yet.
+
+    request() answers "check" (addresses, txids: the txids that reached the addresses), "status"
+    (whether the node is reachable and synced) and "wallet" (the hot wallet's state, for the
+    metrics), or returns False if the request failed.
+
+    Implementations: TransactionWorker (the Node worker), GrpcPayoutBackend (talks to the nodes
+    from this process) and MockPayoutBackend. open_payout_backend() picks one.
+    """
+
+    on_state = None  # Optional callback(ready, detail), called when the backend becomes ready or goes away
+
+    def start(self):
+        """Starts connecting in the background."""
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    @property
+    def ready(self):
+        """True once the backend takes payouts (they may still fail "offline" if no node is reachable)."""
+        raise NotImplementedError
+
+    def payout(self, address, amount, timeout=None, key=None):
+        """Sends `amount` KAS (a string or number) to `address`."""
+        raise NotImplementedError
+
+    def payout_batch(self, outputs, timeout=None):
+        """
+        Pays several {"address": ..., "amount": ..., "key": ...} outputs in one transaction.
+
+        Entries about a single output carry its "output" index, and the "result" entry adds
+        "outputs", the outcome of each output.
+        """
+        raise NotImplementedError
+
+    async def request(self, method, timeout=None, **params):
+        raise NotImplementedError
+
+    def _notify_state(self, ready, detail):
+        if self.on_state is not None:
+            self.on_state(ready, detail)
+
+
+class PayoutOutput:
+    """One checked output of a payout request."""
+
+    __slots__ = ("address", "amount", "sompi", "key")
+
+    def __init__(self, address, amount, sompi, key=None):
+        self.address = address
+        self.amount = amount
+        self.sompi = sompi
+        self.key = key
+
+
+class PayoutRequest:
+    """A payout being handled in process, and the queue its log entries go to."""
+
+    def __init__(self, request_id):
+        self.id = request_id
+        self.entries = asyncio.Queue()
+        self.cancelled = False  # The caller gave up; honoured until the transaction is signed
+        self.signing = False  # Past the last check of `cancelled`: the payout may go out now
+        self.detached = False  # The caller is gone, later entries are only logged
+
+    def log(self, message, level="info", phase=None, **fields):
+        entry = {"type": level, "message": message, "id": self.id, **fields}
+        if phase is not None:
+            entry["phase"] = phase
+        self.put(entry)
+
+    def put(self, entry):
+        if self.detached:
+            logger.info(f"[{str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+        else:
+            self.entries.put_nowait(entry)
+
+    def fail(self, message, offline=False, unknown=False):
+        self.log(message, "error", **({"offline": True} if offline else {}), **({"unknown": True} if unknown else {}))
+        self.put({"type": TERMINAL_TYPE, "id": self.id, "result": False})
+
+
+def kaspa_to_sompi(amount):
+    """`amount` KAS as integer sompi (extra decimals are cut off), or None if it is not a number."""
+    try:
+        sompi = (Decimal(str(amount)) * SOMPI_PER_KASPA).quantize(Decimal(1), rounding=ROUND_DOWN)
+    except InvalidOperation:
+        return None
+    return int(sompi) if sompi.is_finite() else None
+
+
+def sompi_to_kaspa_string(sompi):
+    return f"{(Decimal(sompi) / SOMPI_PER_KASPA).normalize():f}"
+
+
+class InProcessPayoutBackend(PayoutBackend):
+    """
+    Base of the backends that pay out from this process rather than through the Node worker.
+
+    Does what the worker does around the transaction itself: validates the outputs, refuses
+    repeated idempotency keys, runs payouts one at a time (so two never pick the same UTXOs),
+    honours cancellation until the transaction is signed and ends every request with its result
+    entries; a request that times out after that fails "unknown".
+    Subclasses implement connect(), send() and the check(), status() and wallet() requests.
+    """
+
+    def __init__(self, network_prefix="kaspa", on_state=None, reconnect_delay=2, ready_timeout=30):
+        """
+        :param network_prefix: Address prefix payouts must have ("kaspa" on mainnet).
+        :param on_state: Optional callback(ready, detail), see PayoutBackend.
+        :param reconnect_delay: Seconds between connection attempts while the first one fails.
+        :param ready_timeout: Seconds a request waits for the backend to be ready before it fails "offline",
+            even without a timeout of its own.
+        """
+        self.network_prefix = network_prefix
+        self.on_state = on_state
+        self.reconnect_delay = reconnect_delay
+        self.ready_timeout = ready_timeout
+        self._ids = itertools.count(1)
+        self._ready = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._submitted_keys = collections.OrderedDict()  # idempotency key -> txid, oldest first
+        self._connector = None
+        self._running = set()
+
+    def start(self):
+        if self._connector is None:
+            self._connector = asyncio.create_task(self._connect())
+
+    async def stop(self):
+        if self._connector is not None:
+            self._connector.cancel()
+            self._connector = None
+        self._ready.clear()
+        await self.close()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def payout(self, address, amount, timeout=None, key=None):
+        return self._entries([{"address": address, "amount": amount, "key": key}], False, timeout)
+
+    def payout_batch(self, outputs, timeout=None):
+        return self._entries(list(outputs), True, timeout)
+
+    async def request(self, method, timeout=None, **params):
+        handler = {"check": self.check, "status": self.status, "wallet": self.wallet}.get(method)
+        if handler is None:
+            logger.warning(f"Unknown payout backend request {method!r}")
+            return False
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+            return await asyncio.wait_for(handler(**params), timeout)
+        except asyncio.TimeoutError:
+            logger.info(f"[ERROR] {method} request timed out after {timeout} seconds")
+        except Exception as e:
+            logger.info(f"[ERROR] {method} request failed: {e}")
+        return False
+
+    # Implemented by the backends
+
+    async def connect(self):
+        """Connects to the node(s). Returns a detail for the readiness, e.g. which node."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def send(self, request, outputs):
+        """
+        Pays the checked `outputs` (PayoutOutput) in one transaction, logging through `request`.
+
+        Call submitted() right after the submission. Check `request.cancelled` before signing and
+        set `request.signing` right after that check.
+        Returns True once confirmed, False if it failed or is pending.
+        """
+        raise NotImplementedError
+
+    async def check(self, addresses, txids):
+        raise NotImplementedError
+
+    async def status(self):
+        raise NotImplementedError
+
+    async def wallet(self):
+        raise NotImplementedError
+
+    # Shared by the backends
+
+    def submitted(self, outputs, txid):
+        """Remembers the outputs' idempotency keys, so they are never submitted again."""
+        for output in outputs:
+            if output.key:
+                self._submitted_keys[output.key] = txid
+        while len(self._submitted_keys) > MAX_SUBMITTED_KEYS:
+            self._submitted_keys.popitem(last=False)
+
+    async def _connect(self):
+        while True:
+            try:
+                detail = await self.connect()
+                break
+            except Exception as e:
+                logger.warning(f"Payout backend failed to connect: {e}")
+                self._notify_state(False, f"connect failed: {e}")
+            await asyncio.sleep(self.reconnect_delay)
+        self._ready.set()
+        self._notify_state(True, detail)
+
+    def _check_output(self, request, output, index):
+        """Returns the output as a PayoutOutput, or None (after logging why) if it cannot be paid."""
+        fields = {} if index is None else {"output": index}
+        address, amount, key = output.get("address"), output.get("amount"), output.get("key")
+        if key and key in self._submitted_keys:
+            txid = self._submitted_keys[key]
+            request.log(f"Payout {key} was already submitted, TXID: {txid}", "error", duplicate=True, txid=txid, **fields)
+            return None
+        if not amount:
+            request.log("Missing amount.", "error", **fields)
+            return None
+        sompi = kaspa_to_sompi(amount)
+        if sompi is None or sompi <= 0:
+            request.log("Invalid amount. Must be greater than zero.", "error", **fields)
+            return None
+        if not isinstance(address, str) or not is_valid_kaspa_address(address, self.network_prefix):
+            request.log(f"Invalid address: {address}", "error", **fields)
+            return None
+        return PayoutOutput(address, amount, sompi, key)
+
+    async def _handle(self, request, outputs, batch):
+        result = False
+        checked = []
+        try:
+            async with self._lock:
+                checked = [self._check_output(request, output, index if batch else None)
+                           for index, output in enumerate(outputs)]
+                valid = [output for output in checked if output is not None]
+                if not valid:
+                    request.log("No valid outputs to send.", "error")
+                else:
+                    result = await self.send(request, valid)
+        except Exception as e:
+            request.log(f"Exception: {e}", "error")
+        entry = {"type": TERMINAL_TYPE, "id": request.id, "result": result}
+        if batch:
+            entry["outputs"] = [output is not None and result for output in checked] or [False] * len(outputs)
+        request.put(entry)
+
+    async def _entries(self, outputs, batch, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        request = PayoutRequest(next(self._ids))
+        finished = False
+        try:
+            try:
+                ready_wait = self.ready_timeout if deadline is None else min(self.ready_timeout, self._remaining(loop, deadline))
+                await asyncio.wait_for(self._ready.wait(), ready_wait)
+                task = asyncio.create_task(self._handle(request, outputs, batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            except asyncio.TimeoutError:
+                request.fail(f"Payout backend was not ready within {ready_wait:.1f} seconds", offline=True)
+            while not finished:
+                if not request.entries.empty():
+                    entry = request.entries.get_nowait()
+                else:
+                    try:
+                        entry = await asyncio.wait_for(request.entries.get(), self._remaining(loop, deadline))
+                    except asyncio.TimeoutError:
+                        request.cancelled = True
+                        if request.signing:  # Too late to cancel
+                            request.fail(f"Request timed out after {timeout} seconds, the payout may have been "
+                                         "submitted", unknown=True)
+                        else:
+                            request.fail(f"Request timed out after {timeout} seconds")
+                        entry = request.entries.get_nowait()
+                finished = entry.get("type") == TERMINAL_TYPE
+                yield entry
+        finally:
+            request.detached = True
+            if not finished:
+                request.cancelled = True
+
+    @staticmethod
+    def _remaining(loop, deadline):
+        return None if deadline is None else max(0, deadline - loop.time())
+
+
+class MockPayoutBackend(InProcessPayoutBackend):
+    """
+    Deterministic in-memory payout backend, for benchmarks and for running without a node.
+
+    Behaves like mock-transaction-worker.js without the Node process: every payout step takes
+    a fixed time (times `delay_factor`), batches take as long as single payouts, and txids are
+    numbered rather than random, so two runs produce the same log.
+    """
+
+    CONNECT_SECONDS = 0.3
+    STEP_SECONDS = {"connect": 0.3, "build": 0.4, "sign": 0.5, "submit": 1.2}  # Time up to the end of each phase
+
+    def __init__(self, delay_factor=1.0, confirm_after=0, offline_for=0, network_prefix="kaspa", on_state=None):
+        """
+        :param delay_factor: Stretches every step, to simulate a slow node (0 for no delays at all).
+        :param confirm_after: Seconds after submission before a transaction counts as confirmed, so
+            payouts end up pending.
+        :param offline_for: Seconds from start() during which the node is unreachable.
+        """
+        super().__init__(network_prefix=network_prefix, on_state=on_state)
+        self.delay_factor = delay_factor
+        self.confirm_after = confirm_after
+        self.offline_for = offline_for
+        self.submitted_at = {}  # txid -> loop time of the submission
+        self.utxos = 20
+        self._txids = itertools.count(1)
+        self._online_at = None
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    async def _sleep(self, seconds):
+        if self.delay_factor:
+            await asyncio.sleep(seconds * self.delay_factor)
+
+    def _online(self):
+        return self._online_at is not None and self._now() >= self._online_at
+
+    def _confirmed(self, txid):
+        return txid in self.submitted_at and self._now() - self.submitted_at[txid] >= self.confirm_after
+
+    async def connect(self):
+        self._online_at = self._now() + self.offline_for
+        await self._sleep(self.CONNECT_SECONDS)
+        return "mock node"
+
+    async def send(self, request, outputs):
+        if not self._online():
+            await self._sleep(self.STEP_SECONDS["connect"])
+            request.log("Node unreachable: mock node is offline", "error", offline=True)
+            return False
+        total = sum(output.sompi for output in outputs)
+        request.log(f"Attempting to send {total} sompi to {len(outputs)} address(es)", "info", "connect")
+        await self._sleep(self.STEP_SECONDS["connect"])
+        if request.cancelled:
+            request.log("Payout cancelled before submission.", "error")
+            return False
+        request.signing = True
+        request.log("Signing transaction...", "info", "build")
+        await self._sleep(self.STEP_SECONDS["build"])
+        request.log("Submitting transaction...", "info", "sign")
+        await self._sleep(self.STEP_SECONDS["sign"])
+
+        txid = f"{next(self._txids):064x}"
+        self.submitted_at[txid] = self._now()
+        self.submitted(outputs, txid)
+        request.log(f"Transaction sent. TXID: {txid}. Waiting for confirmation...", "info", "submit", txid=txid)
+        await self._sleep(self.STEP_SECONDS["submit"])
+
+        if not self._confirmed(txid):
+            paid = [{"address": output.address, "amount": output.amount} for output in outputs]
+            request.log("Transaction unconfirmed! Don't worry - I will keep checking in the background "
+                        "and resend if needed.", "warn")
+            request.log(f"Pending TXID: {txid}", "pending", txid=txid, **paid[0], outputs=paid)
+            return False
+        request.log(f"Transaction confirmed! TXID: {txid}", "success", "confirm", txid=txid)
+        return True
+
+    async def check(self, addresses=(), txids=()):
+        return [txid for txid in txids if self._confirmed(txid)]
+
+    async def status(self):
+        return self._online()
+
+    async def wallet(self):
+        return {"utxos": self.utxos, "reserved": 0, "balance": str(self.utxos * 100), "presplit": None,
+                "fee_rate": 1, "synced": self._online(), "subscribed": False, "utxo_age": 0, "status_age": 0}
+
+
+def open_payout_backend(name=None, on_state=None, worker_script=None, worker_args=(), grpc_nodes=(),
+                        network="mainnet", fee_rate=1.0):
+    """
+    Returns the payout backend selected by `name` or the CHANGEOMATIC_PAYOUT env variable:
+    "node" (the Node transaction worker, the default), "grpc" or "mock".
+
+    :param worker_script: transaction-worker.js, for "node".
+    :param worker_args: Its extra command line arguments.
+    :param grpc_nodes: "host:port" of the Kaspa nodes, for "grpc", in order of preference.
+    :param network: "mainnet" or "testnet-<n>", for "grpc" (the private key is read from KASPA_PRIVATE_KEY).
+    :param fee_rate: Sompi per gram of mass, for "grpc".
+    """
+    name = name or os.environ.get("CHANGEOMATIC_PAYOUT", "node")
+    if name == "mock":
+        return MockPayoutBackend(on_state=on_state)
+    if name == "grpc":
+        from grpc_backend import GrpcPayoutBackend  # Needs grpcio and kaspy
+        return GrpcPayoutBackend(grpc_nodes, os.environ.get("KASPA_PRIVATE_KEY", ""), network=network,
+                                 fee_rate=fee_rate, on_state=on_state)
+    if name != "node":
+        raise ValueError(f"Unknown payout backend {name!r}")
+    from transaction_worker import TransactionWorker
+    return TransactionWorker(worker_script, worker_args, on_state=on_state)
@@ -0,0 +1,183 @@
+import asyncio
+
+from log_setup import get_logger
+from payout_backend import TERMINAL_TYPE
+
+logger = get_logger("payout")
+
+
+class QueuedPayout:
+    """One recipient's payout, from the moment it is queued until its result is delivered."""
+
+    __slots__ = ("address", "amount", "key", "deadline", "queued_at", "entries", "sent", "rejected", "abandoned")
+
+    def __init__(self, address, amount, key, deadline, queued_at):
+        self.address = address
+        self.amount = amount
+        self.key = key
+        self.deadline = deadline
+        self.queued_at = queued_at
+        self.entries = asyncio.Queue()
+        self.sent = False
+        self.rejected = False   # Left out of the transaction by the worker
+        self.abandoned = False  # The caller timed out or stopped listening
+
+
+class PayoutBatcher:
+    """
+    Queue in front of the transaction worker that merges payouts into multi-output transactions.
+
+    Sent one by one, every payout pays its own fee, selects its own UTXOs and waits for the
+    payouts ahead of it to be built, submitted and confirmed. The batcher holds a payout for at
+    most `max_wait` seconds (less once `max_outputs` are queued) and sends everything queued as
+    one worker batch. While a batch is with the worker, new payouts keep queueing and go out
+    together in the next one.
+
+    payout() is a drop-in for TransactionWorker.payout(): it yields the worker's log entries for
+    one recipient. Entries about the whole transaction are copied to every recipient in it; an
+    output the worker rejected, the pending txid and the result only go to the recipient they
+    belong to.
+    """
+
+    def __init__(self, worker, max_wait=0.5, max_outputs=10):
+        """
+        :param worker: PayoutBackend that sends the transactions (e.g. the TransactionWorker).
+        :param max_wait: Seconds a payout may wait for others to share its transaction.
+        :param max_outputs: Most payouts merged into one transaction.
+        """
+        self.worker = worker
+        self.max_wait = max_wait
+        self.max_outputs = max_outputs
+        self.batches_sent = 0
+        self._queue = []
+        self._queued = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def payout(self, address, amount, timeout=None, key=None):
+        """
+        Queues `amount` KAS for `address` and yields its log entries; the last one is "result".
+        `key` is the payout's idempotency key, see PayoutBackend.
+
+        After `timeout` seconds a payout that is still queued is dropped and fails. One that was
+        already sent stays in its batch, which the worker is told to cancel only when every
+        recipient in it has given up, so it fails "unknown": it may still go out. The entries that
+        arrive for it after that are just logged.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        now = loop.time()
+        item = QueuedPayout(address, amount, key, None if timeout is None else now + timeout, now)
+        self._queue.append(item)
+        self._queued.set()
+        if len(self._queue) >= self.max_outputs:
+            self._full.set()
+        finished = False
+        try:
+            while not finished:
+                try:
+                    remaining = None if item.deadline is None else max(0, item.deadline - loop.time())
+                    entry = await asyncio.wait_for(item.entries.get(), remaining)
+                except asyncio.TimeoutError:
+                    self._abandon(item)
+                    if item.sent:
+                        yield {"type": "error", "unknown": True,
+                               "message": f"Payout timed out after {timeout} seconds, it may still be submitted"}
+                    else:
+                        yield {"type": "error", "message": f"Payout timed out after {timeout} seconds"}
+                    entry = {"type": TERMINAL_TYPE, "result": False}
+                finished = entry.get("type") == TERMINAL_TYPE
+                yield entry
+        finally:
+            if not finished:
+                self._abandon(item)
+
+    def _abandon(self, item):
+        item.abandoned = True
+        if not item.sent and item in self._queue:
+            self._queue.remove(item)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queue:
+                self._queued.clear()
+                await self._queued.wait()
+            linger = self._queue[0].queued_at + self.max_wait - loop.time()
+            if len(self._queue) < self.max_outputs and linger > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), linger)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._queue = self._queue[:self.max_outputs], self._queue[self.max_outputs:]
+            if len(self._queue) < self.max_outputs:
+                self._full.clear()
+            if batch:
+                await self._send(batch)
+
+    async def _send(self, batch):
+        loop = asyncio.get_running_loop()
+        for item in batch:
+            item.sent = True
+        # The worker request lives as long as the most patient recipient
+        deadlines = [item.deadline for item in batch]
+        timeout = None if None in deadlines else max(0, max(deadlines) - loop.time())
+        if len(batch) == 1:
+            entries = self.worker.payout(batch[0].address, batch[0].amount, timeout=timeout, key=batch[0].key)
+        else:
+            logger.info(f"Sending {len(batch)} payouts in one transaction")
+            outputs = [{"address": item.address, "amount": item.amount, **({"key": item.key} if item.key else {})}
+                       for item in batch]
+            entries = self.worker.payout_batch(outputs, timeout=timeout)
+        self.batches_sent += 1
+        delivered = False
+        try:
+            async for entry in entries:
+                if entry.get("type") == TERMINAL_TYPE:
+                    delivered = True
+                    self._deliver_results(batch, entry)
+                elif isinstance(entry.get("output"), int) and 0 <= entry["output"] < len(batch):
+                    item = batch[entry["output"]]
+                    item.rejected = True
+                    self._deliver(item, entry)
+                elif entry.get("type") == "pending":
+                    for item in batch:
+                        if not item.rejected:
+                            self._deliver(item, {**entry, "address": item.address, "amount": item.amount})
+                else:
+                    for item in batch:
+                        if not item.rejected:
+                            self._deliver(item, entry)
+                if all(item.abandoned for item in batch):
+                    break  # Closing the worker request cancels it, if it was not submitted yet
+        except Exception:
+            logger.exception(f"Batch of {len(batch)} payouts failed")
+        finally:
+            await entries.aclose()
+            if not delivered:
+                for item in batch:
+                    self._deliver(item, {"type": "error", "message": "Payout was not completed", "unknown": True})
+                    self._deliver(item, {"type": TERMINAL_TYPE, "result": False})
+
+    def _deliver_results(self, batch, entry):
+        outcomes = entry.get("outputs")
+        if not isinstance(outcomes, list) or len(outcomes) != len(batch):
+            outcomes = [entry.get("result")] * len(batch)
+        for item, outcome in zip(batch, outcomes):
+            self._deliver(item, {**entry, "result": outcome is True})
+
+    @staticmethod
+    def _deliver(item, entry):
+        if item.abandoned:
+            logger.info(f"[{str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+        else:
+            item.entries.put_nowait(entry)
@@ -0,0 +1,83 @@
+"""
+Measures payout throughput with and without batching, against mock-transaction-worker.js.
+
+    python3 payout_benchmark.py [--payouts 40] [--rate 4] [--max-wait 0.5] [--max-outputs 10] [--delay-factor 0.2]
+                                [--no-wallet-cache]
+
+Sends `--payouts` payouts arriving at `--rate` per second (Poisson arrivals, like several
+kiosks paying out at once), first one transaction per payout straight to the worker, then
+through a PayoutBatcher. Reports payouts per second, transactions sent and the latency from
+queueing a payout to its result. --no-wallet-cache makes every payout look up its UTXOs, like
+the worker did before it kept a warm UTXO and fee cache. Needs node.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from payout_backend import TERMINAL_TYPE
+from payout_batcher import PayoutBatcher
+from transaction_worker import TransactionWorker
+
+MOCK_WORKER_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock-transaction-worker.js")
+ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+
+
+async def run(label, send, payout_count, rate, seed):
+    rng = random.Random(seed)
+    latencies = []
+    outcomes = []
+    txids = set()
+
+    async def one_payout(index):
+        start = time.perf_counter()
+        result = False
+        async for entry in send(ADDRESS, f"{1 + index % 7}.5", timeout=600):
+            if entry.get("txid"):
+                txids.add(entry["txid"])
+            if entry.get("type") == TERMINAL_TYPE:
+                result = entry.get("result") is True
+        latencies.append(time.perf_counter() - start)
+        outcomes.append(result)
+
+    start = time.perf_counter()
+    tasks = []
+    for index in range(payout_count):
+        tasks.append(asyncio.create_task(one_payout(index)))
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{label:>8}: {payout_count / elapsed:6.2f} payouts/s | {len(txids):3} transactions | "
+          f"{sum(outcomes)}/{payout_count} confirmed | "
+          f"latency p50 {latencies[len(latencies) // 2]:6.2f} s, "
+          f"p95 {latencies[int(len(latencies) * 0.95)]:6.2f} s, max {latencies[-1]:6.2f} s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payouts", type=int, default=40)
+    parser.add_argument("--rate", type=float, default=4, help="payouts arriving per second")
+    parser.add_argument("--max-wait", type=float, default=0.5)
+    parser.add_argument("--max-outputs", type=int, default=10)
+    parser.add_argument("--delay-factor", type=float, default=0.2, help="passed to the mock worker")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-wallet-cache", action="store_true", help="passed to the mock worker")
+    args = parser.parse_args()
+
+    worker_args = [f"--delay-factor={args.delay_factor}"] + (["--no-wallet-cache"] if args.no_wallet_cache else [])
+    worker = TransactionWorker(MOCK_WORKER_JS, worker_args)
+    worker.start()
+    try:
+        await run("direct", worker.payout, args.payouts, args.rate, args.seed)
+        batcher = PayoutBatcher(worker, max_wait=args.max_wait, max_outputs=args.max_outputs)
+        await run("batched", batcher.payout, args.payouts, args.rate, args.seed)
+        batcher.stop()
+    finally:
+        await worker.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
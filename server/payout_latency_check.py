@@ -0,0 +1,201 @@
+"""
+Checks that coins are still decoded on time while a slow payout runs, and that payout timeouts and cancellation work.
+
+    python3 payout_latency_check.py [--delay-factor 2] [--coin-interval 0.5] [--max-delay 0.1]
+
+Runs mock-transaction-worker.js slowed down `--delay-factor` times and, while it sends a
+payout, feeds 2-pulse coins through SimulatedGpio into the coin listener every
+`--coin-interval` seconds. Each coin must be decoded at most `--max-delay` seconds after its
+time window closed, and the event loop must not lag by more than that either. Then it checks
+the two ways a payout is stopped early: a payout that runs past its timeout must end with a
+failed result on time, and a payout whose caller is cancelled must stop right away; in both
+cases the worker must drop the payout before submitting it, and the next payout must go
+through. Last, a payout that times out after the worker started signing it must end on time
+marked "unknown", with the txid it was sent in. Exits with status 1 if any check fails. Needs node.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from coin_decoder import CoinEdgeListener, CoinPulseDecoder
+from gpio_backend import SimulatedGpio
+from log_setup import get_logger
+from payout_backend import TERMINAL_TYPE
+from transaction_worker import TransactionWorker
+
+MOCK_WORKER_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock-transaction-worker.js")
+ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+COIN_PIN = 22
+PULSE_WIDTH_MS = 30
+TIME_WINDOW_MS = 200
+
+
+class WorkerLog(logging.Handler):
+    """Collects what the worker logs for requests nobody is waiting for any more (a cancelled payout's steps)."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+async def payout(worker, timeout=None):
+    """Sends one payout; returns (result, entries)."""
+    entries = []
+    async for entry in worker.payout(ADDRESS, "1.5", timeout=timeout):
+        entries.append(entry)
+        if entry.get("type") == TERMINAL_TYPE:
+            return entry.get("result") is True, entries
+    return False, entries
+
+
+async def check_coins_during_payout(worker, args, failures):
+    gpio = SimulatedGpio()
+    listener = CoinEdgeListener(CoinPulseDecoder(time_window_ms=TIME_WINDOW_MS))
+    listener.attach(gpio, COIN_PIN)
+    injected = []  # perf_counter() of each coin's first pulse
+    delays = []  # Seconds from each coin's window closing to it being decoded
+    lags = []
+    counts = []
+
+    async def decode():
+        async for signal_count in listener.coins():
+            # The window opens at the end of the first pulse
+            delays.append(time.perf_counter() - injected[len(counts)] - (PULSE_WIDTH_MS + TIME_WINDOW_MS) / 1000)
+            counts.append(signal_count)
+
+    async def measure_lag():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    decoder_task = asyncio.create_task(decode())
+    lag_task = asyncio.create_task(measure_lag())
+    payout_task = asyncio.create_task(payout(worker))
+    while not payout_task.done():
+        injected.append(time.perf_counter())
+        gpio.inject_pulses(COIN_PIN, 2, width_ms=PULSE_WIDTH_MS)
+        await asyncio.sleep(args.coin_interval)
+    await asyncio.sleep((PULSE_WIDTH_MS + TIME_WINDOW_MS) / 1000 + args.max_delay)
+    decoder_task.cancel()
+    lag_task.cancel()
+    result, _ = payout_task.result()
+
+    print(f"coins during a payout: {len(counts)}/{len(injected)} decoded, decode delay max "
+          f"{max(delays, default=0) * 1000:.1f} ms, loop lag max {max(lags, default=0) * 1000:.1f} ms, "
+          f"payout {'confirmed' if result else 'failed'}")
+    if not result:
+        failures.append("the slowed payout did not go through")
+    if len(counts) != len(injected) or any(count != 2 for count in counts):
+        failures.append(f"coins were lost or misread during the payout: {counts}")
+    if max(delays, default=0) > args.max_delay:
+        failures.append(f"a coin was decoded {max(delays) * 1000:.0f} ms after its window closed")
+    if max(lags, default=0) > args.max_delay:
+        failures.append(f"the event loop lagged by {max(lags) * 1000:.0f} ms during the payout")
+
+
+async def check_stopped_payout(worker, worker_log, label, stop, failures, worker_step_seconds):
+    """`stop(worker)` runs a payout and stops it early; it returns the seconds the payout took to end."""
+    worker_log.messages.clear()
+    seconds = await stop(worker)
+    # The cancel frame reaches the worker before its check before signing; wait until the step would be done
+    deadline = time.perf_counter() + 2 * worker_step_seconds
+    while time.perf_counter() < deadline and not any(
+            "cancelled before submission" in message or "Transaction sent" in message for message in worker_log.messages):
+        await asyncio.sleep(0.05)
+    dropped = any("cancelled before submission" in message for message in worker_log.messages)
+    result, _ = await payout(worker)
+    print(f"{label}: ended after {seconds:.2f} s, {'dropped' if dropped else 'SUBMITTED'} by the worker, "
+          f"next payout {'confirmed' if result else 'failed'}")
+    if not dropped:
+        failures.append(f"{label}: the worker submitted the payout anyway")
+    if not result:
+        failures.append(f"{label}: the next payout did not go through")
+    return seconds
+
+
+async def check_late_timeout(worker, args, failures):
+    """A payout that times out after it was submitted must not look like a plain failure."""
+    timeout = 1.8 * args.delay_factor  # After submission, before confirmation (the wallet cache is warm by now)
+    start = time.perf_counter()
+    result, entries = await payout(worker, timeout=timeout)
+    seconds = time.perf_counter() - start
+    unknown = any(entry.get("unknown") is True for entry in entries)
+    txid = next((entry["txid"] for entry in entries if entry.get("txid")), None)
+    print(f"timeout after submission: ended after {seconds:.2f} s, {'unknown' if unknown else 'NOT unknown'}, "
+          f"txid {txid}")
+    if result or not unknown:
+        failures.append("timeout after submission: the payout did not end as unknown")
+    if txid is None:
+        failures.append("timeout after submission: the txid was not reported")
+    if seconds > timeout + args.max_delay:
+        failures.append(f"timeout after submission: the payout ended {seconds - timeout:.2f} s after its timeout")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--delay-factor", type=float, default=2, help="passed to the mock worker")
+    parser.add_argument("--coin-interval", type=float, default=0.5, help="seconds between coins during the payout")
+    parser.add_argument("--max-delay", type=float, default=0.1, help="seconds a coin may be decoded late")
+    args = parser.parse_args()
+
+    worker_log = WorkerLog()
+    payout_logger = get_logger("payout")
+    payout_logger.addHandler(worker_log)
+    payout_logger.setLevel(logging.INFO)
+    payout_logger.propagate = False
+    worker = TransactionWorker(MOCK_WORKER_JS, [f"--delay-factor={args.delay_factor}"])
+    worker.start()
+    failures = []
+    try:
+        await check_coins_during_payout(worker, args, failures)
+
+        timeout = 0.2 * args.delay_factor  # Before the worker's check before signing
+
+        async def time_out(worker):
+            start = time.perf_counter()
+            result, entries = await payout(worker, timeout=timeout)
+            if result or not any("timed out" in entry.get("message", "") for entry in entries):
+                failures.append("timeout: the payout did not end with a timeout error")
+            return time.perf_counter() - start
+
+        seconds = await check_stopped_payout(worker, worker_log, "timeout", time_out, failures, args.delay_factor)
+        if seconds > timeout + args.max_delay:
+            failures.append(f"timeout: the payout ended {seconds - timeout:.2f} s after its timeout")
+
+        async def cancel(worker):
+            task = asyncio.create_task(payout(worker))
+            await asyncio.sleep(timeout)
+            start = time.perf_counter()
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            else:
+                failures.append("cancel: the payout finished instead of being cancelled")
+            return time.perf_counter() - start
+
+        seconds = await check_stopped_payout(worker, worker_log, "cancel", cancel, failures, args.delay_factor)
+        if seconds > args.max_delay:
+            failures.append(f"cancel: the payout took {seconds:.2f} s to stop")
+
+        await check_late_timeout(worker, args, failures)
+    finally:
+        await worker.stop()
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if not failures:
+        print("All checks passed")
+    return not failures
+
+
+if __name__ == "__main__":
+    if not asyncio.run(main()):
+        raise SystemExit(1)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from log_setup import get_logger
+from payout_backend import TERMINAL_TYPE
+
+logger = get_logger("payout")
+
+
+class OutboxPayout:
+    """A payout accepted while the node was unreachable, with the quote it was accepted at."""
+
+    def __init__(self, address, amount, quote=None, key=None, created=None, attempts=0, status="queued", kiosk=None,
+                 txid=None):
+        self.address = address
+        self.amount = amount
+        self.quote = quote or {}  # collected_amount, kaspa_price and usd_to_aud the amount was locked at
+        self.key = key or uuid.uuid4().hex  # Idempotency key, sent with every attempt
+        self.created = created if created is not None else time.time()
+        self.attempts = attempts
+        self.status = status  # "queued", "sending" or "held"
+        self.kiosk = kiosk  # Id of the kiosk the payout was made at
+        self.txid = txid  # Once submitted
+
+    def to_dict(self):
+        return {"address": self.address, "amount": self.amount, "quote": self.quote, "key": self.key,
+                "created": self.created, "attempts": self.attempts, "status": self.status, "kiosk": self.kiosk,
+                "txid": self.txid}
+
+
+class PayoutOutbox:
+    """
+    Store-and-forward queue for payouts that could not be sent because the node was unreachable.
+
+    add() writes the payout to `store_file` (fsynced) before returning, so the customer can be
+    given a receipt straight away. A drainer task probes the worker with "status" requests,
+    backing off from `probe_interval` to `max_probe_interval` while the node stays down, and
+    once it is back sends the backlog through the PayoutBatcher, so it goes out in multi-output
+    transactions, at most `rate` payouts a second (bursts of `burst`).
+
+    Every payout keeps its idempotency key across attempts, so the worker refuses to submit it
+    twice. A payout that was being sent when the server stopped, or when the worker exited (its
+    keys are only kept in memory), is "held" instead of being sent again: whether it went out
+    can only be checked in the wallet.
+    Submitted but unconfirmed payouts are handed to the PayoutTracker.
+    `on_status(status, payout)` is called with "sent", "submitted" or "held".
+    """
+
+    def __init__(self, batcher, tracker=None, store_file="payout_outbox.json", probe_interval=15,
+                 max_probe_interval=5 * 60, probe_timeout=20, rate=1.0, burst=10, payout_timeout=120,
+                 max_attempts=5, wait_histogram=None, on_status=None):
+        """
+        :param batcher: PayoutBatcher the backlog is sent through; its worker answers the probes.
+        :param tracker: PayoutTracker that follows payouts submitted but not confirmed yet.
+        :param rate: Payouts sent per second once the node is back.
+        :param burst: Payouts that may be sent at once before `rate` applies.
+        :param max_attempts: Failed attempts (with the node reachable) before a payout is held.
+        :param wait_histogram: Optional Histogram of the seconds from add() to the payout being sent.
+        """
+        self.batcher = batcher
+        self.worker = batcher.worker
+        self.tracker = tracker
+        self.store_file = store_file
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.probe_timeout = probe_timeout
+        self.rate = rate
+        self.burst = burst
+        self.payout_timeout = payout_timeout
+        self.max_attempts = max_attempts
+        self.wait_histogram = wait_histogram
+        self.on_status = on_status
+        self.payouts = []
+        self.node_reachable = True
+        self._tokens = burst
+        self._tokens_at = None
+        self._added = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return sum(1 for payout in self.payouts if payout.status != "held")
+
+    @property
+    def online(self):
+        """False while payouts should go straight to the outbox instead of being tried first."""
+        return self.node_reachable and self.worker.ready and not self.queued()
+
+    @property
+    def oldest_age(self):
+        queued = self.queued()
+        return time.time() - min(payout.created for payout in queued) if queued else None
+
+    def queued(self):
+        return [payout for payout in self.payouts if payout.status == "queued"]
+
+    def load(self):
+        """Restores the backlog saved before a restart."""
+        try:
+            with open(self.store_file, encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load the payout outbox: {e}")
+            return
+        for entry in saved:
+            payout = OutboxPayout(**entry)
+            if payout.status == "sending":
+                payout.status = "held"
+                logger.error(f"Outbox payout of {payout.amount} KAS to {payout.address} (key {payout.key}) "
+                             "was being sent when the server stopped: check the wallet before sending it again")
+            self.payouts.append(payout)
+        if self.payouts:
+            logger.info(f"Loaded {len(self)} outbox payouts, {len(self.payouts) - len(self)} held")
+            try:
+                self._write(self._to_store())
+            except OSError as e:
+                logger.error(f"Could not save the payout outbox: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def mark_offline(self):
+        """Called when a payout failed because the node was unreachable; the drainer probes from now on."""
+        if self.node_reachable:
+            logger.warning("Node unreachable, new payouts go to the outbox")
+        self.node_reachable = False
+        self._added.set()
+
+    async def add(self, address, amount, quote=None, kiosk=None, key=None, held=False):
+        """
+        Stores a payout for later, under idempotency key `key` (a new one if None). Returns the OutboxPayout once it is on disk.
+
+        A `held` payout is not sent: its outcome is unknown, so it waits for someone to check the wallet.
+        """
+        payout = OutboxPayout(address, amount, quote, key=key, kiosk=kiosk, status="held" if held else "queued")
+        self.payouts.append(payout)
+        await self._save()
+        if held:
+            logger.error(f"Holding payout of {amount} KAS to {address} in the outbox (key {payout.key}): "
+                         "check the wallet before sending it again")
+            return payout
+        logger.info(f"Queued payout of {amount} KAS to {address} in the outbox (key {payout.key}), "
+                    f"{len(self)} waiting")
+        self._added.set()
+        return payout
+
+    async def probe(self):
+        """Asks the worker whether the node is reachable and synced."""
+        if not self.worker.ready:
+            return False
+        return await self.worker.request("status", timeout=self.probe_timeout) is True
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        backoff = self.probe_interval
+        while True:
+            if not self.queued() and self.node_reachable:
+                self._added.clear()
+                await self._added.wait()
+                continue
+            if not await self.probe():
+                self.node_reachable = False
+                logger.info(f"Node still unreachable, {len(self)} payouts waiting. Next check in {backoff:.0f} s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_probe_interval)
+                continue
+            if not self.node_reachable:
+                logger.info(f"Node reachable again, sending {len(self)} outbox payouts")
+            self.node_reachable = True
+            backoff = self.probe_interval
+            if not self.queued():
+                continue
+
+            # Token bucket: `burst` payouts at once, then `rate` per second
+            now = loop.time()
+            if self._tokens_at is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._tokens_at) * self.rate)
+            self._tokens_at = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            batch = self.queued()[:int(self._tokens)]
+            self._tokens -= len(batch)
+            for payout in batch:
+                payout.status = "sending"
+                payout.attempts += 1
+            await self._save()  # On disk as "sending" before the worker sees them
+            await asyncio.gather(*(self._forward(payout) for payout in batch))
+            await self._save()
+
+    async def _forward(self, payout):
+        outcome, offline, unknown, txid = False, False, False, None
+        async for entry in self.batcher.payout(payout.address, payout.amount, timeout=self.payout_timeout,
+                                               key=payout.key):
+            if entry.get("type") == TERMINAL_TYPE:
+                outcome = entry.get("result") is True
+                continue
+            offline = offline or entry.get("offline") is True
+            unknown = unknown or entry.get("unknown") is True
+            if entry.get("type") in ("pending", "success") or entry.get("duplicate"):
+                txid = entry.get("txid") or txid
+            logger.info(f"[OUTBOX {str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+
+        if outcome or txid is not None:
+            payout.txid = txid
+            self.payouts.remove(payout)
+            if self.wait_histogram is not None:
+                self.wait_histogram.observe(time.time() - payout.created)
+            if outcome:
+                logger.info(f"Outbox payout of {payout.amount} KAS to {payout.address} confirmed")
+                self._notify("sent", payout)
+            else:
+                if self.tracker is not None and txid not in self.tracker.by_txid:
+                    self.tracker.track(txid, payout.address, payout.amount, kiosk=payout.kiosk)
+                self._notify("submitted", payout)
+        elif unknown:
+            # Retrying would submit it again: a restarted worker does not know its key
+            payout.status = "held"
+            logger.error(f"Outbox payout of {payout.amount} KAS to {payout.address} (key {payout.key}) "
+                         "was being sent when the worker exited: check the wallet before sending it again")
+            self._notify("held", payout)
+        elif offline:
+            payout.status = "queued"
+            payout.attempts -= 1  # Not the payout's fault
+            self.node_reachable = False
+        elif payout.attempts >= self.max_attempts:
+            payout.status = "held"
+            logger.error(f"Outbox payout of {payout.amount} KAS to {payout.address} (key {payout.key}) "
+                         f"failed {payout.attempts} times, holding it")
+            self._notify("held", payout)
+        else:
+            payout.status = "queued"
+
+    def _notify(self, status, payout):
+        if self.on_status is not None:
+            self.on_status(status, payout)
+
+    def _to_store(self):
+        return [payout.to_dict() for payout in self.payouts]
+
+    async def _save(self):
+        async with self._write_lock:
+            try:
+                await asyncio.to_thread(self._write, self._to_store())
+            except OSError as e:
+                logger.error(f"Could not save the payout outbox: {e}")
+
+    def _write(self, payouts):
+        tmp_file = self.store_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(payouts, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.store_file)
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import time
+
+from log_setup import get_logger
+from timer_wheel import TimerWheel
+
+logger = get_logger("payout")
+
+
+class PendingPayout:
+    """A submitted payout that was not confirmed yet, with every txid sent for it (resubmits add one)."""
+
+    def __init__(self, address, amount, txids, created=None, resubmits_left=1, kiosk=None):
+        self.address = address
+        self.amount = amount
+        self.txids = list(txids)
+        self.created = created if created is not None else time.time()
+        self.resubmits_left = resubmits_left
+        self.kiosk = kiosk  # Id of the kiosk the payout was made at
+        self.timers = []
+
+    def to_dict(self):
+        return {"address": self.address, "amount": self.amount, "txids": self.txids,
+                "created": self.created, "resubmits_left": self.resubmits_left, "kiosk": self.kiosk}
+
+
+class PayoutTracker:
+    """
+    Follows payouts the transaction worker submitted but could not confirm while the customer waited.
+
+    Pending payouts are indexed by txid and by address in memory. Every `check_interval` seconds
+    all of them are checked with one worker "check" request (a single getUtxosByAddresses call
+    for all their addresses). Resubmit and fail deadlines run on a TimerWheel, not a scan.
+
+    The pending set is saved to `store_file` when it changes (not on every check), and finished
+    payouts are appended to `history_file`; both are written off the loop.
+    `on_status(status, payout)` is called with "confirmed", "resubmitted" or "failed".
+    """
+
+    def __init__(self, worker, store_file="pending_payouts.json", history_file="payout_history.jsonl",
+                 check_interval=30, check_timeout=30, resubmit_after=10 * 60, fail_after=15 * 60, on_status=None):
+        """
+        :param worker: PayoutBackend used for checks and resubmits.
+        :param check_interval: Seconds between confirmation checks while payouts are pending.
+        :param resubmit_after: Seconds after the first submission to send the payout again.
+        :param fail_after: Seconds after the first submission to give up on the payout.
+        """
+        self.worker = worker
+        self.store_file = store_file
+        self.history_file = history_file
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.resubmit_after = resubmit_after
+        self.fail_after = fail_after
+        self.on_status = on_status
+        self.wheel = TimerWheel(tick=1.0)
+        self.by_txid = {}     # txid -> [PendingPayout] (a batched transaction pays several)
+        self.by_address = {}  # address -> [PendingPayout]
+        self._tasks = []
+        self._store_dirty = False
+        self._history = []  # Finished payouts not written yet
+        self._writer = None
+
+    def __len__(self):
+        return sum(len(payouts) for payouts in self.by_address.values())
+
+    def load(self):
+        """Restores the pending payouts saved before a restart, and their deadlines."""
+        try:
+            with open(self.store_file, encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load pending payouts: {e}")
+            return
+        for entry in saved:
+            self._add(PendingPayout(**entry))
+        if saved:
+            logger.info(f"Loaded {len(saved)} pending payouts")
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self.wheel.run()), asyncio.create_task(self._check_periodically())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def track(self, txid, address, amount, kiosk=None):
+        """Starts following a payout the worker reported as submitted but unconfirmed."""
+        logger.info(f"Tracking unconfirmed payout of {amount} KAS to {address}, TXID: {txid}")
+        self._add(PendingPayout(address, amount, [txid], kiosk=kiosk))
+        self._save()
+
+    def _add(self, payout):
+        for txid in payout.txids:
+            self.by_txid.setdefault(txid, []).append(payout)
+        self.by_address.setdefault(payout.address, []).append(payout)
+        age = time.time() - payout.created
+        if payout.resubmits_left > 0:
+            payout.timers.append(self.wheel.schedule(max(0, self.resubmit_after - age), self._resubmit, payout))
+        payout.timers.append(self.wheel.schedule(max(0, self.fail_after - age), self._finish, payout, "failed"))
+
+    def _remove(self, payout):
+        for txid in payout.txids:
+            sharing = self.by_txid.get(txid, [])
+            if payout in sharing:
+                sharing.remove(payout)
+            if not sharing:
+                self.by_txid.pop(txid, None)
+        payouts = self.by_address.get(payout.address, [])
+        if payout in payouts:
+            payouts.remove(payout)
+        if not payouts:
+            self.by_address.pop(payout.address, None)
+        for timer in payout.timers:
+            timer.cancel()
+
+    async def check(self):
+        """Checks all pending payouts with one request. Returns the number confirmed."""
+        if not self.by_txid:
+            return 0
+        result = await self.worker.request("check", timeout=self.check_timeout,
+                                           txids=list(self.by_txid), addresses=list(self.by_address))
+        if not isinstance(result, list):
+            logger.warning(f"Checking {len(self.by_txid)} pending transactions failed")
+            return 0
+        confirmed = 0
+        for txid in result:
+            for payout in list(self.by_txid.get(txid, ())):
+                self._finish(payout, "confirmed", txid)
+                confirmed += 1
+        return confirmed
+
+    async def _check_periodically(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    def _resubmit(self, payout):
+        asyncio.create_task(self._send_again(payout))
+
+    async def _send_again(self, payout):
+        logger.warning(f"Payout of {payout.amount} KAS to {payout.address} not confirmed after "
+                       f"{self.resubmit_after / 60:.0f} minutes. Resubmitting...")
+        payout.resubmits_left -= 1
+        self._save()
+        self._notify("resubmitted", payout)
+        async for entry in self.worker.payout(payout.address, payout.amount, timeout=self.fail_after):
+            if payout not in self.by_address.get(payout.address, ()):
+                continue  # Confirmed or failed meanwhile; let the worker finish
+            if entry.get("type") == "pending" and entry.get("txid"):
+                payout.txids.append(entry["txid"])
+                self.by_txid.setdefault(entry["txid"], []).append(payout)
+            elif entry.get("type") == "success":
+                self._finish(payout, "confirmed", entry.get("txid"))
+            else:
+                logger.info(f"[RESUBMIT {str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+        self._save()
+
+    def _finish(self, payout, status, txid=None):
+        self._remove(payout)
+        if status == "confirmed":
+            logger.info(f"Payout of {payout.amount} KAS to {payout.address} confirmed, TXID: {txid}")
+        else:
+            logger.error(f"Payout of {payout.amount} KAS to {payout.address} failed after "
+                         f"{self.fail_after / 60:.0f} minutes, TXIDs: {payout.txids}")
+        self._history.append({**payout.to_dict(), "status": status, "confirmed_txid": txid, "finished": time.time()})
+        self._save()
+        self._notify(status, payout)
+
+    def _notify(self, status, payout):
+        if self.on_status is not None:
+            self.on_status(status, payout)
+
+    def _save(self):
+        """Writes the pending set and new history records in the background, one write at a time."""
+        self._store_dirty = True
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_changes())
+
+    async def _write_changes(self):
+        while self._store_dirty or self._history:
+            pending = None
+            if self._store_dirty:
+                self._store_dirty = False
+                pending = [payout.to_dict() for payouts in self.by_address.values() for payout in payouts]
+            history, self._history = self._history, []
+            await asyncio.to_thread(self._write, pending, history)
+
+    def _write(self, pending, history):
+        if history:
+            self._append_history(history)
+        if pending is not None:
+            self._write_store(pending)
+
+    def _write_store(self, pending):
+        tmp_file = self.store_file + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(pending, f)
+            os.replace(tmp_file, self.store_file)
+        except OSError as e:
+            logger.error(f"Could not save pending payouts: {e}")
+
+    def _append_history(self, records):
+        try:
+            with open(self.history_file, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+        except OSError as e:
+            logger.error(f"Could not write payout history: {e}")
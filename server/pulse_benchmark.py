@@ -0,0 +1,110 @@
+"""
+Records coin acceptor pulse traces and replays them through the coin decoder.
+
+    python3 pulse_benchmark.py record coins.trace --coins 1 2 5 [--seconds 60]
+    python3 pulse_benchmark.py synth synthetic.trace --coins 10000 [--glitch-rate 0.05]
+    python3 pulse_benchmark.py replay [coins.trace ...] [--jitter-ms 0 5 20 50] [--tick-jitter-ms 0]
+
+record captures the raw COIN_PIN edges (stop the server first, it holds the pin) and labels
+them with the signal counts of the coins that were inserted, in order. replay runs traces (or
+a synthetic one when no file is given) through CoinPulseDecoder with the server's thresholds
+and injected scheduler jitter, and reports accuracy, misclassifications and decode latency.
+"""
+import argparse
+import statistics
+import time
+
+from coin_decoder import NS_PER_MS, CoinPulseDecoder
+from gpio_backend import open_gpio_backend
+from pulse_trace import PulseTrace, PulseTraceRecorder, replay, score, synthesize_coins
+
+# Same as click-socket.py
+COIN_PIN = 22
+SIGNAL_MIN_DURATION = 22
+SIGNAL_MAX_DURATION = 38
+TIME_WINDOW = 200
+
+
+def record(args):
+    gpio = open_gpio_backend()
+    recorder = PulseTraceRecorder()
+    recorder.attach(gpio, args.pin)
+    print(f"Recording GPIO {args.pin} for {args.seconds} seconds (Ctrl-C to stop early)...")
+    try:
+        time.sleep(args.seconds)
+    except KeyboardInterrupt:
+        pass
+    gpio.close()
+
+    trace = recorder.trace
+    if args.coins:
+        trace.label_coins(args.coins)
+    trace.save(args.file)
+    print(f"Saved {len(trace)} edges, {len(trace.coin_counts)} labelled coins to {args.file}")
+
+
+def synth(args):
+    trace = synthesize_coins(args.coins, glitch_rate=args.glitch_rate, seed=args.seed)
+    trace.save(args.file)
+    print(f"Saved {len(trace)} edges, {len(trace.coin_counts)} coins to {args.file}")
+
+
+def replay_traces(args):
+    if args.files:
+        traces = [(path, PulseTrace.load(path)) for path in args.files]
+    else:
+        traces = [("synthetic", synthesize_coins(args.coins, glitch_rate=args.glitch_rate, seed=args.seed))]
+
+    print(f"{'trace':16} {'jitter':>7} {'coins':>7} {'correct':>8} {'miscls':>7} {'missed':>7} {'spurious':>8} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'coins/s':>9}")
+    for name, trace in traces:
+        for jitter_ms in args.jitter_ms:
+            decoder = CoinPulseDecoder(SIGNAL_MIN_DURATION, SIGNAL_MAX_DURATION, TIME_WINDOW)
+            start = time.perf_counter()
+            results = replay(trace, decoder, jitter_ms=jitter_ms, tick_jitter_ms=args.tick_jitter_ms, seed=args.seed)
+            elapsed = time.perf_counter() - start
+            stats = score(trace, results)
+
+            coins = stats["coins"] or 1
+            latencies = sorted(stats["latencies"]) or [0]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{name[-16:]:16} {jitter_ms:>5}ms {stats['coins']:>7} {stats['correct'] / coins:>8.2%} "
+                  f"{stats['misclassified'] / coins:>7.2%} {stats['missed'] / coins:>7.2%} {stats['spurious']:>8} "
+                  f"{statistics.median(latencies) / NS_PER_MS:>7.1f} {p99 / NS_PER_MS:>7.1f} "
+                  f"{len(trace.coin_counts) / elapsed:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = commands.add_parser("record", help="record COIN_PIN edges to a trace file")
+    parser_record.add_argument("file")
+    parser_record.add_argument("--pin", type=int, default=COIN_PIN)
+    parser_record.add_argument("--seconds", type=float, default=60)
+    parser_record.add_argument("--coins", type=int, nargs="*", help="signal counts of the inserted coins, in order")
+    parser_record.set_defaults(func=record)
+
+    parser_synth = commands.add_parser("synth", help="write a synthetic labelled trace")
+    parser_synth.add_argument("file")
+    parser_synth.set_defaults(func=synth)
+
+    parser_replay = commands.add_parser("replay", help="replay traces through the decoder")
+    parser_replay.add_argument("files", nargs="*")
+    parser_replay.add_argument("--jitter-ms", type=float, nargs="+", default=[0, 1, 5, 20, 50],
+                               help="mean delay from edge to the event loop")
+    parser_replay.add_argument("--tick-jitter-ms", type=float, default=0,
+                               help="standard deviation of noise added to the edge timestamps")
+    parser_replay.set_defaults(func=replay_traces)
+
+    for subparser in (parser_synth, parser_replay):
+        subparser.add_argument("--coins", type=int, default=10000, help="synthetic coins")
+        subparser.add_argument("--glitch-rate", type=float, default=0.0, help="noise spikes per synthetic coin")
+        subparser.add_argument("--seed", type=int, default=1)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import array
+import bisect
+import random
+import struct
+import sys
+
+from coin_decoder import NS_PER_MS, CoinEdgeListener
+
+MAGIC = b"CPT2"
+HEADER = struct.Struct("<4sII")  # magic, edge count, coin count
+
+
+class PulseTrace:
+    """
+    Raw coin pin edges, stored in arrays: one byte per level and one int64 per nanosecond tick.
+
+    A trace can also be labelled with the coins it contains (signal count, first and last edge
+    tick of each), so a replay can be scored. Saved as a small header followed by the arrays
+    (little endian): 9 bytes per edge and 17 per coin.
+    """
+
+    def __init__(self):
+        self.levels = array.array("B")
+        self.ticks = array.array("q")
+        self.coin_counts = array.array("B")
+        self.coin_starts = array.array("q")
+        self.coin_ends = array.array("q")
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def _arrays(self):
+        return self.levels, self.ticks, self.coin_counts, self.coin_starts, self.coin_ends
+
+    def append(self, level, tick):
+        self.levels.append(level)
+        self.ticks.append(tick)
+
+    def add_coin(self, count, start, end):
+        self.coin_counts.append(count)
+        self.coin_starts.append(start)
+        self.coin_ends.append(end)
+
+    def label_coins(self, counts, min_gap_ms=100, min_pulse_ms=10):
+        """
+        Labels a recorded trace with the coins that were inserted, in order.
+
+        Edges are grouped into coins at idle gaps longer than `min_gap_ms`; groups with no LOW
+        pulse of at least `min_pulse_ms` are taken as noise and left unlabelled.
+
+        :raises ValueError: if the number of coins found does not match `counts`.
+        """
+        groups = []
+        group_start = 0
+        for i in range(1, len(self.ticks) + 1):
+            if i == len(self.ticks) or self.ticks[i] - self.ticks[i - 1] > min_gap_ms * NS_PER_MS:
+                groups.append((group_start, i))
+                group_start = i
+
+        spans = []
+        for start, end in groups:
+            pulses = [self.ticks[i] - self.ticks[i - 1] for i in range(start + 1, end)
+                      if self.levels[i] == 1 and self.levels[i - 1] == 0]
+            if any(pulse >= min_pulse_ms * NS_PER_MS for pulse in pulses):
+                spans.append((self.ticks[start], self.ticks[end - 1]))
+        if len(spans) != len(counts):
+            raise ValueError(f"Found {len(spans)} coins in the trace, but {len(counts)} were labelled")
+        for count, (start, end) in zip(counts, spans):
+            self.add_coin(count, start, end)
+
+    def save(self, path):
+        arrays = self._arrays()
+        if sys.byteorder == "big":
+            arrays = [array.array(a.typecode, a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self.ticks), len(self.coin_counts)))
+            for a in arrays:
+                a.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        trace = cls()
+        with open(path, "rb") as f:
+            magic, edge_count, coin_count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a pulse trace")
+            trace.levels.fromfile(f, edge_count)
+            trace.ticks.fromfile(f, edge_count)
+            for a in trace._arrays()[2:]:
+                a.fromfile(f, coin_count)
+        if sys.byteorder == "big":
+            for a in trace._arrays():
+                a.byteswap()
+        return trace
+
+
+class PulseTraceRecorder:
+    """Appends every edge of a GPIO pin to a PulseTrace. The callback runs on the GPIO alert thread."""
+
+    def __init__(self, trace=None):
+        self.trace = trace if trace is not None else PulseTrace()
+
+    def attach(self, gpio, pin):
+        gpio.claim_alert(pin)
+        gpio.add_edge_callback(pin, self.on_edge)
+
+    def on_edge(self, level, tick):
+        self.trace.append(level, tick)
+
+
+def synthesize_coins(coins, counts=(1, 2, 3, 4, 5), width_ms=30, width_sd_ms=2, gap_ms=15, gap_sd_ms=2,
+                     idle_ms=(300, 800), glitch_rate=0.0, seed=None):
+    """
+    Builds a labelled trace of `coins` random coins, shaped like the coin acceptor's output.
+
+    :param counts: Signal counts to pick from (one per coin type).
+    :param width_ms: Mean LOW pulse width; `width_sd_ms` is its standard deviation.
+    :param gap_ms: Mean HIGH time between the pulses of one coin; `gap_sd_ms` is its standard deviation.
+    :param idle_ms: Range of the idle time between coins.
+    :param glitch_rate: Chance per coin of a short noise spike (1-5 ms LOW) in the idle time before it.
+    """
+    rng = random.Random(seed)
+    trace = PulseTrace()
+    tick = 0
+    for _ in range(coins):
+        tick += int(rng.uniform(*idle_ms) * NS_PER_MS)
+        if rng.random() < glitch_rate:
+            glitch_at = tick - int(rng.uniform(50, idle_ms[0] - 10) * NS_PER_MS)
+            trace.append(0, glitch_at)
+            trace.append(1, glitch_at + int(rng.uniform(1, 5) * NS_PER_MS))
+        count = rng.choice(counts)
+        start = tick
+        for i in range(count):
+            if i:
+                tick += int(max(1.0, rng.gauss(gap_ms, gap_sd_ms)) * NS_PER_MS)
+            trace.append(0, tick)
+            tick += int(max(1.0, rng.gauss(width_ms, width_sd_ms)) * NS_PER_MS)
+            trace.append(1, tick)
+        trace.add_coin(count, start, tick)
+    return trace
+
+
+def replay(trace, decoder, jitter_ms=0.0, tick_jitter_ms=0.0, grace=CoinEdgeListener.WINDOW_GRACE, seed=None):
+    """
+    Drives `decoder` with a trace the way CoinEdgeListener.coins() does, on a simulated clock.
+
+    Each edge reaches the loop `jitter_ms` (exponentially distributed mean) after its tick, in
+    order, and the listener's deadline flush runs `grace` seconds after the window ends. An edge
+    that arrives after that flush is lost to its coin, exactly as on the Pi. `tick_jitter_ms`
+    adds Gaussian noise to the ticks themselves, as if they were taken in Python instead of the kernel.
+
+    :return: [(signal count, window start tick, reported at ns)] in simulated time.
+    """
+    rng = random.Random(seed)
+    jitter_rate = 1 / (jitter_ms * NS_PER_MS) if jitter_ms else None
+    tick_sd = tick_jitter_ms * NS_PER_MS
+    window = decoder.time_window_ms * NS_PER_MS
+    grace_ns = int(grace * 1e9)
+
+    results = []
+    deadline = None
+    arrival = 0
+    for level, tick in zip(trace.levels, trace.ticks):
+        if jitter_rate:
+            arrival = max(arrival, tick + int(rng.expovariate(jitter_rate)))
+        else:
+            arrival = max(arrival, tick)
+        if tick_sd:
+            tick += int(rng.gauss(0, tick_sd))
+
+        if deadline is not None and arrival >= deadline:
+            start = decoder.window_start
+            count = decoder.flush()
+            if count is not None:
+                results.append((count, start, deadline))
+            deadline = None
+
+        was_measuring = decoder.measuring
+        start = decoder.window_start
+        count = decoder.feed(level, tick)
+        if count is not None:
+            results.append((count, start, arrival))
+            deadline = None
+        if decoder.measuring and (not was_measuring or count is not None):
+            deadline = arrival + window + grace_ns
+
+    if deadline is not None:
+        start = decoder.window_start
+        count = decoder.flush()
+        if count is not None:
+            results.append((count, start, deadline))
+    return results
+
+
+def score(trace, results, slack_ms=20):
+    """
+    Compares replay() results with the trace's coin labels.
+
+    Every decoded window is matched to the coin whose pulses it started in (allowing `slack_ms`
+    past the coin's last edge, for replays with tick jitter). Returns a dict of
+    coins, correct, misclassified (wrong count or a coin split in two), missed, spurious
+    (a window outside any coin) and latencies (ns from a coin's last edge to its report).
+    """
+    outcome = [None] * len(trace.coin_counts)
+    spurious = 0
+    latencies = []
+    for count, start, reported in results:
+        index = bisect.bisect_right(trace.coin_starts, start) - 1
+        if index < 0 or start > trace.coin_ends[index] + slack_ms * NS_PER_MS:
+            spurious += 1
+            continue
+        if outcome[index] is None:
+            outcome[index] = count == trace.coin_counts[index]
+            latencies.append(reported - trace.coin_ends[index])
+        else:
+            outcome[index] = False
+    return {
+        "coins": len(outcome),
+        "correct": outcome.count(True),
+        "misclassified": outcome.count(False),
+        "missed": outcome.count(None),
+        "spurious": spurious,
+        "latencies": latencies,
+    }
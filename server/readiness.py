@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+from log_setup import get_logger
+
+logger = get_logger()
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class Readiness:
+    """
+    Startup state of each subsystem (kiosk hardware, price feeds, payout worker, ...).
+
+    The server binds its websocket before anything else is up, so clients can be told what is
+    still starting. Every subsystem is registered as "starting" and later marked "ready" or
+    "failed" (with a detail message); the seconds from `started` to that point are kept for the
+    startup metrics. `on_change(readiness)` is called after every change.
+    """
+
+    def __init__(self, started=None, on_change=None):
+        """
+        :param started: time.monotonic() the startup is measured from, e.g. taken before the imports.
+        """
+        self.started = started if started is not None else time.monotonic()
+        self.on_change = on_change
+        self.states = {}  # subsystem -> (state, detail)
+        self.seconds = {}  # subsystem -> seconds from `started` to its last change
+        self._ready = {}  # subsystem -> asyncio.Event, set once ready
+
+    def __contains__(self, subsystem):
+        return subsystem in self.states
+
+    @property
+    def all_ready(self):
+        return all(state == READY for state, _ in self.states.values())
+
+    def register(self, *subsystems):
+        for subsystem in subsystems:
+            self.states.setdefault(subsystem, (STARTING, None))
+            self._ready.setdefault(subsystem, asyncio.Event())
+
+    def mark_ready(self, subsystem, detail=None):
+        self._set(subsystem, READY, detail)
+        self._ready[subsystem].set()
+
+    def mark_failed(self, subsystem, detail=None):
+        self._set(subsystem, FAILED, detail)
+        self._ready[subsystem].clear()
+
+    def is_ready(self, subsystem):
+        return self.states.get(subsystem, (None,))[0] == READY
+
+    async def wait(self, subsystem):
+        """Waits until `subsystem` is ready."""
+        self.register(subsystem)
+        await self._ready[subsystem].wait()
+
+    def to_dict(self):
+        return {
+            "ready": self.all_ready,
+            "subsystems": {subsystem: {"state": state, "detail": detail}
+                           for subsystem, (state, detail) in self.states.items()},
+        }
+
+    def _set(self, subsystem, state, detail):
+        self.register(subsystem)
+        if self.states[subsystem] == (state, detail):
+            return
+        self.states[subsystem] = (state, detail)
+        self.seconds[subsystem] = time.monotonic() - self.started
+        message = f"[startup] {subsystem} {state} after {self.seconds[subsystem]:.2f} s" + (f": {detail}" if detail else "")
+        if state == FAILED:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        if self.all_ready:
+            logger.info(f"[startup] All subsystems ready after {self.seconds[subsystem]:.2f} s")
+        if self.on_change is not None:
+            self.on_change(self)
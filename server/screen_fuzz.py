@@ -0,0 +1,208 @@
+"""
+Fuzzes the kiosk's screen machine with random events at a high rate.
+
+    python3 screen_fuzz.py [--events 200000] [--seed 1] [--timeout-scale 0.0001] [--burst 16] [--idle 0.02]
+
+Posts random button presses, holds, coins, scan results and payout outcomes to a
+ScreenMachine running SCREEN_TABLE with stub actions that mimic the server's (a scan or payout
+"runs" until its result event arrives), with the screen timeouts scaled down and short idle pauses so they fire too.
+After every event it checks the session invariants: the screen is a known one, processing is
+only entered with money and an address, only one payout is in flight, a scan only runs on
+the scan-wallet screen, and no money is lost: the coins inserted are what was paid out, queued
+and is still credited, both in the kiosk and in the session rebuilt from its journal events.
+Reports events per second and the transitions taken.
+"""
+import argparse
+import asyncio
+import collections
+import random
+import time
+
+from log_setup import TraceBuffer, get_logger
+from screen_machine import (BUTTON, COIN, EVENT_KINDS, HOLD, PAYOUT_OUTCOME, SCAN_RESULT, SCREEN_TABLE,
+                            SCREEN_TIMEOUTS, SCREENS, ScreenMachine)
+from session_journal import SessionState
+
+ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+
+
+class FuzzKiosk:
+    def __init__(self):
+        self.collected_amount = 0
+        self.payout_amount = 0
+        self.recipient_address = ""
+        self.journal = SessionState()  # Fed the journal events the server appends, as replayed after a crash
+        self.inserted_cents = 0
+        self.paid_cents = 0
+        self.queued_cents = 0
+        self.scanning = False
+        self.payouts_in_flight = 0
+        self.scan_timeouts = 0
+        self.outcomes_due = 0  # Payouts started whose outcome was not posted yet
+        self.transitions = collections.Counter()
+        self.violations = []
+
+
+def add_coin(kiosk, event):
+    kiosk.collected_amount += event.data["amount"]
+    kiosk.inserted_cents += round(event.data["amount"] * 100)
+    kiosk.journal.apply("coin-received", {"amount": event.data["amount"]})
+
+def start_scan(kiosk, event):
+    kiosk.scanning = True
+
+def stop_scan(kiosk, event):
+    kiosk.scanning = False
+
+def scan_timeout(kiosk, event):
+    kiosk.scanning = False
+    kiosk.scan_timeouts += 1
+
+def no_money(kiosk, event):
+    kiosk.scanning = False
+    kiosk.recipient_address = event.data["address"]
+
+def start_payout(kiosk, event):
+    kiosk.scanning = False
+    kiosk.recipient_address = event.data["address"]
+    if kiosk.collected_amount <= 0 or not kiosk.recipient_address:
+        kiosk.violations.append(f"payout started with {kiosk.collected_amount} AUD to {kiosk.recipient_address!r}")
+    if kiosk.payouts_in_flight:
+        kiosk.violations.append("payout started while another one is in flight")
+    kiosk.payouts_in_flight += 1
+    kiosk.outcomes_due += 1
+    kiosk.payout_amount = kiosk.collected_amount
+    kiosk.journal.apply("payout-started", {"amount": "0", "address": kiosk.recipient_address,
+                                           "collected": kiosk.payout_amount})
+
+def payout_settled(kiosk, event):
+    kiosk.payouts_in_flight -= 1
+    outcome = event.data["outcome"]
+    if outcome == "queued":
+        kiosk.journal.apply("payout-queued", {"key": "fuzz", "collected": kiosk.payout_amount})
+        kiosk.queued_cents += round(kiosk.payout_amount * 100)
+    else:
+        kiosk.journal.apply("payout-finished", {"result": outcome == "sent", "collected": kiosk.payout_amount})
+        if outcome == "sent":
+            kiosk.paid_cents += round(kiosk.payout_amount * 100)
+    if outcome in ("sent", "queued"):
+        kiosk.collected_amount = round(kiosk.collected_amount - kiosk.payout_amount, 2)
+        kiosk.recipient_address = ""
+    kiosk.payout_amount = 0
+
+def reset_session(kiosk, event):
+    kiosk.scanning = False
+    kiosk.recipient_address = ""
+    kiosk.journal.apply("session-reset", {})
+
+FUZZ_ACTIONS = {
+    "add-coin": add_coin,
+    "start-scan": start_scan,
+    "cancel-scan": stop_scan,
+    "scan-timeout": scan_timeout,
+    "no-money": no_money,
+    "payout-busy": stop_scan,
+    "start-payout": start_payout,
+    "payout-settled": payout_settled,
+    "reset-session": reset_session,
+}
+FUZZ_GUARDS = {
+    "payout-in-flight": lambda kiosk, event: kiosk.payouts_in_flight > 0,
+    "no-money": lambda kiosk, event: kiosk.collected_amount <= 0,
+    "payout-queued": lambda kiosk, event: event.data["outcome"] == "queued",
+}
+
+
+def random_event(rng, kiosk):
+    kind = rng.choices((BUTTON, HOLD, COIN, SCAN_RESULT, PAYOUT_OUTCOME), weights=(8, 1, 4, 2, 2))[0]
+    if kind == PAYOUT_OUTCOME:
+        if not kiosk.outcomes_due:
+            kind = BUTTON  # Only a running payout posts an outcome, once
+        else:
+            kiosk.outcomes_due -= 1
+    if kind == COIN:
+        return kind, {"amount": rng.choice((0.1, 0.2, 0.5, 1, 2))}
+    if kind == SCAN_RESULT:
+        return kind, {"address": ADDRESS}
+    if kind == PAYOUT_OUTCOME:
+        return kind, {"outcome": rng.choice(("sent", "queued", "failed"))}
+    return kind, {}
+
+
+def check(machine, kiosk):
+    if machine.errors:
+        kiosk.violations.append(f"{machine.errors} events raised in the machine")
+    if kiosk.payouts_in_flight < 0:
+        kiosk.violations.append("payout settled that was never started")
+    if machine.screen not in SCREENS:
+        kiosk.violations.append(f"unknown screen {machine.screen!r}")
+    if kiosk.scanning and machine.screen != "scan-wallet":
+        kiosk.violations.append(f"scan running on {machine.screen!r}")
+    credited_cents = round(kiosk.collected_amount * 100)
+    if kiosk.inserted_cents != kiosk.paid_cents + kiosk.queued_cents + credited_cents:
+        kiosk.violations.append(f"money lost: {kiosk.inserted_cents} cents inserted, {kiosk.paid_cents} paid, "
+                                f"{kiosk.queued_cents} queued, {credited_cents} credited")
+    if round(kiosk.journal.collected_amount * 100) != credited_cents:
+        kiosk.violations.append(f"journal replay credits {kiosk.journal.collected_amount} AUD, "
+                                f"the kiosk {kiosk.collected_amount} AUD")
+
+
+async def fuzz(event_count, seed, timeout_scale, burst, idle):
+    rng = random.Random(seed)
+    kiosk = FuzzKiosk()
+
+    def on_screen(context, screen, notification):
+        context.transitions[screen] += 1
+
+    timeouts = {screen: seconds * timeout_scale for screen, seconds in SCREEN_TIMEOUTS.items()}
+    machine = ScreenMachine(kiosk, table=SCREEN_TABLE, actions=FUZZ_ACTIONS, guards=FUZZ_GUARDS, timeouts=timeouts,
+                            on_screen=on_screen, trace=TraceBuffer(get_logger("fuzz"), size=64))
+    longest_timeout = max(timeouts.values())
+    runner = asyncio.create_task(machine.run())
+    kinds = collections.Counter()
+
+    start = time.perf_counter()
+    for sent in range(event_count):
+        kind, data = random_event(rng, kiosk)
+        kinds[kind] += 1
+        machine.post(kind, **data)
+        if sent % burst == burst - 1:
+            # Lets the machine drain the burst; now and then the kiosk idles long enough for a timeout
+            await asyncio.sleep(rng.uniform(0, 2 * longest_timeout) if rng.random() < idle else 0)
+            check(machine, kiosk)
+            if kiosk.violations:
+                break
+    while machine._queue.qsize():
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    check(machine, kiosk)
+    runner.cancel()
+
+    print(f"{machine.handled + machine.ignored} events in {elapsed:.2f} s: "
+          f"{(machine.handled + machine.ignored) / elapsed:,.0f} events/s, "
+          f"{machine.handled} transitions, {machine.ignored} ignored, {kiosk.scan_timeouts} scan timeouts")
+    print("posted:  " + ", ".join(f"{kind} {kinds[kind]}" for kind in EVENT_KINDS if kinds[kind]))
+    print("entered: " + ", ".join(f"{screen} {kiosk.transitions[screen]}" for screen in SCREENS))
+    if kiosk.violations:
+        machine.trace.dump("Invariant violated")
+        print(f"FAILED: {kiosk.violations[0]}")
+        return False
+    print("All invariants held")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout-scale", type=float, default=0.0001,
+                        help="factor applied to SCREEN_TIMEOUTS, so timeouts fire during the run")
+    parser.add_argument("--burst", type=int, default=16, help="events posted before yielding to the machine")
+    parser.add_argument("--idle", type=float, default=0.02, help="chance of idling after a burst")
+    args = parser.parse_args()
+    if not asyncio.run(fuzz(args.events, args.seed, args.timeout_scale, args.burst, args.idle)):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
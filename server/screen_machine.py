@@ -0,0 +1,187 @@
+import asyncio
+import time
+
+from log_setup import TraceBuffer, get_logger
+
+logger = get_logger()
+
+# Event kinds
+BUTTON = "button"                  # Short press
+HOLD = "hold"                      # Button held for the reset interval
+COIN = "coin"                      # data: amount
+SCAN_RESULT = "scan-result"        # data: address
+PAYOUT_OUTCOME = "payout-outcome"  # data: outcome ("sent", "queued" or "failed")
+TIMEOUT = "timeout"                # Posted by the machine when a screen's SCREEN_TIMEOUTS entry runs out
+EVENT_KINDS = (BUTTON, HOLD, COIN, SCAN_RESULT, PAYOUT_OUTCOME, TIMEOUT)
+
+ANY = "*"  # Table rows for an event on every screen, used when the screen has no row of its own
+
+SCREENS = ("welcome", "wallet", "insert-coin", "confirm-amount", "scan-wallet", "processing", "receipt", "error-page")
+
+
+class Event:
+    __slots__ = ("kind", "data", "posted")
+
+    def __init__(self, kind, **data):
+        self.kind = kind
+        self.data = data
+        self.posted = time.monotonic()
+
+    def __repr__(self):
+        return f"Event({self.kind!r}, {self.data!r})"
+
+
+class Transition:
+    """
+    One table row: go to `target` (None stays on the screen) and run `action`, if `guard` passes.
+
+    `guard(context, event)` and `action(context, event)` are names looked up in the machine's
+    guards and actions. An action may return a notification for the new screen.
+    """
+
+    __slots__ = ("target", "action", "guard")
+
+    def __init__(self, target, action=None, guard=None):
+        self.target = target
+        self.action = action
+        self.guard = guard
+
+
+# The kiosk's screen flow: (screen, event kind) -> rows tried in order, the first whose guard passes is taken
+SCREEN_TABLE = {
+    ("welcome", BUTTON): (Transition("wallet"),),
+    ("wallet", BUTTON): (Transition("insert-coin"),),
+    ("insert-coin", BUTTON): (Transition("confirm-amount"),),
+    ("confirm-amount", BUTTON): (Transition("scan-wallet", "start-scan"),),
+    ("error-page", BUTTON): (Transition("scan-wallet", "start-scan"),),
+    ("scan-wallet", BUTTON): (Transition("error-page", "cancel-scan"),),
+    ("processing", BUTTON): (Transition("welcome"),),
+    ("receipt", BUTTON): (Transition("welcome"),),
+
+    ("scan-wallet", SCAN_RESULT): (
+        Transition("error-page", "payout-busy", guard="payout-in-flight"),  # Left processing before it finished
+        Transition("error-page", "no-money", guard="no-money"),
+        Transition("processing", "start-payout"),
+    ),
+    ("scan-wallet", TIMEOUT): (Transition("error-page", "scan-timeout"),),
+    ("receipt", TIMEOUT): (Transition("welcome"),),
+
+    ("processing", PAYOUT_OUTCOME): (
+        Transition("receipt", "payout-settled", guard="payout-queued"),
+        Transition(None, "payout-settled"),
+    ),
+
+    (ANY, COIN): (Transition(None, "add-coin"),),
+    (ANY, HOLD): (Transition("welcome", "reset-session"),),
+    (ANY, PAYOUT_OUTCOME): (Transition(None, "payout-settled"),),  # The customer left the processing screen
+}
+
+# Seconds a screen may stay up before a TIMEOUT event is posted for it
+SCREEN_TIMEOUTS = {
+    "scan-wallet": 40,
+    "receipt": 60,
+}
+
+
+class ScreenMachine:
+    """
+    Table-driven screen flow for one kiosk, fed by a single event queue.
+
+    Everything that changes the screen (button presses, holds, coins, scan results, payout
+    outcomes, timeouts) is posted as an Event and handled one at a time by run(), so background
+    tasks never race each other over the screen. Dispatch is a dict lookup on (screen, kind),
+    falling back to (ANY, kind); events without a row are ignored. Entering a screen listed in
+    `timeouts` arms a timer that posts a TIMEOUT event, dropped if the screen was left meanwhile.
+
+    Actions must return quickly: long work (a scan, a payout) is started as a task that posts
+    its result back as an event. Every transition is recorded in `trace` (a TraceBuffer).
+    `on_screen(context, screen, notification)` is called after every screen change.
+    """
+
+    def __init__(self, context, screen="welcome", table=SCREEN_TABLE, actions=None, guards=None,
+                 timeouts=SCREEN_TIMEOUTS, on_screen=None, trace=None):
+        """
+        :param context: Passed to guards, actions and on_screen (the Kiosk).
+        :param actions: Action name -> function(context, event), sync or async.
+        :param guards: Guard name -> function(context, event) returning a bool.
+        :param trace: TraceBuffer for the transitions; one that keeps the last 256 is made if not given.
+        """
+        self.context = context
+        self.screen = screen
+        self.table = table
+        self.actions = actions or {}
+        self.guards = guards or {}
+        self.timeouts = timeouts
+        self.on_screen = on_screen
+        self.trace = trace if trace is not None else TraceBuffer(logger)
+        self.handled = 0
+        self.ignored = 0
+        self.errors = 0
+        self._queue = asyncio.Queue()
+        self._entered = 0  # Screen entries so far, to recognise stale timeouts
+        self._timer = None
+        missing = {row.action for rows in table.values() for row in rows if row.action} - set(self.actions)
+        missing |= {row.guard for rows in table.values() for row in rows if row.guard} - set(self.guards)
+        if missing:
+            raise ValueError(f"Screen table uses undefined actions or guards: {sorted(missing)}")
+
+    def post(self, kind, **data):
+        """Queues an event. Call from the event loop (use loop.call_soon_threadsafe from other threads)."""
+        self._queue.put_nowait(Event(kind, **data))
+
+    async def run(self):
+        """Handles queued events forever, one at a time."""
+        self._arm_timeout()
+        while True:
+            event = await self._queue.get()
+            try:
+                await self.dispatch(event)
+            except Exception:
+                self.errors += 1
+                logger.exception(f"Handling {event!r} on screen {self.screen!r} failed")
+                self.trace.dump(f"Screen machine error on {event!r}")
+
+    async def dispatch(self, event):
+        """Takes the transition for `event` from the current screen. Returns the Transition, or None if ignored."""
+        if event.kind == TIMEOUT and event.data.get("entry") != self._entered:
+            return None  # Armed for a screen that was left since
+        rows = self.table.get((self.screen, event.kind)) or self.table.get((ANY, event.kind))
+        row = None
+        for candidate in rows or ():
+            if candidate.guard is None or self.guards[candidate.guard](self.context, event):
+                row = candidate
+                break
+        if row is None:
+            self.ignored += 1
+            self.trace.record("ignored", self.screen, event.kind)
+            return None
+
+        previous = self.screen
+        if row.target is not None:
+            self.screen = row.target
+            self._entered += 1
+            self._arm_timeout()
+        notification = None
+        if row.action is not None:
+            notification = self.actions[row.action](self.context, event)
+            if asyncio.iscoroutine(notification):
+                notification = await notification
+        self.handled += 1
+        self.trace.record("transition", previous, event.kind, self.screen, row.action)
+        if row.target is not None and self.on_screen is not None:
+            result = self.on_screen(self.context, self.screen, notification)
+            if asyncio.iscoroutine(result):
+                await result
+        return row
+
+    def _arm_timeout(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        seconds = self.timeouts.get(self.screen)
+        if seconds is not None:
+            self._timer = asyncio.get_running_loop().call_later(seconds, self._post_timeout, self.screen, self._entered)
+
+    def _post_timeout(self, screen, entry):
+        self._timer = None
+        self.post(TIMEOUT, screen=screen, entry=entry)
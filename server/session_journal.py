@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import time
+
+from log_setup import get_logger
+
+logger = get_logger()
+
+
+class SessionState:
+    """The customer session rebuilt from the journal: inserted money, scanned address, screen and any open payout."""
+
+    def __init__(self, collected_amount=0, recipient_address="", screen="welcome", payout=None):
+        self.collected_amount = collected_amount
+        self.recipient_address = recipient_address
+        self.screen = screen
+        self.payout = payout  # {"amount", "address", "collected", "key"} of a payout started but not finished
+
+    def apply(self, event, data):
+        if event == "coin-received":
+            self.collected_amount += data["amount"]
+        elif event == "address-scanned":
+            self.recipient_address = data["address"]
+        elif event == "session-reset":
+            self.recipient_address = ""
+        elif event == "screen":
+            self.screen = data["screen"]
+        elif event == "payout-started":
+            self.payout = {"amount": data["amount"], "address": data["address"],
+                           "collected": data.get("collected", self.collected_amount), "key": data.get("key")}
+        elif event == "payout-finished":
+            if data.get("result"):
+                self._settle(data)
+            self.payout = None
+        elif event == "payout-queued":  # Handed to the payout outbox, which sends it later
+            self._settle(data)
+            self.payout = None
+
+    def _settle(self, data):
+        """Takes the money paid out off the session; coins inserted while the payout ran stay credited."""
+        paid = data.get("collected")
+        if paid is None:  # Journals written before the paid amount was recorded
+            paid = (self.payout or {}).get("collected", self.collected_amount)
+        self.collected_amount = round(self.collected_amount - paid, 2)
+        self.recipient_address = ""
+
+    def to_dict(self):
+        return {
+            "collected_amount": self.collected_amount,
+            "recipient_address": self.recipient_address,
+            "screen": self.screen,
+            "payout": self.payout,
+        }
+
+
+class SessionJournal:
+    """
+    Append-only journal of session events (coin-received, address-scanned, payout-started, ...).
+
+    append() applies an event to `state` and queues its JSON line; the lines are written and
+    fsynced together by a background thread, `commit_delay` seconds after the first one, so a
+    burst of coins costs one SD card flush. sync() commits immediately, for events that must be
+    on disk before acting on them (e.g. before a payout is sent).
+
+    Every `snapshot_every` events the state is written to `snapshot_path` and the journal is
+    truncated, so replaying it at startup stays short.
+    """
+
+    def __init__(self, path, snapshot_path, commit_delay=0.2, snapshot_every=256):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.commit_delay = commit_delay
+        self.snapshot_every = snapshot_every
+        self.state = SessionState()
+        self.seq = 0
+        self._file = None
+        self._pending = []
+        self._since_snapshot = 0
+        self._commit_lock = asyncio.Lock()
+        self._commit_task = None
+
+    def recover(self):
+        """
+        Rebuilds `state` from the snapshot and the journal, and opens the journal for appending.
+
+        A torn last line (from a crash mid-write) is ignored. Returns the number of journal events replayed.
+        """
+        snapshot_seq = 0
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.state = SessionState(**snapshot["state"])
+            snapshot_seq = self.seq = snapshot["seq"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Could not read the session snapshot, replaying the journal only: {e}")
+
+        replayed = 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping a torn journal line: {line!r}")
+                        continue
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    self.state.apply(record["event"], record)
+                    self.seq = record["seq"]
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+
+        self._since_snapshot = replayed
+        self._file = open(self.path, "a", encoding="utf-8")
+        return replayed
+
+    def append(self, event, **data):
+        """Records an event; it is on disk within `commit_delay` seconds (or after sync())."""
+        self.seq += 1
+        self.state.apply(event, data)
+        self._pending.append(json.dumps({"seq": self.seq, "ts": round(time.time(), 3), "event": event, **data}) + "\n")
+        if self._commit_task is None:
+            self._commit_task = asyncio.get_running_loop().create_task(self._commit_later())
+
+    async def sync(self):
+        """Writes and fsyncs everything appended so far."""
+        await self._commit()
+
+    async def _commit_later(self):
+        await asyncio.sleep(self.commit_delay)
+        self._commit_task = None
+        await self._commit()
+
+    async def _commit(self):
+        async with self._commit_lock:
+            if not self._pending:
+                return
+            lines, self._pending = self._pending, []
+            self._since_snapshot += len(lines)
+            snapshot = None
+            if self._since_snapshot >= self.snapshot_every:
+                # The state includes exactly the events in `lines` and before
+                snapshot = {"seq": self.seq, "state": self.state.to_dict()}
+                self._since_snapshot = 0
+            try:
+                await asyncio.to_thread(self._write, lines, snapshot)
+            except OSError as e:
+                logger.error(f"Could not write the session journal: {e}")
+
+    def _write(self, lines, snapshot=None):
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if snapshot is not None:
+            tmp_file = self.snapshot_path + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.snapshot_path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            # Events after the snapshot are still pending on the loop, so nothing is lost here
+            self._file.truncate(0)
+
+    def close(self):
+        """Writes whatever is pending and closes the journal. Call on shutdown, after the loop stopped."""
+        if self._commit_task is not None:
+            self._commit_task.cancel()
+            self._commit_task = None
+        if self._file is None:
+            return
+        if self._pending:
+            self._write(self._pending)
+            self._pending = []
+        self._file.close()
+        self._file = None
@@ -0,0 +1,66 @@
+import asyncio
+
+from log_setup import get_logger
+
+logger = get_logger()
+
+
+class TimerHandle:
+    __slots__ = ("deadline_tick", "callback", "args", "cancelled")
+
+    def __init__(self, deadline_tick, callback, args):
+        self.deadline_tick = deadline_tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel for many coarse deadlines (e.g. payout resubmit/fail times).
+
+    Timers are put in the slot of their deadline tick, so scheduling and cancelling are O(1)
+    and each tick only looks at one slot; timers more than one revolution away stay in their
+    slot until their round comes up. run() advances the wheel every `tick` seconds on the loop.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = 0
+
+    def __len__(self):
+        return sum(1 for slot in self.slots for handle in slot if not handle.cancelled)
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) about `delay` seconds from now (rounded up to the next tick)."""
+        ticks = max(1, -(-delay // self.tick))
+        handle = TimerHandle(self.current_tick + int(ticks), callback, args)
+        self.slots[handle.deadline_tick % len(self.slots)].append(handle)
+        return handle
+
+    def advance(self):
+        """Moves the wheel one tick and runs the timers that are due."""
+        self.current_tick += 1
+        slot_index = self.current_tick % len(self.slots)
+        slot = self.slots[slot_index]
+        due = [handle for handle in slot if handle.deadline_tick <= self.current_tick and not handle.cancelled]
+        self.slots[slot_index] = [handle for handle in slot if handle.deadline_tick > self.current_tick and not handle.cancelled]
+        for handle in due:
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception(f"Timer callback {handle.callback!r} failed")
+
+    async def run(self):
+        """Advances the wheel on the loop's clock, catching up on ticks missed while the loop was busy."""
+        loop = asyncio.get_running_loop()
+        started_at = loop.time() - self.current_tick * self.tick
+        while True:
+            next_tick_at = started_at + (self.current_tick + 1) * self.tick
+            await asyncio.sleep(max(0, next_tick_at - loop.time()))
+            while loop.time() >= started_at + (self.current_tick + 1) * self.tick:
+                self.advance()
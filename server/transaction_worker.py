@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import json
+
+from log_setup import get_logger
+from payout_backend import TERMINAL_TYPE, PayoutBackend
+
+logger = get_logger("payout")
+
+
+class TransactionWorker(PayoutBackend):
+    """
+    Keeps one long-lived Node transaction worker running and sends payouts to it (the "node" payout backend).
+
+    The worker (install/transaction-worker.js) keeps its RPC connection open between payouts.
+    Requests and log entries are JSON lines on its stdin/stdout, tagged with a request id.
+    Every request ends with a {"type": "result", "result": ...} entry (a bool for payouts). If
+    the worker dies it is restarted, and the requests it was handling end with a failed result
+    marked "unknown": the worker may have submitted them, and the submitted keys died with it.
+    """
+
+    def __init__(self, script, args=(), restart_delay=2, ready_timeout=30, cancel_timeout=5, on_state=None):
+        """
+        :param script: Path of the worker script run with node.
+        :param args: Extra command line arguments, e.g. ["--network", "mainnet"].
+        :param restart_delay: Seconds to wait before restarting a worker that exited.
+        :param ready_timeout: Seconds a request waits for the worker to be ready before it fails "offline",
+            even without a timeout of its own.
+        :param cancel_timeout: Seconds a timed out request waits for the worker to answer its cancel frame
+            before it fails "unknown".
+        :param on_state: Optional callback(ready, detail), called when the worker becomes ready or goes away.
+        """
+        self.script = script
+        self.args = list(args)
+        self.restart_delay = restart_delay
+        self.ready_timeout = ready_timeout
+        self.cancel_timeout = cancel_timeout
+        self.on_state = on_state
+        self.process = None
+        self._ids = itertools.count(1)
+        self._pending = {}  # request id -> queue of log entries
+        self._ready = asyncio.Event()
+        self._supervisor = None
+
+    def start(self):
+        """Starts the worker in the background and keeps it running."""
+        if self._supervisor is None:
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+    @property
+    def ready(self):
+        """True while the worker process is running and has reported it is ready."""
+        return self._ready.is_set()
+
+    def payout(self, address, amount, timeout=None, key=None):
+        """
+        Asks the worker to send `amount` KAS to `address`.
+
+        Yields the worker's log entries for this payout; the last one is the "result" entry.
+        After `timeout` seconds, or if the caller is cancelled, the worker is told to cancel the
+        payout. It only honours that before the transaction is signed, and answers the cancel frame
+        with an entry carrying "cancelled": true or false. A timed out payout fails plainly only if
+        the worker confirmed the cancel; otherwise (too late, or no answer within `cancel_timeout`)
+        it fails "unknown". A cancelled caller gets no answer, so it must assume the payout may
+        have gone out. Once the payout has ended, the worker's remaining log entries are just logged.
+
+        With an idempotency `key`, the worker refuses to submit the same payout twice; the
+        refusal is an "error" entry with "duplicate": true and the earlier "txid".
+        Failures before the request reached a running worker carry "offline": true; those of a
+        worker that exited while handling it carry "unknown": true.
+        """
+        request = {"address": address, "amount": amount}
+        if key is not None:
+            request["key"] = key
+        return self._entries(request, timeout)
+
+    def payout_batch(self, outputs, timeout=None):
+        """
+        Asks the worker to pay several {"address": ..., "amount": ..., "key": ...} outputs in one transaction.
+
+        Yields log entries like payout(). Entries about a single output carry its "output" index,
+        and the "result" entry adds "outputs", the outcome of each output.
+        """
+        return self._entries({"outputs": list(outputs)}, timeout)
+
+    async def request(self, method, timeout=None, **params):
+        """
+        Sends a non-payout request (e.g. "check") and returns its result, or False if it failed.
+
+        The request's log entries are logged rather than returned.
+        """
+        async for entry in self._entries({"method": method, **params}, timeout):
+            if entry.get("type") == TERMINAL_TYPE:
+                return entry.get("result")
+            logger.info(f"[{str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+        return False
+
+    async def _entries(self, request, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        request_id = next(self._ids)
+        entries = asyncio.Queue()
+        finished = cancelling = False
+        try:
+            try:
+                ready_wait = self.ready_timeout if deadline is None else min(self.ready_timeout, self._remaining(loop, deadline))
+                await asyncio.wait_for(self._ready.wait(), ready_wait)
+                self._pending[request_id] = entries
+                self.process.stdin.write((json.dumps({"id": request_id, **request}) + "\n").encode())
+                await self.process.stdin.drain()
+            except asyncio.TimeoutError:
+                self._fail(entries, f"Transaction worker was not ready within {ready_wait:.1f} seconds", offline=True)
+            except (BrokenPipeError, ConnectionResetError):
+                self._fail(entries, "Transaction worker is not running", offline=True)
+            while not finished:
+                if not entries.empty():
+                    entry = entries.get_nowait()
+                else:
+                    try:
+                        entry = await asyncio.wait_for(entries.get(), self._remaining(loop, deadline))
+                    except asyncio.TimeoutError:
+                        if cancelling:
+                            self._fail(entries, f"Request timed out after {timeout} seconds and the worker did not "
+                                                "answer the cancel, the payout may have been submitted", unknown=True)
+                        elif request_id in self._pending:
+                            # Until the worker answers, the payout may still go out
+                            cancelling = True
+                            deadline = loop.time() + self.cancel_timeout
+                            self._cancel(request_id)
+                            continue
+                        else:
+                            self._fail(entries, f"Request timed out after {timeout} seconds")
+                        entry = entries.get_nowait()
+                if cancelling and "cancelled" in entry:
+                    if entry["cancelled"] is True:
+                        self._fail(entries, f"Request timed out after {timeout} seconds")
+                    else:
+                        self._fail(entries, f"Request timed out after {timeout} seconds, the payout may have been "
+                                            "submitted", unknown=True)
+                    cancelling = False
+                    self._pending.pop(request_id, None)  # The worker's own result for it is just logged
+                finished = entry.get("type") == TERMINAL_TYPE
+                yield entry
+        finally:
+            self._pending.pop(request_id, None)
+            if not finished:
+                self._cancel(request_id)
+
+    @staticmethod
+    def _remaining(loop, deadline):
+        return None if deadline is None else max(0, deadline - loop.time())
+
+    def _cancel(self, request_id):
+        """Tells the worker to drop `request_id` if it has not been signed yet."""
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.stdin.write((json.dumps({"id": request_id, "cancel": True}) + "\n").encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def _supervise(self):
+        while True:
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    "node", self.script, *self.args,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                logger.info(f"Transaction worker started, pid {self.process.pid}")
+                await asyncio.gather(self._read_stdout(self.process.stdout), self._read_stderr(self.process.stderr))
+                returncode = await self.process.wait()
+                logger.warning(f"Transaction worker exited with code {returncode}")
+                self._notify_state(False, f"worker exited with code {returncode}, restarting")
+            except OSError as e:
+                logger.error(f"Transaction worker failed to start: {e}")
+                self._notify_state(False, f"worker failed to start: {e}")
+            finally:
+                self._ready.clear()
+                self._fail_pending("Transaction worker exited, the payout may have been submitted")
+            await asyncio.sleep(self.restart_delay)
+
+    async def _read_stdout(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            output = line.decode(errors="replace").strip()
+            if not output:
+                continue
+            try:
+                entry = json.loads(output)
+            except json.JSONDecodeError:
+                logger.info(f"[UNKNOWN] {output}")  # Handle non-JSON outputs
+                continue
+            self._dispatch(entry)
+
+    async def _read_stderr(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            logger.info(f"[WORKER] {line.decode(errors='replace').strip()}")
+
+    def _dispatch(self, entry):
+        if entry.get("type") == "ready":
+            self._ready.set()
+            self._notify_state(True, f"worker pid {self.process.pid}")
+            return
+        entries = self._pending.get(entry.get("id"))
+        if entries is None:
+            logger.info(f"[{str(entry.get('type', 'info')).upper()}] {entry.get('message', '')}")
+            return
+        entries.put_nowait(entry)
+
+    def _fail_pending(self, message):
+        for entries in self._pending.values():
+            self._fail(entries, message, unknown=True)
+        self._pending.clear()
+
+    @staticmethod
+    def _fail(entries, message, offline=False, unknown=False):
+        entry = {"type": "error", "message": message}
+        if offline:
+            entry["offline"] = True
+        if unknown:
+            entry["unknown"] = True
+        entries.put_nowait(entry)
+        entries.put_nowait({"type": TERMINAL_TYPE, "result": False})
@@ -0,0 +1,180 @@
+"""
+Compares the JSON and the compact wire protocols: bytes on the wire, frames and delivery latency.
+
+    python3 wire_benchmark.py [--sessions 20] [--clients 5] [--tick 0.05] [--modes json compact msgpack]
+
+Replays `--sessions` customer sessions (screen changes, a burst of coins, a payout's submit-log
+lines, the outcome, price updates that mostly do not change) through one Broadcaster to
+`--clients` websocket clients per mode, each with and without permessage-deflate. Reports the
+bytes received per session (websocket frames and TCP payload), the frames per session and the
+latency from publish() to receipt of each event (the compact protocol holds the events of a
+burst for up to one tick; events that changed nothing are not counted). msgpack needs the
+msgpack package.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.parse
+
+import websockets
+
+from broadcaster import Broadcaster
+from wire_protocol import negotiate
+
+LOG_LINES = [
+    ("INFO", "Connecting to the node..."),
+    ("INFO", "Fetching UTXOs for kaspa:qypvmhfdgvpcqj9l3c5zjvcq0yss5ha8c2t6ydxagq3c6yd6n7k4ujs2wl6a5kz"),
+    ("INFO", "Building transaction: 1 input, 2 outputs, fee 2036 sompi"),
+    ("INFO", "Signing transaction..."),
+    ("INFO", "Transaction sent. TXID: 5d3f4b08e4b1fbc62e6e8e7f0b1f1b0c9f9c2c1b7ad3b1b6c3d7e2f1a0b9c8d7. Waiting for confirmation..."),
+    ("WARN", "Still waiting for confirmation (2 s)"),
+    ("INFO", "Transaction accepted by the node"),
+    ("SUCCESS", "Transaction confirmed! TXID: 5d3f4b08e4b1fbc62e6e8e7f0b1f1b0c9f9c2c1b7ad3b1b6c3d7e2f1a0b9c8d7"),
+]
+READINESS = {"ready": True, "subsystems": {name: {"state": "ready", "detail": None, "seconds": 1.2}
+                                           for name in ("websocket", "hardware:main", "prices", "payouts")}}
+
+
+def session_events(rng):
+    """(delay before, event, data) of one customer session, roughly as the server publishes them."""
+    events = [(0.2, "screen-change", {"screen": "wallet", "notification": None}),
+              (0.2, "screen-change", {"screen": "insert-coin", "notification": None})]
+    total = 0
+    for _ in range(rng.randint(3, 10)):
+        amount = rng.choice([0.1, 0.2, 0.5, 1.0, 2.0])
+        total = round(total + amount, 2)
+        events.append((rng.uniform(0.05, 0.3), "coin-update", {"amount": amount, "total_collected": total}))
+    events += [(0.3, "screen-change", {"screen": "confirm-amount", "notification": None}),
+               (0.3, "screen-change", {"screen": "scan-wallet", "notification": None}),
+               (0.01, "clear-error-logs", {}),
+               (0.5, "screen-change", {"screen": "processing", "notification": None})]
+    for log_type, message in LOG_LINES:
+        events.append((rng.uniform(0.001, 0.02), "submit-log", {"type": log_type, "message": message}))
+    events += [(0.005, "submit-outcome", {"result": True}),
+               (0.05, "coin-update", {"amount": 0, "total_collected": 0}),
+               (0.3, "exchange-update", {"kaspa_price": 0.0812, "usd_to_aud": 1.53, "stale": False}),
+               (0.1, "readiness", READINESS),
+               (0.3, "screen-change", {"screen": "welcome", "notification": None})]
+    return events
+
+
+class Client:
+    def __init__(self, mode, deflate):
+        self.mode = mode
+        self.deflate = deflate
+        self.frames = 0
+        self.message_bytes = 0
+        self.wire_bytes = 0
+        self.receipts = []  # (first seq, last seq, perf_counter() at receipt)
+        self.last_seq = 0
+
+    async def run(self, port, done):
+        query = {"json": "", "compact": "?protocol=2", "msgpack": "?protocol=2&encoding=msgpack"}[self.mode]
+        async with websockets.connect(f"ws://127.0.0.1:{port}/{query}", compression="deflate" if self.deflate else None,
+                                      max_size=None) as websocket:
+            data_received = websocket.data_received
+
+            def count(data):
+                self.wire_bytes += len(data)
+                data_received(data)
+
+            websocket.data_received = count  # TCP payload, after permessage-deflate
+            while True:
+                try:
+                    raw = await asyncio.wait_for(websocket.recv(), 1)
+                except asyncio.TimeoutError:
+                    if done.is_set():
+                        return
+                    continue
+                now = time.perf_counter()
+                self.frames += 1
+                self.message_bytes += len(raw)
+                if self.mode == "msgpack":
+                    import msgpack
+                    message = msgpack.unpackb(raw)
+                else:
+                    message = json.loads(raw)
+                seq = message.get("seq") if self.mode == "json" else message.get("v")
+                if message.get("event") == "state-snapshot" or "s" in message:
+                    self.last_seq = seq
+                    continue
+                if seq > self.last_seq:
+                    self.receipts.append((self.last_seq + 1, seq, now))
+                    self.last_seq = seq
+
+    def latencies(self, published):
+        return [received - published[seq] for first, last, received in self.receipts
+                for seq in range(first, last + 1) if seq in published]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=5, help="clients per mode, with and without deflate each")
+    parser.add_argument("--tick", type=float, default=0.05, help="seconds the compact protocol coalesces events")
+    parser.add_argument("--speed", type=float, default=4, help="replay the sessions this many times faster")
+    parser.add_argument("--modes", nargs="+", default=["json", "compact", "msgpack"])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    broadcaster = Broadcaster(max_queue=1000, history_size=100000, tick=args.tick)
+    published = {}  # seq -> perf_counter() at publish
+
+    async def handler(websocket):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(websocket.request.path).query)
+        broadcaster.add(websocket, *negotiate(query))
+        broadcaster.send_to(websocket, "state-snapshot", {"epoch": broadcaster.epoch, "screen": "welcome",
+                                                          "total_collected": 0, "readiness": READINESS,
+                                                          "kaspa_price": 0.0812, "usd_to_aud": 1.53, "stale": False})
+        try:
+            await websocket.wait_closed()
+        finally:
+            broadcaster.remove(websocket)
+
+    server = await websockets.serve(handler, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    done = asyncio.Event()
+    clients = [Client(mode, deflate) for mode in args.modes for deflate in (False, True) for _ in range(args.clients)]
+    tasks = [asyncio.create_task(client.run(port, done)) for client in clients]
+    while len(broadcaster) < len(clients):
+        await asyncio.sleep(0.01)
+
+    rng = random.Random(args.seed)
+    publish_seconds = 0.0
+    event_count = 0
+    for _ in range(args.sessions):
+        for delay, event, data in session_events(rng):
+            await asyncio.sleep(delay / args.speed)
+            start = time.perf_counter()
+            broadcaster.publish(event, data)
+            publish_seconds += time.perf_counter() - start
+            published[broadcaster.seq] = start
+            event_count += 1
+    await asyncio.sleep(args.tick + 0.2)
+    done.set()
+    await asyncio.gather(*tasks)
+    for first, last, frame in broadcaster.frames:
+        if frame is None:  # Changed nothing, so compact clients were not sent anything
+            for seq in range(first, last + 1):
+                published.pop(seq, None)
+    server.close()
+    await server.wait_closed()
+
+    print(f"{args.sessions} sessions, {event_count} events, publish() {publish_seconds / event_count * 1e6:.1f} us per event")
+    for mode in args.modes:
+        for deflate in (False, True):
+            group = [client for client in clients if client.mode == mode and client.deflate == deflate]
+            latencies = sorted(latency for client in group for latency in client.latencies(published))
+            label = f"{mode}{' + deflate' if deflate else ''}"
+            print(f"{label:>17}: {group[0].frames / args.sessions:5.1f} frames, "
+                  f"{group[0].message_bytes / args.sessions:7.0f} B of messages, "
+                  f"{group[0].wire_bytes / args.sessions:7.0f} B on the wire per session | "
+                  f"latency p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms "
+                  f"({len(latencies) // len(group)} events)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""
+The compact wire protocol (version 2), which clients opt into with ws://host:8765/?protocol=2.
+
+Instead of one {"event", "data", "seq"} JSON message per event, the server sends one frame per
+tick, {"v": seq, "o": [ops]}, where `v` is the seq of the last event in it (the one to resume
+from) and the ops are, in publish order:
+
+  * a dict: a patch of the kiosk's state (screen, notification, kaspa_price, usd_to_aud,
+    stale, readiness), holding only the keys that changed; state events in a row are merged
+    into one patch, except that every screen change gets a patch of its own
+  * a list [code, data]: any other event, by its code in EVENTS; consecutive submit-log lines
+    are packed into one [code, type, message, type, message, ...] with the types as codes in
+    LOG_TYPES. coin-update is one of these, so every coin is sent with its amount, even one
+    that leaves the total unchanged
+
+The first frame after connecting (unless the client resumed) is the snapshot,
+{"v": seq, "s": state, "protocol": 2, "events": EVENTS, "log_types": LOG_TYPES}, so a client
+reads the code tables from the server it talks to. Frames are JSON text, or MessagePack binary
+with &encoding=msgpack (needs the msgpack package). permessage-deflate is negotiated by the
+websocket handshake as usual, in either protocol.
+"""
+import json
+
+from log_setup import get_logger
+
+logger = get_logger("ws")
+
+PROTOCOL_VERSION = 2
+EVENTS = ("state-snapshot", "screen-change", "coin-update", "exchange-update", "readiness", "submit-log",
+          "submit-outcome", "payout-receipt", "payout-status", "clear-error-logs", "metrics", "profile-status")
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS)}
+LOG_TYPES = ("INFO", "WARN", "ERROR", "SUCCESS", "PENDING", "RESULT")
+LOG_TYPE_CODES = {log_type: code for code, log_type in enumerate(LOG_TYPES)}
+SUBMIT_LOG = EVENT_CODES["submit-log"]
+
+# Events that only change the kiosk's state, and the state keys they set
+STATE_EVENTS = {
+    "screen-change": lambda data: {"screen": data["screen"], "notification": data.get("notification")},
+    "exchange-update": lambda data: {key: data[key] for key in ("kaspa_price", "usd_to_aud", "stale") if key in data},
+    "readiness": lambda data: {"readiness": data},
+}
+# Sent even when unchanged: the UI clears its logs on every screen change to "welcome"
+ALWAYS_PATCHED = {"screen"}
+_MISSING = object()
+
+
+def pack_event(event, data):
+    """An event that is not a state change as a [code, data] op (by name for events without a code)."""
+    if event == "submit-log":
+        log_type = data.get("type", "INFO")
+        return [SUBMIT_LOG, LOG_TYPE_CODES.get(log_type, log_type), data.get("message", "")]
+    return [EVENT_CODES.get(event, event), data]
+
+
+class DeltaEncoder:
+    """Turns published events into frame ops, keeping the state last sent so patches hold only what changed."""
+
+    def __init__(self):
+        self.state = {}
+
+    def ops(self, events):
+        """The ops for `events` ((event, data) pairs, in publish order)."""
+        ops = []
+        for event, data in events:
+            to_state = STATE_EVENTS.get(event)
+            if to_state is None:
+                op = pack_event(event, data)
+                if op[0] == SUBMIT_LOG and ops and isinstance(ops[-1], list) and ops[-1][0] == SUBMIT_LOG:
+                    ops[-1].extend(op[1:])
+                else:
+                    ops.append(op)
+                continue
+            patch = {}
+            for key, value in to_state(data).items():
+                if key in ALWAYS_PATCHED or self.state.get(key, _MISSING) != value:
+                    patch[key] = value
+                self.state[key] = value
+            if not patch:
+                continue
+            if ops and isinstance(ops[-1], dict) and not ("screen" in patch and "screen" in ops[-1]):
+                ops[-1].update(patch)
+            else:
+                ops.append(patch)
+        return ops
+
+
+def snapshot_frame(seq, state):
+    return {"v": seq, "s": state, "protocol": PROTOCOL_VERSION, "events": EVENTS, "log_types": LOG_TYPES}
+
+
+def encode_frame(frame, encoding="json"):
+    """The frame as JSON text or MessagePack bytes."""
+    if encoding == "msgpack":
+        import msgpack
+        return msgpack.packb(frame, use_bin_type=True)
+    return json.dumps(frame, separators=(",", ":"))
+
+
+def negotiate(query):
+    """The (protocol, encoding) a client asked for with ?protocol=2&encoding=msgpack; ("json", "json") by default."""
+    if query.get("protocol", [""])[0] != str(PROTOCOL_VERSION):
+        return "json", "json"
+    encoding = query.get("encoding", ["json"])[0]
+    if encoding == "msgpack":
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            logger.warning("Client asked for MessagePack frames, but msgpack is not installed: sending JSON")
+            encoding = "json"
+    elif encoding != "json":
+        encoding = "json"
+    return "compact", encoding
@@ -0,0 +1,373 @@
+"""
+Load-tests and soaks the kiosk's websocket server with hundreds of simulated displays.
+
+    python3 ws_load_test.py [--clients 200] [--duration 60] [--slow 0.1] [--slow-delay 0.5] [--metrics 0.05]
+                            [--storm-interval 15] [--storm-fraction 0.3] [--abort 0.5] [--session-gap 1]
+                            [--sample-interval 5] [--settle 5] 2> server.log
+
+Runs click-socket.py on its own event loop in a background thread, with the simulated GPIO
+board, the fake QR reader and the mock payout backend, from a temporary directory. Needs
+nothing but free ports 8765 and 9108, so it runs on any Linux box.
+
+Connects `--clients` displays spread over the server's kiosks. A `--slow` fraction of them
+reads one message every `--slow-delay` seconds and a `--metrics` fraction subscribes to the
+metrics. Every `--storm-interval` seconds a `--storm-fraction` of the displays drop their
+connection at once (an `--abort` fraction of those without a close handshake) and reconnect
+right away, resuming from the last seq they saw. Meanwhile every kiosk runs customer sessions:
+button presses, coins, a QR code and a mock payout, `--session-gap` seconds apart.
+
+Reports the delivery latency (publish on the server to receipt by the display, p50/p99, for
+normal and slow displays), the connections, resumes and server-side disconnects, the process's
+memory growth over the soak (RSS sampled every `--sample-interval` seconds) and the server's
+tasks and clients left `--settle` seconds after every display disconnected.
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import random
+import runpy
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import websockets
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "click-socket.py")
+SERVER_URL = "ws://127.0.0.1:8765/"
+ADDRESS = "kaspa:qpp6ekunv44ffjq8757sd2qufz0tklfecc9457y7w25kmhq35r9sgec0vjru8"
+UNTIMED_EVENTS = {"state-snapshot", "metrics"}  # Sent to one client with the current seq, not published
+
+
+class Server:
+    """click-socket.py running on its own event loop in a background thread."""
+
+    def __init__(self):
+        self.namespace = None
+        self.loop = None
+        self.main_task = None
+        self.published = {}  # (kiosk id, seq) -> time.monotonic() it was published
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._error = None
+
+    def start(self):
+        threading.Thread(target=self._run, name="server", daemon=True).start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            self.namespace = runpy.run_path(SERVER_SCRIPT, run_name="changeomatic")
+            for kiosk_id, kiosk in self.namespace["kiosks"].items():
+                self._time_publishes(kiosk_id, kiosk.broadcaster)
+            self.loop = asyncio.new_event_loop()
+        except BaseException as e:
+            self._error = e
+            return
+        finally:
+            self._started.set()
+        self.main_task = self.loop.create_task(self.namespace["main"]())
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except asyncio.CancelledError:
+            pass  # Stopped by stop()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            self._stopped.set()
+
+    def _time_publishes(self, kiosk_id, broadcaster):
+        publish = broadcaster.publish
+
+        def timed_publish(event, data):
+            self.published[(kiosk_id, broadcaster.seq + 1)] = time.monotonic()
+            return publish(event, data)
+
+        broadcaster.publish = timed_publish
+
+    async def run(self, coroutine):
+        """Runs `coroutine` on the server's loop."""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    async def state(self):
+        """Tasks (by coroutine name), connected clients and queued messages on the server."""
+        async def collect():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            kiosks = self.namespace["kiosks"].values()
+            return {
+                "tasks": collections.Counter(getattr(task.get_coro(), "__qualname__", repr(task.get_coro()))
+                                             for task in tasks),
+                "clients": sum(len(kiosk.broadcaster) for kiosk in kiosks),
+                "queued": sum(len(channel.queue) for kiosk in kiosks for channel in kiosk.broadcaster.clients.values()),
+                "metrics_subscribers": len(self.namespace["metrics_subscribers"]),
+            }
+        return await self.run(collect())
+
+    async def stop(self):
+        """Cancels main() and every task it left, like Ctrl+C would."""
+        self.loop.call_soon_threadsafe(self.main_task.cancel)
+        await asyncio.to_thread(self._stopped.wait, 10)
+        self.namespace["log_listener"].stop()
+
+
+class Display:
+    """One simulated kiosk display: connects, reads every message and reconnects with resume when dropped."""
+
+    def __init__(self, kiosk_id, published, slow_delay=0, subscribe_metrics=False):
+        self.kiosk_id = kiosk_id
+        self.published = published
+        self.slow_delay = slow_delay
+        self.subscribe_metrics = subscribe_metrics
+        self.websocket = None
+        self.connected_at = None
+        self.epoch = None
+        self.seq = 0
+        self.latencies = []  # Seconds from publish to receipt, of messages published while connected
+        self.counts = collections.Counter()  # connects, snapshots, resumed, replayed, messages, server-closed, errors
+        self._dropping = False
+
+    def url(self):
+        query = {"kiosk": self.kiosk_id}
+        if self.epoch is not None:
+            query.update(epoch=self.epoch, resume=self.seq)
+        return f"{SERVER_URL}?{urllib.parse.urlencode(query)}"
+
+    async def run(self, stop):
+        while not stop.is_set():
+            self._dropping = False
+            try:
+                async with websockets.connect(self.url(), open_timeout=30) as websocket:
+                    self.websocket = websocket
+                    self.connected_at = time.monotonic()
+                    self.counts["connects"] += 1
+                    if self.subscribe_metrics:
+                        await websocket.send(json.dumps({"command": "subscribe", "topic": "metrics"}))
+                    async for raw_message in websocket:
+                        self.receive(raw_message, time.monotonic())
+                        if self.slow_delay:
+                            await asyncio.sleep(self.slow_delay)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+                self.counts["errors"] += 1
+                await asyncio.sleep(1)
+            finally:
+                self.websocket = None
+            if not self._dropping and not stop.is_set():
+                self.counts["server-closed"] += 1
+
+    def receive(self, raw_message, received_at):
+        message = json.loads(raw_message)
+        event, seq = message["event"], message.get("seq")
+        self.counts["messages"] += 1
+        if event == "state-snapshot":
+            self.epoch = message["data"]["epoch"]
+            self.counts["snapshots"] += 1
+        if seq is None or event in UNTIMED_EVENTS:
+            return
+        published_at = self.published.get((self.kiosk_id, seq))
+        if published_at is not None and published_at >= self.connected_at:
+            self.latencies.append(received_at - published_at)
+        elif seq > self.seq:
+            self.counts["replayed"] += 1  # Missed while disconnected, sent on resume
+        self.seq = max(self.seq, seq)
+
+    def drop(self, abort):
+        """Drops the connection: with a close handshake, or by cutting the TCP connection."""
+        if self.websocket is None:
+            return
+        self._dropping = True
+        if abort:
+            self.websocket.transport.abort()
+        else:
+            asyncio.create_task(self.websocket.close())
+
+    async def close(self):
+        self._dropping = True
+        if self.websocket is not None:
+            await self.websocket.close()
+
+
+async def customer_sessions(kiosk, stop, gap, rng, outcomes):
+    """Plays customer sessions on one kiosk until `stop`: wallet, coins, confirm, QR scan, payout, back to welcome."""
+    async def press():
+        kiosk.gpio.press_button(kiosk.button_pin, 0.1)
+        await asyncio.sleep(0.35)
+
+    async def wait_while(condition, timeout):
+        deadline = time.monotonic() + timeout
+        while condition() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    await wait_while(lambda: kiosk.code_reader is None, 30)  # The simulated hardware is attached in the background
+    while not stop.is_set():
+        if kiosk.screen != "welcome":
+            kiosk.gpio.press_button(kiosk.button_pin, 4.5)  # Hold to reset
+            await asyncio.sleep(5)
+        for _ in range(2):  # wallet, insert-coin
+            await press()
+        for _ in range(rng.randint(1, 4)):
+            kiosk.gpio.inject_pulses(kiosk.coin_pin, rng.choice((1, 2)))
+            await asyncio.sleep(0.4)
+        await press()  # confirm-amount
+        kiosk.code_reader.bus.show(ADDRESS)
+        await press()  # scan-wallet, then processing once the code is read
+        await wait_while(lambda: kiosk.screen == "scan-wallet", 10)
+        await wait_while(lambda: kiosk.payout_task is not None, 60)
+        kiosk.code_reader.bus.hide()
+        outcomes[kiosk.screen] += 1
+        await press()  # welcome
+        await asyncio.sleep(gap)
+
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def slope_per_hour(samples):
+    """Least-squares slope of (seconds, value) samples, per hour."""
+    if len(samples) < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_v = sum(v for _, v in samples) / len(samples)
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / variance * 3600 if variance else 0.0
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+async def storms(displays, stop, interval, fraction, abort, rng, counts):
+    while True:
+        await asyncio.sleep(interval)
+        if stop.is_set():
+            return
+        for display in rng.sample(displays, int(len(displays) * fraction)):
+            aborted = rng.random() < abort
+            display.drop(aborted)
+            counts["aborted" if aborted else "closed"] += 1
+
+
+async def sample_memory(start, interval, samples, server, server_samples):
+    while True:
+        samples.append((time.monotonic() - start, rss_mb()))
+        state = await server.state()
+        server_samples.append((time.monotonic() - start, sum(state["tasks"].values()), state["queued"]))
+        await asyncio.sleep(interval)
+
+
+async def load_test(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="changeomatic-load-")
+    os.chdir(workdir)  # Journals, caches and logs of this run stay out of the way
+    os.environ.setdefault("CHANGEOMATIC_GPIO", "sim")
+    os.environ.setdefault("CHANGEOMATIC_QR", "sim")
+    os.environ.setdefault("CHANGEOMATIC_PAYOUT", "mock")
+
+    server = Server()
+    server.start()
+    namespace = server.namespace
+    kiosks = namespace["kiosks"]
+    stop = asyncio.Event()
+    outcomes = collections.Counter()
+    session_tasks = [asyncio.create_task(customer_sessions(kiosk, stop, args.session_gap, rng, outcomes))
+                     for kiosk in kiosks.values()]
+    # One session per kiosk first, so tasks started on first use (e.g. the payout batcher) are in the baseline
+    while sum(outcomes.values()) < len(kiosks):
+        await asyncio.sleep(0.1)
+    baseline = await server.state()
+    print(f"Server up in {workdir}: kiosks {', '.join(kiosks)}, {sum(baseline['tasks'].values())} tasks "
+          "after the first sessions")
+
+    displays = []
+    for index in range(args.clients):
+        kiosk_id = list(kiosks)[index % len(kiosks)]
+        displays.append(Display(kiosk_id, server.published,
+                                slow_delay=args.slow_delay if rng.random() < args.slow else 0,
+                                subscribe_metrics=rng.random() < args.metrics))
+    start = time.monotonic()
+    display_tasks = [asyncio.create_task(display.run(stop)) for display in displays]
+    outcomes.clear()
+    drops = collections.Counter()
+    memory, server_samples = [], []
+    background = [asyncio.create_task(storms(displays, stop, args.storm_interval, args.storm_fraction, args.abort,
+                                             rng, drops)),
+                  asyncio.create_task(sample_memory(start, args.sample_interval, memory, server, server_samples))]
+
+    await asyncio.sleep(args.duration)
+    stop.set()
+    for task in background + session_tasks:
+        task.cancel()
+    await asyncio.gather(*(display.close() for display in displays), return_exceptions=True)
+    await asyncio.gather(*display_tasks, return_exceptions=True)
+    elapsed = time.monotonic() - start
+    await asyncio.sleep(args.settle)
+    gc.collect()
+    memory.append((time.monotonic() - start, rss_mb()))
+    final = await server.state()
+    await server.stop()
+
+    counts = sum((display.counts for display in displays), collections.Counter())
+    print(f"{args.clients} displays for {elapsed:.0f} s: {counts['connects']} connects, {counts['snapshots']} snapshots, "
+          f"{counts['messages']} messages, {counts['replayed']} replayed on resume, "
+          f"{drops['closed']} closed + {drops['aborted']} aborted by storms, "
+          f"{counts['server-closed']} disconnected by the server, {counts['errors']} connect errors")
+    print(f"customer sessions: {sum(outcomes.values())} (ended on: "
+          f"{', '.join(f'{screen} {n}' for screen, n in outcomes.items())})")
+    for label, group in (("normal", [d for d in displays if not d.slow_delay]), ("slow", [d for d in displays if d.slow_delay])):
+        latencies = sorted(latency for display in group for latency in display.latencies)
+        if group:
+            print(f"{label:>7} displays ({len(group)}): {len(latencies)} live messages, delivery "
+                  f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+                  f"max {(latencies[-1] if latencies else float('nan')) * 1000:.1f} ms")
+    print(f"memory: RSS {memory[0][1]:.1f} MB -> {memory[-1][1]:.1f} MB, "
+          f"trend {slope_per_hour(memory[len(memory) // 2:]):+.1f} MB/h over the second half")
+    if server_samples:
+        print(f"server during the run: up to {max(tasks for _, tasks, _ in server_samples)} tasks, "
+              f"up to {max(queued for _, _, queued in server_samples)} messages queued")
+
+    leaked = final["tasks"] - baseline["tasks"]
+    print(f"after {args.settle:.0f} s settle: {sum(final['tasks'].values())} tasks "
+          f"(baseline {sum(baseline['tasks'].values())}), {final['clients']} clients, "
+          f"{final['metrics_subscribers']} metrics subscribers")
+    if leaked or final["clients"] or final["metrics_subscribers"]:
+        print("LEAKED: " + (", ".join(f"{name} x{n}" for name, n in leaked.items()) or "client state"))
+        return False
+    print("No leaked tasks or clients")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+    parser.add_argument("--slow", type=float, default=0.1, help="fraction of slow-reading displays")
+    parser.add_argument("--slow-delay", type=float, default=0.5, help="seconds a slow display takes per message")
+    parser.add_argument("--metrics", type=float, default=0.05, help="fraction of displays subscribing to the metrics")
+    parser.add_argument("--storm-interval", type=float, default=15, help="seconds between reconnect storms")
+    parser.add_argument("--storm-fraction", type=float, default=0.3, help="fraction of displays dropped per storm")
+    parser.add_argument("--abort", type=float, default=0.5, help="fraction of dropped connections cut without a close")
+    parser.add_argument("--session-gap", type=float, default=1, help="seconds between customer sessions")
+    parser.add_argument("--sample-interval", type=float, default=5, help="seconds between memory samples")
+    parser.add_argument("--settle", type=float, default=5, help="seconds after the displays left before counting leaks")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if not asyncio.run(load_test(args)):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
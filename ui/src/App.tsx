@@ -16,6 +16,53 @@ const kaspaLogoUrl = "/images/Kaspa-LDSP-Black.png";
 const kaspaWalletQrUrl = "/images/KaspiumQRCode.svg"; // Hardcoded QR URL
 
 const WS_URL = "ws://localhost:8765";
+// The coin machine this screen belongs to (http://.../?kiosk=<id>); the server's first kiosk if not given
+const KIOSK_ID = new URLSearchParams(window.location.search).get("kiosk");
+// One JSON message per event, unless opened with http://.../?protocol=2 for the server's compact protocol
+// (server/wire_protocol.py): a frame per tick of state patches and packed events, fewer bytes but up to a tick later
+const COMPACT_PROTOCOL = new URLSearchParams(window.location.search).get("protocol") === "2";
+
+type ServerMessage = { event: string; data: any; seq?: number };
+type CompactOp = Record<string, any> | any[];
+type CompactFrame = { v: number; s?: Record<string, any>; events?: string[]; log_types?: string[]; o?: CompactOp[] };
+type CompactCodes = { events: string[]; logTypes: string[] };
+
+// Turns a compact frame back into the messages of the JSON protocol. `state` is what the patches apply to
+const expandFrame = (frame: CompactFrame, codes: CompactCodes, state: Record<string, any>): ServerMessage[] => {
+  if (frame.s) {
+    codes.events = frame.events || [];
+    codes.logTypes = frame.log_types || [];
+    Object.keys(state).forEach((key) => delete state[key]);
+    Object.assign(state, frame.s);
+    return [{ event: "state-snapshot", data: frame.s, seq: frame.v }];
+  }
+  const messages: ServerMessage[] = [];
+  for (const op of frame.o || []) {
+    if (Array.isArray(op)) {
+      const event = typeof op[0] === "number" ? codes.events[op[0]] : op[0];
+      if (event === "submit-log") {
+        for (let i = 1; i < op.length; i += 2) {
+          const type = typeof op[i] === "number" ? codes.logTypes[op[i]] : op[i];
+          messages.push({ event, data: { type, message: op[i + 1] }, seq: frame.v });
+        }
+      } else {
+        messages.push({ event, data: op[1], seq: frame.v });
+      }
+      continue;
+    }
+    Object.assign(state, op);
+    if ("screen" in op) {
+      messages.push({ event: "screen-change", data: { screen: state.screen, notification: state.notification ?? null }, seq: frame.v });
+    }
+    if ("kaspa_price" in op || "usd_to_aud" in op || "stale" in op) {
+      messages.push({ event: "exchange-update", data: { kaspa_price: state.kaspa_price, usd_to_aud: state.usd_to_aud, stale: state.stale }, seq: frame.v });
+    }
+    if ("readiness" in op) {
+      messages.push({ event: "readiness", data: state.readiness, seq: frame.v });
+    }
+  }
+  return messages;
+};
 
 type ScreenType =
     | "welcome"
@@ -24,6 +71,7 @@ type ScreenType =
     | "confirm-amount"
     | "scan-wallet"
     | "processing"
+    | "receipt"
     | "error-page";
 
 const getNextScreen = (currentScreen: ScreenType): ScreenType => {
@@ -40,6 +88,8 @@ const getNextScreen = (currentScreen: ScreenType): ScreenType => {
       return "processing";
     case "processing":
       return "welcome";
+    case "receipt":
+      return "welcome";
     default:
       return "error-page";
   }
@@ -54,9 +104,18 @@ const App: React.FC = () => {
   const [submit_logs, setSubmitLogs] = useState<string[]>([]);
   const [submit_outcome, setSubmitOutcome] = useState(false);
   const [error_log, setErrorLog] = useState<string[]>([]);
+  // Payout kept in the server's outbox while the node is unreachable
+  const [receipt, setReceipt] = useState<{ reference: string; amount: string; address: string; total_collected: number; held?: boolean } | null>(null);
+  // Server subsystems (kiosk hardware, prices, payouts) still starting or failed after a boot
+  const [notReady, setNotReady] = useState<string[]>([]);
 
 
   const socketRef = useRef<WebSocket | null>(null);
+  // Last server epoch/sequence seen, so a reconnect only receives the messages it missed
+  const resumeRef = useRef<{ epoch: number; seq: number } | null>(null);
+  // Compact protocol: the server's event and log type codes, and the state its patches apply to
+  const codesRef = useRef<CompactCodes>({ events: [], logTypes: [] });
+  const frameStateRef = useRef<Record<string, any>>({});
 
   useEffect(() => {
     let reconnectAttempts = 0;
@@ -64,49 +123,100 @@ const App: React.FC = () => {
     const connectWebSocket = () => {
       if (socketRef.current) return;
 
-      socketRef.current = new WebSocket(WS_URL);
+      const resume = resumeRef.current;
+      const params = new URLSearchParams();
+      if (KIOSK_ID) params.set("kiosk", KIOSK_ID);
+      if (COMPACT_PROTOCOL) params.set("protocol", "2");
+      if (resume) {
+        params.set("epoch", String(resume.epoch));
+        params.set("resume", String(resume.seq));
+      }
+      socketRef.current = new WebSocket(params.toString() ? `${WS_URL}/?${params}` : WS_URL);
 
       socketRef.current.onopen = () => {
         setConnected(true);
         reconnectAttempts = 0;
       };
 
-      socketRef.current.onmessage = (event) => {
-        try {
-          const message = JSON.parse(event.data);
-          console.log("received message:", message);
-
-          // Handling "screen-change" message
-          if (message.event === "screen-change") {
-            setScreen(message.data.screen);
-            if (message.data.screen === "welcome"){
-              setSubmitLogs([]);
-              setErrorLog([]);
-            }
-            else if (message.data.screen === "error-page" && message.data.notification){
-              setErrorLog([...message.data.notification.split("/n")]);
-            }
-          }
+      const handleMessage = (message: ServerMessage) => {
+        console.log("received message:", message);
 
-          // Handling "coin-update" message
-          else if (message.event === "coin-update") {
-            setInsertedMoney(message.data.total_collected);
-          }
+        if (message.event === "state-snapshot") {
+          resumeRef.current = { epoch: message.data.epoch, seq: message.seq };
+        } else if (typeof message.seq === "number" && resumeRef.current) {
+          resumeRef.current.seq = message.seq;
+        }
 
-          else if (message.event === "exchange-update") {
-            setKaspaPrice(Math.round((message.data.kaspa_price + Number.EPSILON) * 1000) / 1000);
-            setUsdToCurrency(Math.round((1/(message.data.usd_to_aud) + Number.EPSILON) * 1000) / 1000);
-          }
-          else if (message.event === "submit-outcome"){
-            setSubmitOutcome(message.data.result);
-          }
-          else if (message.event === "submit-log"){
-            setSubmitLogs((prevLogs) => [...prevLogs, message.data.type + " " + message.data.message]);
+        const applyReadiness = (readiness: { subsystems: Record<string, { state: string }> } | undefined) => {
+          if (!readiness) return;
+          setNotReady(Object.entries(readiness.subsystems)
+              .filter(([, subsystem]) => subsystem.state !== "ready")
+              .map(([name, subsystem]) => subsystem.state === "failed" ? `${name} (failed)` : name));
+        };
+
+        // Handling "state-snapshot" message (sent on connect)
+        if (message.event === "state-snapshot") {
+          applyReadiness(message.data.readiness);
+          setScreen(message.data.screen);
+          setInsertedMoney(message.data.total_collected);
+          setKaspaPrice(Math.round((message.data.kaspa_price + Number.EPSILON) * 1000) / 1000);
+          setUsdToCurrency(Math.round((1/(message.data.usd_to_aud) + Number.EPSILON) * 1000) / 1000);
+          if (message.data.screen === "welcome"){
+            setSubmitLogs([]);
+            setErrorLog([]);
           }
-          else if (message.event === "clear-error-logs"){
+        }
+
+        // Handling "screen-change" message
+        else if (message.event === "screen-change") {
+          setScreen(message.data.screen);
+          if (message.data.screen === "welcome"){
+            setSubmitLogs([]);
             setErrorLog([]);
           }
+          else if (message.data.screen === "error-page" && message.data.notification){
+            setErrorLog([...message.data.notification.split("/n")]);
+          }
+        }
+
+        // Handling "coin-update" message
+        else if (message.event === "coin-update") {
+          setInsertedMoney(message.data.total_collected);
+        }
+
+        else if (message.event === "exchange-update") {
+          setKaspaPrice(Math.round((message.data.kaspa_price + Number.EPSILON) * 1000) / 1000);
+          setUsdToCurrency(Math.round((1/(message.data.usd_to_aud) + Number.EPSILON) * 1000) / 1000);
+        }
+        else if (message.event === "submit-outcome"){
+          setSubmitOutcome(message.data.result);
+        }
+        else if (message.event === "submit-log"){
+          setSubmitLogs((prevLogs) => [...prevLogs, message.data.type + " " + message.data.message]);
+        }
+        else if (message.event === "payout-receipt"){
+          setReceipt(message.data);
+        }
+        else if (message.event === "payout-status"){
+          // A background payout (unconfirmed while the customer waited, or sent from the outbox) changed state
+          const label = message.data.status === "failed" || message.data.status === "held" ? "ERROR"
+              : message.data.status === "confirmed" || message.data.status === "sent" ? "SUCCESS" : "WARN";
+          setSubmitLogs((prevLogs) => [...prevLogs, `${label} Payout of ${message.data.amount} KAS ${message.data.status}`]);
+        }
+        else if (message.event === "readiness"){
+          applyReadiness(message.data);
+        }
+        else if (message.event === "clear-error-logs"){
+          setErrorLog([]);
+        }
+      };
 
+      socketRef.current.onmessage = (event) => {
+        try {
+          const frame = JSON.parse(event.data);
+          // JSON protocol messages have an "event"; compact frames are expanded into the same messages
+          const messages = "event" in frame ? [frame] : expandFrame(frame, codesRef.current, frameStateRef.current);
+          messages.forEach(handleMessage);
         } catch (error) {
           console.error("Error parsing WebSocket message:", event.data);
           console.log("Invalid message data received:", event.data);
@@ -131,6 +241,7 @@ const App: React.FC = () => {
   const statusBar = (
       <div className="status-bar">
         <p>{connected ? "✓ Connected" : "Reconnecting to WebSocket... ♻"}</p>
+        {connected && notReady.length > 0 && <p>Starting: {notReady.join(", ")}...</p>}
       </div>
   );
 
@@ -255,6 +366,20 @@ const App: React.FC = () => {
 
             </div>
         )}
+        {screen === "receipt" && (
+            <Screen
+                message={receipt?.held
+                    ? "We could not confirm your payout. /nIt is on hold until we check it, so please keep this receipt."
+                    : "The Kaspa network is out of reach right now, /nbut your payout is saved and will be sent automatically."}
+                buttonLabel="Done"
+                extraContent={receipt && (
+                    <h3>
+                      Receipt {receipt.reference}: {Math.round((Number(receipt.amount) + Number.EPSILON) * 10) / 10} KASPA
+                      for ${receipt.total_collected} to {receipt.address}
+                    </h3>
+                )}
+            />
+        )}
         {screen === "error-page" && (
             <Screen
                 message="Uh-oh! Something glitched. Don’t worry, your coins are safe. Try again!"